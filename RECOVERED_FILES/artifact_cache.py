@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Converted-Weight Artifact Cache for LM Studio Server v3
+- Saves a loaded model's already cast / quantized tensors as safetensors shards
+- Later loads memory-map those shards instead of re-reading and re-converting the checkpoint
+- Keyed by model revision, dtype and quantization, with LRU eviction under a size budget
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+from safetensors.torch import save_file
+
+MANIFEST = 'artifact.json'
+SHARD_BYTES = 2 * 1024 ** 3  # host RAM one shard needs while it is written
+
+
+def snapshot_revision(snapshot):
+    """Commit hash of an HF cache snapshot, or a fingerprint of a plain directory's files"""
+    if os.path.basename(os.path.dirname(os.path.normpath(snapshot))) == 'snapshots':
+        return os.path.basename(os.path.normpath(snapshot))
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(snapshot)):
+        stat = os.stat(os.path.join(snapshot, name))
+        digest.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return digest.hexdigest()[:16]
+
+
+def _device_label(device):
+    return str(device).replace(':', '')
+
+
+class ArtifactCache:
+    """Directory of converted-weight artifacts under `root`, at most `max_bytes` in total.
+
+    An artifact is a directory of `<device>-<n>.safetensors` shards plus a
+    manifest written last, so a crash mid-store never leaves a half artifact
+    that looks complete. Tensors are stored device-agnostic: the placement
+    they were saved from is recorded in the manifest, but an artifact loads
+    into any device map. Stores run on a background thread so a load returns
+    as soon as the model is usable. A store only starts when the disk would
+    still have `min_free_bytes` left afterwards, and stops if the disk fills
+    up under it. The size of every complete artifact is also kept in
+    memory (read from disk once, then updated on store and remove), so
+    stats() never touches the filesystem.
+    """
+
+    def __init__(self, root, max_bytes, min_free_bytes=0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._storing = set()
+        self._lock = threading.Lock()
+        self._sizes = {e['artifact_id']: e.get('bytes', 0) for e in self.entries()}
+
+    @staticmethod
+    def artifact_id(model_name, revision, dtype, quantization=None):
+        name = re.sub(r'[^A-Za-z0-9._-]+', '--', model_name.strip('/'))
+        dtype = str(dtype).replace('torch.', '')
+        return f"{name}--{revision[:12]}--{dtype}--{quantization or 'none'}"
+
+    def path(self, artifact_id):
+        return os.path.join(self.root, artifact_id)
+
+    def lookup(self, artifact_id):
+        """Shard paths of a complete artifact (marking it recently used), or None"""
+        manifest = self._manifest(artifact_id)
+        if manifest is None:
+            self.misses += 1
+            return None
+        files = [os.path.join(self.path(artifact_id), name) for name in manifest['files']]
+        if not all(os.path.exists(f) for f in files):
+            self.misses += 1
+            return None
+        os.utime(os.path.join(self.path(artifact_id), MANIFEST))
+        self.hits += 1
+        return files
+
+    def _manifest(self, artifact_id):
+        try:
+            with open(os.path.join(self.path(artifact_id), MANIFEST)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store_async(self, artifact_id, model, info=None):
+        """Write model's tensors as artifact_id on a background thread (no-op if already stored or storing)"""
+        with self._lock:
+            if artifact_id in self._storing or self._manifest(artifact_id) is not None:
+                return None
+            self._storing.add(artifact_id)
+        thread = threading.Thread(target=self._store, args=(artifact_id, model, info or {}),
+                                  name='artifact-store', daemon=True)
+        thread.start()
+        return thread
+
+    def _store(self, artifact_id, model, info):
+        try:
+            # Tied weights share storage; keep the first name, tie_weights() restores the rest on load
+            tensors, seen = {}, set()
+            for name, tensor in model.state_dict().items():
+                key = (tensor.device, tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape))
+                if key in seen:
+                    continue
+                seen.add(key)
+                tensors[name] = tensor
+            total = sum(t.numel() * t.element_size() for t in tensors.values())
+            if not self._make_room(total):
+                print(f"⚠️  No room for artifact {artifact_id} ({total / 1e9:.1f}GB) in the cache budget "
+                      f"or on disk - not storing")
+                return
+
+            start = time.time()
+            dest = self.path(artifact_id)
+            partial = f'{dest}.partial-{os.getpid()}'
+            shutil.rmtree(partial, ignore_errors=True)
+            os.makedirs(partial)
+            files = []
+            try:
+                by_device = {}
+                for name, tensor in tensors.items():
+                    by_device.setdefault(tensor.device, []).append(name)
+                for device, names in by_device.items():
+                    shard, shard_bytes = {}, 0
+                    for name in names + [None]:
+                        if name is not None:
+                            tensor = tensors[name]
+                            shard[name] = tensor.detach().to('cpu').contiguous()
+                            shard_bytes += tensor.numel() * tensor.element_size()
+                        if shard and (name is None or shard_bytes >= SHARD_BYTES):
+                            # Other writers share the disk: re-check before every shard
+                            if self._disk_free() < shard_bytes + self.min_free_bytes:
+                                raise OSError(f'disk nearly full ({self._disk_free() / 1e9:.1f}GB free)')
+                            filename = f'{_device_label(device)}-{len(files):05d}.safetensors'
+                            save_file(shard, os.path.join(partial, filename))
+                            files.append(filename)
+                            shard, shard_bytes = {}, 0
+                manifest = dict(info, files=files, bytes=total, created_at=time.time())
+                with open(os.path.join(partial, MANIFEST), 'w') as f:
+                    json.dump(manifest, f, default=str)
+                shutil.rmtree(dest, ignore_errors=True)
+                os.rename(partial, dest)
+            except Exception:
+                shutil.rmtree(partial, ignore_errors=True)
+                raise
+            with self._lock:
+                self._sizes[artifact_id] = total
+            self.stores += 1
+            print(f"✅ Stored artifact {artifact_id}: {total / 1e9:.1f}GB in {time.time() - start:.1f}s")
+        except Exception as e:
+            print(f"⚠️  Could not store artifact {artifact_id}: {e}")
+        finally:
+            with self._lock:
+                self._storing.discard(artifact_id)
+
+    def entries(self):
+        """Manifest of every complete artifact, most recently used first"""
+        if not os.path.isdir(self.root):
+            return []
+        entries = []
+        for artifact_id in os.listdir(self.root):
+            manifest = self._manifest(artifact_id)
+            if manifest is None:
+                continue
+            manifest['artifact_id'] = artifact_id
+            manifest['last_used'] = os.path.getmtime(os.path.join(self.path(artifact_id), MANIFEST))
+            entries.append(manifest)
+        return sorted(entries, key=lambda e: -e['last_used'])
+
+    def total_bytes(self):
+        return sum(e.get('bytes', 0) for e in self.entries())
+
+    def remove(self, artifact_id):
+        if self._manifest(artifact_id) is None:
+            return False
+        shutil.rmtree(self.path(artifact_id), ignore_errors=True)
+        with self._lock:
+            self._sizes.pop(artifact_id, None)
+        return True
+
+    def _disk_free(self):
+        return shutil.disk_usage(self.root).free
+
+    def _make_room(self, required_bytes):
+        """Drop least recently used artifacts until required_bytes fit the budget and the disk.
+
+        Nothing is evicted when even an empty cache would leave the disk
+        below min_free_bytes - the space is held by something else.
+        """
+        if required_bytes > self.max_bytes:
+            return False
+        os.makedirs(self.root, exist_ok=True)
+        entries = self.entries()
+        if self._disk_free() + sum(e.get('bytes', 0) for e in entries) < required_bytes + self.min_free_bytes:
+            return False
+        while True:
+            used = sum(e.get('bytes', 0) for e in entries)
+            if used + required_bytes <= self.max_bytes and self._disk_free() >= required_bytes + self.min_free_bytes:
+                return True
+            if not entries:
+                return False
+            victim = entries.pop()['artifact_id']
+            print(f"Evicting artifact {victim}")
+            self.remove(victim)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            sizes = list(self._sizes.values())
+        return {
+            'root': self.root,
+            'artifacts': len(sizes),
+            'used_gb': round(sum(sizes) / 1e9, 2),
+            'budget_gb': round(self.max_bytes / 1e9, 2),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'storing': sorted(self._storing),
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,723 @@
+#!/usr/bin/env python3
+"""
+Continuous Batching Scheduler for LM Studio Server v3
+- Collects concurrent /generate requests into one decode batch
+- Admits new sequences and retires finished ones at every decode step
+- A single worker thread owns the model, so request threads never race into generate
+"""
+
+import itertools
+import math
+import random
+import threading
+import time
+import traceback
+from collections import deque
+
+import torch
+
+from logits_processors import RepetitionControls
+from metrics import BATCH_BUCKETS, Histogram
+from paged_kv_cache import PagedKVCache
+from sampling import row_params, sample, warp
+from tracing import SCHEDULER_TID
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+# Admission order: interactive requests are always admitted before batch ones
+LANES = ('interactive', 'batch')
+
+
+class QueueFull(Exception):
+    """A request was turned away because its lane or the token budget is full"""
+
+    def __init__(self, message, lane, retry_after):
+        super().__init__(message)
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers (0 when it is empty)"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def cache_to_tensors(past_key_values):
+    """Return [(key, value), ...] per layer for any HF cache format"""
+    if hasattr(past_key_values, 'layers'):
+        return [(layer.keys, layer.values) for layer in past_key_values.layers]
+    if hasattr(past_key_values, 'key_cache'):
+        return list(zip(past_key_values.key_cache, past_key_values.value_cache))
+    return [(k, v) for k, v in past_key_values]
+
+
+def tensors_to_cache(kv):
+    """Wrap per-layer (key, value) tensors in the cache type the model expects"""
+    if DynamicCache is None:
+        return tuple(kv)
+    if hasattr(DynamicCache, 'from_legacy_cache'):
+        return DynamicCache.from_legacy_cache(tuple(kv))
+    return DynamicCache(kv)
+
+
+class GenerationRequest:
+    """One /generate call travelling through the scheduler"""
+
+    def __init__(self, input_ids, max_new_tokens=50, temperature=0.8, top_p=0.9, eos_token_id=None,
+                 speculative=False, lane='interactive', logprobs=None, seed=None, top_k=0, min_p=0.0):
+        if lane not in LANES:
+            raise ValueError(f"Unknown priority '{lane}' (use one of: {', '.join(LANES)})")
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.min_p = min_p
+        self.eos_token_id = eos_token_id
+        self.speculative = speculative
+        self.lane = lane
+        # Alternatives to report per generated token; None skips the log-softmax entirely
+        self.logprobs = logprobs
+        self.token_logprobs = []  # (logprob of the chosen token, [(token_id, logprob), ...] top alternatives)
+        # A seed fixes the sampling noise, so the same request draws the same tokens whatever it is batched with
+        self.seed = seed
+        self.drafted = 0
+        self.draft_accepted = 0
+        self.output_ids = []
+        self.finish_reason = None
+        self.error = None
+        self.cancelled = False
+        self.submitted_at = time.monotonic()  # monotonic: only differences between these timestamps mean anything
+        self.admitted_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self.timings = {}  # seconds per phase: 'prefill' from the scheduler, 'tokenize' etc. from the caller
+        self.trace = None  # (tracer, pid, tid) when this request was sampled for tracing
+        self._cond = threading.Condition()
+
+    @property
+    def done(self):
+        return self.finish_reason is not None or self.error is not None
+
+    @property
+    def greedy(self):
+        return self.temperature is None or self.temperature <= 0
+
+    def cancel(self):
+        """Ask the scheduler to drop this request at the next decode step"""
+        self.cancelled = True
+
+    def _append(self, token_id):
+        with self._cond:
+            if self.first_token_at is None:
+                self.first_token_at = time.monotonic()
+            self.output_ids.append(token_id)
+            self._cond.notify_all()
+
+    def _finish(self, reason=None, error=None):
+        with self._cond:
+            self.finish_reason = reason
+            self.error = error
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+        if self.trace is not None:
+            if self.first_token_at is not None:
+                self.trace_span('decode', self.first_token_at, self.finished_at, tokens=len(self.output_ids))
+            self.trace_instant('complete', self.finished_at, reason=reason,
+                               error=str(error) if error is not None else None)
+
+    def trace_span(self, name, start, end, **args):
+        """Record a span on this request's trace track (no-op unless it was sampled)"""
+        if self.trace is not None:
+            tracer, pid, tid = self.trace
+            tracer.span(name, start, end, pid, tid, args)
+
+    def trace_instant(self, name, at, **args):
+        if self.trace is not None:
+            tracer, pid, tid = self.trace
+            tracer.instant(name, at, pid, tid, args)
+
+    def wait(self, timeout=None):
+        """Block until the request finishes and return the generated token IDs"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.done, timeout=timeout):
+                raise TimeoutError('Generation did not finish in time')
+        if self.error is not None:
+            raise self.error
+        return list(self.output_ids)
+
+    def iter_tokens(self):
+        """Yield generated token IDs as the scheduler produces them"""
+        cursor = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self.output_ids) > cursor or self.done)
+                new_tokens = self.output_ids[cursor:]
+                finished = self.done
+            cursor += len(new_tokens)
+            for token_id in new_tokens:
+                yield token_id
+            if finished:
+                break
+        if self.error is not None:
+            raise self.error
+
+
+class _Sequence:
+    """Scheduler-side bookkeeping for one request"""
+
+    _ids = itertools.count()
+
+    def __init__(self, request, history):
+        self.seq_id = next(self._ids)
+        self.request = request
+        self.token_ids = list(request.input_ids)
+        self.history = history  # logits_processors.TokenHistory over token_ids, extended as tokens are appended
+        self.noise_seed = request.seed if request.seed is not None else random.getrandbits(62)
+        self.last_token = None
+        self.preemptions = 0
+
+    def context_ids(self):
+        """Tokens whose KV must be in the cache before the next decode step"""
+        return self.token_ids if self.last_token is None else self.token_ids[:-1]
+
+    def remaining_tokens(self, waiting):
+        """Tokens of work left: the context still to prefill (if waiting) plus the tokens still to generate"""
+        remaining = self.request.max_new_tokens - len(self.request.output_ids)
+        return remaining + (len(self.context_ids()) if waiting else 0)
+
+
+class BatchScheduler:
+    """Iteration-level batching over a HF causal LM.
+
+    KV for every sequence lives in a PagedKVCache: prefill writes a
+    sequence's blocks, each decode step gathers the active sequences into a
+    left-padded batch, runs one forward pass and appends the new position.
+    When the pool runs out mid-decode the newest sequence is preempted -
+    its blocks are freed and it is requeued to be recomputed later - so a
+    full pool slows admission instead of ending in an OOM.
+
+    With a `draft` (speculative.DraftModel) attached, requests that ask for
+    speculative decoding are advanced several tokens per step while no more
+    than `draft.max_batch_size` of them are running; past that, plain
+    batching already keeps the GPU busy and they decode one token at a time.
+
+    Requests wait in one of two lanes. `queue_depth` caps how many may wait
+    per lane and `token_budget` caps the prompt + generation tokens
+    outstanding across everything queued or running; the batch lane only
+    gets `batch_token_share` of that budget, so interactive requests always
+    find room. submit() raises QueueFull with a Retry-After estimate from
+    recent throughput instead of letting work pile up without bound.
+
+    With a `tracer` (tracing.Tracer) attached, every decode step and
+    prefill is recorded on the model's scheduler track while a capture is
+    running, and sampled requests get their own track from enqueue to
+    completion.
+    """
+
+    def __init__(self, model, max_batch_size=16, repetition_penalty=1.1, no_repeat_ngram_size=3,
+                 prefix_cache=None, kv_cache=None, draft=None, queue_depth=None, token_budget=None,
+                 batch_token_share=0.5, tracer=None, trace_name='model'):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.draft = draft
+        self.repetition_penalty = repetition_penalty
+        self.no_repeat_ngram_size = no_repeat_ngram_size
+        self.input_device = model.get_input_embeddings().weight.device
+
+        if kv_cache is None:
+            kv_cache = PagedKVCache(num_blocks=max_batch_size * 256)
+            kv_cache.preallocate(model)
+        self.kv_cache = kv_cache
+        if draft is not None:
+            draft.vocab_limit = model.config.vocab_size
+
+        self.queue_depth = dict(queue_depth or {})
+        self.token_budget = token_budget
+        self.batch_token_share = batch_token_share
+        self._waiting = {lane: deque() for lane in LANES}
+        self._wait_times = {lane: deque(maxlen=1024) for lane in LANES}
+        self._rejected = {lane: 0 for lane in LANES}
+        self._throughput = None  # tokens/s, exponentially averaged over decode steps
+        self._active = []
+        self.tracer = tracer
+        self._trace_pid = tracer.process(trace_name) if tracer is not None else None
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+        self._repetition = RepetitionControls(repetition_penalty, no_repeat_ngram_size)
+
+        self.steps = 0
+        self.tokens_generated = 0
+        self.requests_completed = 0
+        self.requests_failed = 0
+        self.batch_size_total = 0
+        self.max_batch_seen = 0
+        self.preemptions = 0
+        # Scraped by /metrics; one observation each per decode step
+        self.batch_sizes = Histogram(BATCH_BUCKETS)
+        self.step_seconds = Histogram()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, reason='Scheduler stopped'):
+        """Stop the worker, fail everything still queued or running and release the KV pool"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        error = RuntimeError(reason)
+        with self._cond:
+            pending = list(self._queued())
+            for lane in LANES:
+                self._waiting[lane].clear()
+        for seq in pending:
+            seq.request._finish(error=error)
+        self._fail_active(error)
+        self.kv_cache.pools = None
+        if self.draft is not None:
+            self.draft.kv_cache.pools = None
+
+    def submit(self, request):
+        """Queue a request in its lane, or raise QueueFull if admission control turns it away"""
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError('Scheduler is not running')
+            seq = _Sequence(request, self._repetition.history())
+            try:
+                self._check_admission(seq)
+            except QueueFull:
+                self._rejected[request.lane] += 1
+                raise
+            self._waiting[request.lane].append(seq)
+            self._cond.notify_all()
+        if self.tracer is not None and self.tracer.active:
+            tid = self.tracer.sample(self._trace_pid, f'request {seq.seq_id} ({request.lane})')
+            if tid is not None:
+                request.trace = (self.tracer, self._trace_pid, tid)
+                request.trace_instant('enqueue', request.submitted_at, prompt_tokens=len(request.input_ids),
+                                      max_new_tokens=request.max_new_tokens)
+        return request
+
+    def _queued(self):
+        """Waiting sequences in admission order"""
+        return itertools.chain.from_iterable(self._waiting[lane] for lane in LANES)
+
+    def outstanding_tokens(self):
+        """Prompt + generation tokens still to be processed for everything queued or running"""
+        waiting = sum(seq.remaining_tokens(True) for seq in self._queued())
+        return waiting + sum(seq.remaining_tokens(False) for seq in list(self._active))
+
+    def _retry_after(self, excess_tokens):
+        """Seconds until roughly excess_tokens of queued work has drained, as a Retry-After hint"""
+        rate = self._throughput or 0
+        if rate <= 0:
+            return 1
+        return int(min(60, max(1, math.ceil(excess_tokens / rate))))
+
+    def _check_admission(self, seq):
+        lane = seq.request.lane
+        waiting = self._waiting[lane]
+        depth = self.queue_depth.get(lane)
+        if depth is not None and len(waiting) >= depth:
+            raise QueueFull(f'The {lane} queue is full ({depth} requests waiting)', lane,
+                            self._retry_after(waiting[0].remaining_tokens(True)))
+        if not self.token_budget:
+            return
+        limit = self.token_budget * (self.batch_token_share if lane == 'batch' else 1.0)
+        outstanding = self.outstanding_tokens()
+        cost = seq.remaining_tokens(True)
+        # A request bigger than the whole budget still runs once nothing else is outstanding
+        if outstanding and outstanding + cost > limit:
+            raise QueueFull(f'{outstanding} tokens are already queued or running ({lane} budget {int(limit)})', lane,
+                            self._retry_after(outstanding + cost - limit))
+
+    def queue_stats(self):
+        with self._cond:
+            depths = {lane: len(self._waiting[lane]) for lane in LANES}
+            outstanding = self.outstanding_tokens()
+        lanes = {}
+        for lane in LANES:
+            waits = list(self._wait_times[lane])
+            lanes[lane] = {
+                'depth': depths[lane],
+                'max_depth': self.queue_depth.get(lane),
+                'rejected': self._rejected[lane],
+                'wait_p50_ms': round(percentile(waits, 0.5) * 1000, 1),
+                'wait_p90_ms': round(percentile(waits, 0.9) * 1000, 1),
+                'wait_p99_ms': round(percentile(waits, 0.99) * 1000, 1),
+            }
+        return {
+            'lanes': lanes,
+            'outstanding_tokens': outstanding,
+            'token_budget': self.token_budget,
+            'throughput_tokens_per_s': round(self._throughput or 0, 1),
+        }
+
+    def stats(self):
+        with self._cond:
+            waiting = sum(len(self._waiting[lane]) for lane in LANES)
+        return {
+            'active': len(self._active),
+            'waiting': waiting,
+            'max_batch_size': self.max_batch_size,
+            'steps': self.steps,
+            'tokens_generated': self.tokens_generated,
+            'requests_completed': self.requests_completed,
+            'requests_failed': self.requests_failed,
+            'avg_batch_size': round(self.batch_size_total / self.steps, 2) if self.steps else 0,
+            'max_batch_seen': self.max_batch_seen,
+            'preemptions': self.preemptions,
+            'kv_cache': self.kv_cache.stats(),
+            'prefix_cache': self.prefix_cache.stats() if self.prefix_cache is not None else None,
+            'speculative': self.draft.stats() if self.draft is not None else None,
+            'queue': self.queue_stats(),
+        }
+
+    # ------------------------------------------------------------------
+    # Worker loop
+    # ------------------------------------------------------------------
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping and not any(self._waiting.values()) and not self._active:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                admitted = self._admit()
+
+            for seq in admitted:
+                try:
+                    with torch.no_grad():
+                        self._prefill(seq)
+                except Exception as e:
+                    print(f"❌ Prefill failed: {e}")
+                    traceback.print_exc()
+                    self._release(seq)
+                    self.requests_failed += 1
+                    seq.request._finish(error=e)
+
+            if not self._active:
+                if not admitted:
+                    # Head of the queue is waiting for blocks held by nobody - should not happen
+                    time.sleep(0.01)
+                continue
+            try:
+                start, tokens, batch_size = time.monotonic(), self.tokens_generated, len(self._active)
+                with torch.no_grad():
+                    self._decode_step()
+                elapsed = time.monotonic() - start
+                self.step_seconds.observe(elapsed)
+                if self.tracer is not None and self.tracer.active:
+                    self.tracer.span('decode step', start, start + elapsed, self._trace_pid, SCHEDULER_TID,
+                                     {'batch_size': batch_size, 'tokens': self.tokens_generated - tokens})
+                rate = (self.tokens_generated - tokens) / max(elapsed, 1e-6)
+                self._throughput = rate if self._throughput is None else 0.8 * self._throughput + 0.2 * rate
+            except Exception as e:
+                print(f"❌ Decode step failed: {e}")
+                traceback.print_exc()
+                self._fail_active(e)
+
+    def _admit(self):
+        """Pop waiting sequences, interactive lane first, while there is batch room and KV blocks for their context"""
+        admitted = []
+        while len(self._active) + len(admitted) < self.max_batch_size:
+            lane = next((lane for lane in LANES if self._waiting[lane]), None)
+            if lane is None:
+                break
+            waiting = self._waiting[lane]
+            seq = waiting[0]
+            if seq.request.cancelled:
+                waiting.popleft()
+                seq.request._finish('cancelled')
+                continue
+            needed = len(seq.context_ids()) + 1
+            if not self.kv_cache.fits_at_all(needed):
+                waiting.popleft()
+                self.requests_failed += 1
+                seq.request._finish(error=RuntimeError(
+                    f'Sequence needs {needed} tokens of KV cache but the pool only holds '
+                    f'{self.kv_cache.num_blocks * self.kv_cache.block_size}'))
+                continue
+            if not self.kv_cache.reserve(seq.seq_id, needed):
+                self.kv_cache.free(seq.seq_id)
+                break
+            admitted.append(waiting.popleft())
+            request = seq.request
+            if request.admitted_at is None:
+                request.admitted_at = time.monotonic()
+                self._wait_times[lane].append(request.admitted_at - request.submitted_at)
+                request.trace_span('queued', request.submitted_at, request.admitted_at)
+            request.trace_instant('batch join', time.monotonic(), batch_size=len(self._active) + len(admitted),
+                                  preemptions=seq.preemptions)
+        return admitted
+
+    def _fail_active(self, error):
+        active, self._active = self._active, []
+        for seq in active:
+            self._release(seq)
+            self.requests_failed += 1
+            seq.request._finish(error=error)
+
+    def _release(self, seq):
+        """Free a sequence's KV blocks, and its draft blocks when speculating"""
+        self.kv_cache.free(seq.seq_id)
+        if self.draft is not None:
+            self.draft.release(seq.seq_id)
+
+    def _preempt(self, seq):
+        """Give a sequence's blocks back and requeue it; its KV is recomputed on readmission"""
+        self._release(seq)
+        seq.preemptions += 1
+        self.preemptions += 1
+        seq.request.trace_instant('preempted', time.monotonic())
+        with self._cond:
+            self._waiting[seq.request.lane].appendleft(seq)
+
+    def _prefill(self, seq):
+        start = time.monotonic()
+        context = seq.context_ids()
+        fresh = seq.last_token is None
+
+        # Reuse cached KV for a shared prefix; keep at least one token to produce logits
+        matched, past = 0, None
+        if self.prefix_cache is not None:
+            matched, past = self.prefix_cache.match(context[:-1])
+
+        input_ids = torch.tensor([context[matched:]], device=self.input_device)
+        if past is not None:
+            outputs = self.model(input_ids=input_ids, past_key_values=tensors_to_cache(past), use_cache=True)
+        else:
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+        kv = cache_to_tensors(outputs.past_key_values)
+        if self.prefix_cache is not None and fresh:
+            self.prefix_cache.insert(context, kv)
+        self.kv_cache.write(seq.seq_id, kv)
+
+        token = self._sample([seq], outputs.logits[:, -1, :].float())[0] if fresh else None
+        # Recomputation after a preemption counts towards the same request's prefill time
+        end = time.monotonic()
+        timings = seq.request.timings
+        timings['prefill'] = timings.get('prefill', 0.0) + end - start
+        if self.tracer is not None and self.tracer.active:
+            name = 'prefill' if fresh else 'recompute'
+            args = {'tokens': len(context), 'cached_prefix': matched}
+            self.tracer.span(name, start, end, self._trace_pid, SCHEDULER_TID, dict(args, seq_id=seq.seq_id))
+            seq.request.trace_span(name, start, end, **args)
+        if fresh and self._append_token(seq, token):
+            self._release(seq)
+            return
+        self._active.append(seq)
+
+    def _decode_step(self):
+        # Every sequence needs room for one more position; preempt the newest until that holds
+        index = 0
+        while index < len(self._active):
+            seq = self._active[index]
+            if self.kv_cache.reserve(seq.seq_id, self.kv_cache.lengths[seq.seq_id] + 1):
+                index += 1
+            else:
+                self._preempt(self._active.pop())
+        if not self._active:
+            return
+
+        batch = self._active
+        plain, speculative, num_tokens = batch, [], 0
+        if self.draft is not None:
+            plain, speculative, num_tokens = self._split_speculative(batch)
+
+        finished = set()
+        if plain:
+            finished.update(self._decode_batch(plain))
+        if speculative:
+            finished.update(self._speculative_step(speculative, num_tokens))
+        self.steps += 1
+        self.batch_sizes.observe(len(batch))
+        self.batch_size_total += len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        self._active = [seq for seq in batch if seq.seq_id not in finished]
+
+    def _decode_batch(self, batch):
+        """One token for every sequence in batch; returns the IDs of those that finished"""
+        seq_ids = [seq.seq_id for seq in batch]
+        positions = [self.kv_cache.lengths[seq_id] for seq_id in seq_ids]
+        # The model reads and writes the paged pool directly; no copy of the batch's cache is built
+        past, attention_mask = self.kv_cache.view(seq_ids, 1, self.input_device)
+
+        input_ids = torch.tensor([[seq.last_token] for seq in batch], device=self.input_device)
+        position_ids = torch.tensor([[position] for position in positions], device=self.input_device)
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past,
+            use_cache=True,
+        )
+        past.commit(outputs.past_key_values)
+
+        tokens = self._sample(batch, outputs.logits[:, -1, :].float())
+        finished = []
+        for seq, token in zip(batch, tokens):
+            if self._append_token(seq, token):
+                self._release(seq)
+                finished.append(seq.seq_id)
+        return finished
+
+    def _split_speculative(self, batch):
+        """(plain, speculative, k): which sequences draft this step, and how many tokens each"""
+        # Verification only scores drafted positions, so requests that want logprobs decode one token at a time;
+        # seeded sampling does too, since acceptance would draw randomness that is not derived from the seed
+        wanted = [seq for seq in batch if seq.request.speculative and seq.request.logprobs is None
+                  and (seq.request.greedy or seq.request.seed is None)]
+        if not wanted or len(wanted) > self.draft.max_batch_size:
+            return batch, [], 0
+        # Never draft past max_new_tokens: a step emits up to k accepted tokens plus one from the target
+        remaining = min(seq.request.max_new_tokens - len(seq.request.output_ids) for seq in wanted)
+        num_tokens = min(self.draft.num_tokens, remaining - 1)
+        if num_tokens < 1:
+            return batch, [], 0
+        speculative = []
+        for seq in wanted:
+            length = self.kv_cache.lengths[seq.seq_id]
+            if (self.kv_cache.reserve(seq.seq_id, length + num_tokens + 1)
+                    and self.draft.reserve(seq, length, num_tokens)):
+                speculative.append(seq)
+        plain = [seq for seq in batch if seq not in speculative]
+        return plain, speculative, num_tokens
+
+    def _speculative_step(self, batch, num_tokens):
+        """Draft num_tokens per sequence, verify them in one target pass and keep the agreeing prefix"""
+        drafts, draft_probs = self.draft.propose(batch, num_tokens, self._warp)
+
+        start = time.monotonic()
+        seq_ids = [seq.seq_id for seq in batch]
+        lengths = [self.kv_cache.lengths[seq_id] for seq_id in seq_ids]
+        width = num_tokens + 1
+        past, attention_mask = self.kv_cache.view(seq_ids, width, self.input_device)
+        input_ids = torch.tensor([[seq.last_token] + tokens for seq, tokens in zip(batch, drafts)],
+                                 device=self.input_device)
+        position_ids = torch.tensor([list(range(length, length + width)) for length in lengths],
+                                    device=self.input_device)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past,
+            use_cache=True,
+        )
+        past.commit(outputs.past_key_values)
+        logits = outputs.logits[:, -width:, :].float()
+
+        finished = []
+        for row, (seq, length) in enumerate(zip(batch, lengths)):
+            request = seq.request
+            history = list(seq.token_ids)
+            emitted = []
+            for j, token in enumerate(drafts[row]):
+                scores = self._warp(seq, history, logits[row, j:j + 1])
+                accepted, replacement = self.draft.verify(token, draft_probs[row][j], scores, request.greedy)
+                if not accepted:
+                    emitted.append(replacement)
+                    break
+                emitted.append(token)
+                history.append(token)
+            else:
+                # Every draft was accepted; the target's last position yields one more token for free
+                emitted.append(self._pick(request, self._warp(seq, history, logits[row, num_tokens:])))
+
+            accepted_count = len(emitted) - 1
+            request.drafted += num_tokens
+            request.draft_accepted += accepted_count
+            self.draft.record(num_tokens, accepted_count, len(emitted))
+            # KV now holds last_token plus the accepted drafts; the final token is fed next step
+            self.kv_cache.truncate(seq.seq_id, length + accepted_count + 1)
+            self.draft.kv_cache.truncate(seq.seq_id, length + accepted_count + 1)
+            for token in emitted:
+                if self._append_token(seq, token):
+                    self._release(seq)
+                    finished.append(seq.seq_id)
+                    break
+        self.draft.rounds += 1
+        self.draft.verify_seconds += time.monotonic() - start
+        return finished
+
+    def _append_token(self, seq, token):
+        """Record a sampled token; returns True when the sequence is finished"""
+        request = seq.request
+        seq.token_ids.append(token)
+        seq.last_token = token
+        request._append(token)
+        self.tokens_generated += 1
+
+        reason = None
+        if request.cancelled:
+            reason = 'cancelled'
+        elif request.eos_token_id is not None and token == request.eos_token_id:
+            reason = 'stop'
+        elif len(request.output_ids) >= request.max_new_tokens:
+            reason = 'length'
+        if reason is None:
+            return False
+        self.requests_completed += 1
+        request._finish(reason)
+        return True
+
+    def _penalize(self, batch, token_lists, scores):
+        """Repetition controls for `[len(batch), vocab]` scores; token_lists[i] extends batch[i].token_ids"""
+        if not self._repetition.enabled:
+            return scores
+        for seq in batch:
+            seq.history.update(seq.token_ids)
+        return self._repetition([seq.history for seq in batch], token_lists, scores)
+
+    @staticmethod
+    def _sampling_params(batch, device):
+        """Per-row sampling tensors; the position makes every step's noise different"""
+        return row_params([(seq.request.temperature, seq.request.top_p, seq.request.top_k, seq.request.min_p,
+                            seq.noise_seed, len(seq.token_ids)) for seq in batch], device)
+
+    def _warp(self, seq, token_ids, scores):
+        """Repetition controls, then temperature/top-k/top-p/min-p for sampled requests, on one `[1, vocab]` row"""
+        scores = self._penalize([seq], [token_ids], scores)
+        if seq.request.greedy:
+            return scores
+        return warp(scores, **self._sampling_params([seq], scores.device))
+
+    def _pick(self, request, scores):
+        """Token from one warped row (speculative decoding only; seeded requests never get here)"""
+        if request.greedy:
+            return int(scores.argmax(dim=-1))
+        probs = torch.softmax(scores, dim=-1)
+        return int(torch.multinomial(probs, num_samples=1))
+
+    def _sample(self, batch, logits):
+        """Repetition controls, then every row's own sampling settings, in one pass over the batch"""
+        scores = self._penalize(batch, [seq.token_ids for seq in batch], logits)
+        tokens = sample(scores, self._sampling_params(batch, scores.device)).tolist()
+        for row, (seq, token) in enumerate(zip(batch, tokens)):
+            if seq.request.logprobs is not None:
+                self._record_logprobs(seq.request, logits[row], token)
+        return tokens
+
+    def _record_logprobs(self, request, logits, token):
+        """Log-probability of the chosen token under the model's raw distribution, plus the top alternatives"""
+        logprobs = torch.log_softmax(logits, dim=-1)
+        top = []
+        if request.logprobs > 0:
+            values, ids = logprobs.topk(min(request.logprobs, logprobs.shape[-1]))
+            top = list(zip(ids.tolist(), values.tolist()))
+        request.token_logprobs.append((float(logprobs[token]), top))
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Model Load-Time Benchmark
+- Writes a dummy Llama-style checkpoint (random weights, sharded safetensors)
+- Times from_pretrained(low_cpu_mem_usage=True) against fast_loader
+- Checks both paths produce identical weights
+
+Point --output-dir at the filesystem you care about (e.g. the NFS cache
+directory) - the OS page cache makes repeat runs faster than a cold load,
+so the first repeat of each loader is reported separately.
+"""
+
+import argparse
+import gc
+import os
+import shutil
+import time
+
+import torch
+from transformers import AutoModelForCausalLM, LlamaConfig
+
+from fast_loader import DEFAULT_WORKERS, load_safetensors_model
+
+DTYPES = {'float16': torch.float16, 'bfloat16': torch.bfloat16, 'float32': torch.float32}
+
+
+def make_checkpoint(path, hidden_size, layers, shard_size):
+    """Save a randomly initialised Llama model with the given width and depth"""
+    config = LlamaConfig(
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 8 // 3 // 256 * 256 or 256,
+        num_hidden_layers=layers,
+        num_attention_heads=max(1, hidden_size // 128),
+        num_key_value_heads=max(1, hidden_size // 512),
+        vocab_size=32000,
+    )
+    model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.float16)
+    model.save_pretrained(path, max_shard_size=shard_size, safe_serialization=True)
+    num_params = sum(p.numel() for p in model.parameters())
+    del model
+    gc.collect()
+    return num_params
+
+
+def release(model):
+    del model
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.empty_cache()
+
+
+def time_load(load):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    model = load()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return model, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare model load paths on a dummy checkpoint')
+    parser.add_argument('--output-dir', default=os.path.join(os.environ.get('TMPDIR', '/tmp'), 'lmstudio_loader_bench'))
+    parser.add_argument('--hidden-size', type=int, default=2048)
+    parser.add_argument('--layers', type=int, default=16)
+    parser.add_argument('--shard-size', default='500MB')
+    parser.add_argument('--dtype', choices=list(DTYPES), default='float16')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--keep', action='store_true', help='Keep the dummy checkpoint afterwards')
+    args = parser.parse_args()
+
+    dtype = DTYPES[args.dtype]
+    device_map = 'auto' if torch.cuda.is_available() else None
+
+    print("=" * 60)
+    print("Model Load-Time Benchmark")
+    print("=" * 60)
+    if not os.path.exists(os.path.join(args.output_dir, 'config.json')):
+        print(f"Writing dummy checkpoint to {args.output_dir}...")
+        num_params = make_checkpoint(args.output_dir, args.hidden_size, args.layers, args.shard_size)
+        print(f"   Parameters: {num_params:,}")
+    shards = [f for f in os.listdir(args.output_dir) if f.endswith('.safetensors')]
+    size_gb = sum(os.path.getsize(os.path.join(args.output_dir, f)) for f in shards) / 1e9
+    print(f"Checkpoint: {len(shards)} shards, {size_gb:.2f}GB")
+    print(f"Device: {'cuda x%d' % torch.cuda.device_count() if torch.cuda.is_available() else 'cpu'}, dtype: {args.dtype}")
+    print()
+
+    loaders = {
+        'from_pretrained': lambda: AutoModelForCausalLM.from_pretrained(
+            args.output_dir, torch_dtype=dtype, device_map=device_map, low_cpu_mem_usage=True
+        ),
+        f'fast_loader ({args.workers} workers)': lambda: load_safetensors_model(
+            args.output_dir, dtype=dtype, num_workers=args.workers
+        ),
+    }
+
+    results = {name: [] for name in loaders}
+    for repeat in range(args.repeats):
+        for name, load in loaders.items():
+            model, seconds = time_load(load)
+            results[name].append(seconds)
+            print(f"[{repeat + 1}/{args.repeats}] {name:<28} {seconds:7.2f}s  {size_gb / seconds:6.2f}GB/s")
+            release(model)
+
+    # Same weights either way
+    reference = loaders['from_pretrained']().state_dict()
+    candidate = list(loaders.values())[1]().state_dict()
+    identical = set(reference) == set(candidate) and all(
+        torch.equal(reference[k].cpu(), candidate[k].cpu()) for k in reference
+    )
+
+    print()
+    print(f"{'loader':<28} {'first':>8} {'best':>8} {'GB/s':>8}")
+    for name, times in results.items():
+        print(f"{name:<28} {times[0]:7.2f}s {min(times):7.2f}s {size_gb / min(times):8.2f}")
+    baseline, fast = (min(times) for times in results.values())
+    print(f"\nSpeedup: {baseline / fast:.2f}x")
+    print(f"Weights identical: {'✅' if identical else '❌'}")
+
+    if not args.keep:
+        shutil.rmtree(args.output_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Server Load Generator
+- Drives /generate or /generate_stream at a fixed concurrency (closed loop) or a Poisson arrival rate (open loop)
+- Reports throughput, latency / TTFT / TPOT percentiles and error rates as JSON
+- --baseline compares against an earlier report, for regressions between server versions
+
+Pair it with the stub backend to measure server overhead without a GPU:
+    LMSTUDIO_STUB_TOKEN_MS=20 python lm_studio_server_v3_improved.py
+    python benchmark_server.py --load stub --concurrency 16 --requests 200
+"""
+
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+
+def percentiles(values):
+    """p50 / p90 / p99 / mean / max in milliseconds, or None when there are no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def rank(fraction):
+        return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+    return {
+        'p50_ms': round(rank(0.5) * 1000, 2),
+        'p90_ms': round(rank(0.9) * 1000, 2),
+        'p99_ms': round(rank(0.99) * 1000, 2),
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 2),
+        'max_ms': round(ordered[-1] * 1000, 2),
+    }
+
+
+def post_json(url, payload, timeout):
+    body = json.dumps(payload).encode()
+    req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    return urllib.request.urlopen(req, timeout=timeout)
+
+
+def load_model(server, model_name, timeout=600):
+    """Ask the server to load model_name and wait for its load job"""
+    with post_json(f'{server}/load_model', {'model_name': model_name}, 30) as response:
+        job = json.load(response)
+    if not job.get('job_id'):
+        raise RuntimeError(f"Load of {model_name} was refused: {job.get('error')}")
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with urllib.request.urlopen(f"{server}/load_status/{job['job_id']}", timeout=30) as response:
+            status = json.load(response)
+        if status['done']:
+            if status['phase'] != 'ready':
+                raise RuntimeError(f"Load of {model_name} failed: {status.get('error')}")
+            return status
+        time.sleep(0.5)
+    raise RuntimeError(f'Load of {model_name} did not finish within {timeout}s')
+
+
+def one_request(server, endpoint, payload, timeout):
+    """Send one generation request; returns a result dict with client-side timings in seconds"""
+    result = {'ok': False, 'status': None, 'error': None, 'latency': None, 'ttft': None, 'tpot': None, 'tokens': 0}
+    start = time.monotonic()
+    try:
+        with post_json(server + endpoint, payload, timeout) as response:
+            result['status'] = response.status
+            if endpoint.endswith('_stream') and response.headers.get('Content-Type', '').startswith('text/event-stream'):
+                data = read_stream(response, start, result)
+            else:
+                data = json.load(response)
+                timings = data.get('timings') or {}
+                # Without a stream the client only sees the end; the server's own figures are the best estimate
+                if 'time_to_first_token_ms' in timings:
+                    result['ttft'] = timings['time_to_first_token_ms'] / 1000
+                if 'per_output_token_ms' in timings:
+                    result['tpot'] = timings['per_output_token_ms'] / 1000
+                result['tokens'] = timings.get('output_tokens', 0)
+        result['latency'] = time.monotonic() - start
+        result['ok'] = bool(data.get('success'))
+        if not result['ok']:
+            result['error'] = data.get('error', 'unknown error')
+    except urllib.error.HTTPError as e:
+        result['status'] = e.code
+        result['error'] = f'HTTP {e.code}'
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    return result
+
+
+def read_stream(response, start, result):
+    """Consume server-sent events, timing the first and last text events; returns the final event"""
+    first, last, events, final = None, None, 0, {}
+    for line in response:
+        if not line.startswith(b'data: '):
+            continue
+        data = json.loads(line[6:])
+        if data.get('done'):
+            final = data
+            break
+        now = time.monotonic()
+        first = first if first is not None else now
+        last = now
+        events += 1
+    tokens = final.get('tokens') or events
+    result['tokens'] = tokens
+    if first is not None:
+        result['ttft'] = first - start
+        if tokens > 1:
+            result['tpot'] = (last - first) / (tokens - 1)
+    return final
+
+
+def run(args):
+    payload = {
+        'text': args.prompt,
+        'max_new_tokens': args.max_new_tokens,
+        'temperature': args.temperature,
+        'priority': args.priority,
+    }
+    if args.model:
+        payload['model'] = args.model
+    results = []
+    lock = threading.Lock()
+
+    def send():
+        result = one_request(args.server, args.endpoint, payload, args.timeout)
+        with lock:
+            results.append(result)
+            done = len(results)
+        if not args.quiet and done % max(1, args.requests // 10) == 0:
+            print(f"   {done}/{args.requests} requests finished", file=sys.stderr)
+
+    start = time.monotonic()
+    if args.rate:
+        # Open loop: arrivals follow a Poisson process regardless of how fast the server answers
+        rng = random.Random(args.seed)
+        threads = []
+        next_at = start
+        for _ in range(args.requests):
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            thread = threading.Thread(target=send, daemon=True)
+            thread.start()
+            threads.append(thread)
+            next_at += rng.expovariate(args.rate)
+        for thread in threads:
+            thread.join()
+    else:
+        # Closed loop: each worker sends its next request as soon as the previous one returns
+        counter = iter(range(args.requests))
+        counter_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with counter_lock:
+                    if next(counter, None) is None:
+                        return
+                send()
+
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    duration = time.monotonic() - start
+    return summarize(args, results, duration)
+
+
+def summarize(args, results, duration):
+    ok = [r for r in results if r['ok']]
+    rejected = [r for r in results if r['status'] in (429, 503)]
+    errors = {}
+    for r in results:
+        if not r['ok']:
+            errors[r['error']] = errors.get(r['error'], 0) + 1
+    tokens = sum(r['tokens'] for r in ok)
+    return {
+        'config': {
+            'server': args.server,
+            'endpoint': args.endpoint,
+            'mode': f'open loop at {args.rate} req/s' if args.rate else f'closed loop x{args.concurrency}',
+            'requests': args.requests,
+            'max_new_tokens': args.max_new_tokens,
+            'prompt_chars': len(args.prompt),
+            'priority': args.priority,
+        },
+        'duration_seconds': round(duration, 3),
+        'completed': len(ok),
+        'failed': len(results) - len(ok),
+        'rejected': len(rejected),
+        'error_rate': round((len(results) - len(ok)) / len(results), 4) if results else 0,
+        'errors': errors,
+        'requests_per_second': round(len(ok) / duration, 3) if duration else 0,
+        'output_tokens_per_second': round(tokens / duration, 1) if duration else 0,
+        'latency': percentiles([r['latency'] for r in ok]),
+        'ttft': percentiles([r['ttft'] for r in ok if r['ttft'] is not None]),
+        'tpot': percentiles([r['tpot'] for r in ok if r['tpot'] is not None]),
+    }
+
+
+def compare(report, baseline):
+    """Relative change of the headline figures against an earlier report"""
+    rows = [('requests_per_second',), ('output_tokens_per_second',), ('error_rate',)]
+    rows += [(section, 'p50_ms') for section in ('latency', 'ttft', 'tpot')]
+    rows += [(section, 'p99_ms') for section in ('latency', 'ttft', 'tpot')]
+    changes = {}
+    for path in rows:
+        new, old = report, baseline
+        for key in path:
+            new = new.get(key) if isinstance(new, dict) else None
+            old = old.get(key) if isinstance(old, dict) else None
+        if new is None or old is None:
+            continue
+        change = round((new - old) / old * 100, 1) if old else None
+        changes['.'.join(path)] = {'baseline': old, 'current': new, 'change_percent': change}
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the LM Studio generation endpoints')
+    parser.add_argument('--server', default='http://localhost:8080')
+    parser.add_argument('--endpoint', default='/generate', choices=['/generate', '/generate_stream'])
+    parser.add_argument('--load', metavar='MODEL', help="Load this model first (e.g. 'stub')")
+    parser.add_argument('--model', help='Model field sent with each request (default: the server default)')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8, help='Closed-loop workers (ignored with --rate)')
+    parser.add_argument('--rate', type=float, help='Open-loop arrival rate in requests/s')
+    parser.add_argument('--prompt', default='Explain how continuous batching works in an inference server.')
+    parser.add_argument('--max-new-tokens', type=int, default=64)
+    parser.add_argument('--temperature', type=float, default=0.8)
+    parser.add_argument('--priority', default='interactive', choices=['interactive', 'batch'])
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--seed', type=int, default=0, help='Seed for open-loop arrival times')
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--baseline', help='Earlier JSON report to compare against')
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args()
+    args.server = args.server.rstrip('/')
+
+    if args.load:
+        print(f"Loading {args.load}...", file=sys.stderr)
+        load_model(args.server, args.load)
+        print(f"✅ {args.load} ready", file=sys.stderr)
+
+    report = run(args)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['comparison'] = compare(report, json.load(f))
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+        print(f"✅ Report written to {args.output}", file=sys.stderr)
+    else:
+        print(text)
+    if not args.quiet:
+        print(f"{report['completed']}/{args.requests} ok, {report['requests_per_second']} req/s, "
+              f"{report['output_tokens_per_second']} tok/s, error rate {report['error_rate'] * 100:.1f}%",
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Parallel Safetensors Loader for LM Studio Server v3
+- Builds the model skeleton on the meta device (no CPU copy of the weights)
+- Memory-maps every shard and reads them from a thread pool
+- Casts each tensor and copies it straight to the device it was placed on
+"""
+
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import torch
+from accelerate import dispatch_model, infer_auto_device_map, init_empty_weights
+from accelerate.utils import get_balanced_memory, set_module_tensor_to_device
+from safetensors import safe_open
+from transformers import AutoConfig, AutoModelForCausalLM
+
+from quantization import DEFAULT_GROUP_SIZE, quantize_model, quantized_layers
+
+DEFAULT_WORKERS = min(16, os.cpu_count() or 4)
+
+
+def safetensors_shards(snapshot):
+    """Shard paths for a snapshot, or [] if it has no complete safetensors checkpoint"""
+    index_path = os.path.join(snapshot, 'model.safetensors.index.json')
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            shards = sorted(set(json.load(f)['weight_map'].values()))
+    elif os.path.exists(os.path.join(snapshot, 'model.safetensors')):
+        shards = ['model.safetensors']
+    else:
+        return []
+    paths = [os.path.join(snapshot, shard) for shard in shards]
+    return paths if all(os.path.exists(p) for p in paths) else []
+
+
+def plan_device_map(model, dtype, max_memory=None):
+    """Same placement as from_pretrained(device_map="auto"), or everything on CPU"""
+    if not torch.cuda.is_available():
+        return {'': 'cpu'}
+    no_split = getattr(model, '_no_split_modules', None) or []
+    if max_memory is None and torch.cuda.device_count() > 1:
+        max_memory = get_balanced_memory(model, dtype=dtype, no_split_module_classes=no_split)
+    return infer_auto_device_map(model, max_memory=max_memory, no_split_module_classes=no_split, dtype=dtype)
+
+
+def _device_for(name, device_map):
+    """Walk up the dotted parameter name until it hits an entry in device_map"""
+    module = name
+    while module:
+        if module in device_map:
+            return device_map[module]
+        module = module.rsplit('.', 1)[0] if '.' in module else ''
+    return device_map.get('', 'cpu')
+
+
+def _read_shard(path, targets, dtype, stream_device, quantized=None):
+    """Read one shard's tensors, cast them (unless dtype is None) and start their copies to the target device.
+
+    Weights of layers in `quantized` ({module name: QuantizedLinear}) are
+    quantized once they reach their device, so only one full-width tensor
+    per reader is ever held there.
+    """
+    stream = torch.cuda.Stream(device=stream_device) if stream_device is not None else None
+    loaded = []
+    with safe_open(path, framework='pt', device='cpu') as f:
+        for key in f.keys():
+            target = targets.get(key)
+            if target is None:
+                continue
+            param_name, device = target
+            tensor = f.get_tensor(key)
+            if dtype is not None and tensor.is_floating_point():
+                tensor = tensor.to(dtype)
+            module_name = param_name[:-len('.weight')] if param_name.endswith('.weight') else None
+            layer = quantized.get(module_name) if quantized and module_name else None
+            if device == 'disk':
+                device = 'cpu'
+            if device != 'cpu':
+                device = f'cuda:{device}' if isinstance(device, int) else device
+                # Pinned host memory lets the copy run on this worker's stream while the next tensor is read
+                with torch.cuda.stream(stream):
+                    tensor = tensor.pin_memory().to(device, non_blocking=True)
+                    if layer is not None:
+                        tensor = layer.quantize(tensor)
+            elif layer is not None:
+                tensor = layer.quantize(tensor)
+            if layer is not None:
+                qweight, scales = tensor
+                loaded.append((module_name + '.qweight', device, qweight))
+                loaded.append((module_name + '.scales', device, scales))
+            else:
+                loaded.append((param_name, device, tensor))
+    if stream is not None:
+        stream.synchronize()
+    return loaded
+
+
+def meta_model(path, dtype=torch.float16, trust_remote_code=True, token=None):
+    """Model skeleton on the meta device - sizes and module names without allocating weights"""
+    config = AutoConfig.from_pretrained(path, trust_remote_code=trust_remote_code, token=token)
+    with init_empty_weights():
+        model = AutoModelForCausalLM.from_config(config, torch_dtype=dtype, trust_remote_code=trust_remote_code)
+    model.tie_weights()
+    return model
+
+
+def load_safetensors_model(snapshot, dtype=torch.float16, device_map=None, num_workers=DEFAULT_WORKERS,
+                           trust_remote_code=True, on_shard=None, quantization=None,
+                           group_size=DEFAULT_GROUP_SIZE):
+    """Load a causal LM from a local safetensors snapshot with a pool of reader threads.
+
+    Raises ValueError if the snapshot has no safetensors shards or they do
+    not cover every parameter, so callers can fall back to from_pretrained.
+    `on_shard(path, num_bytes)` is called as each shard lands. With
+    `quantization` ('int8', 'int4', 'fp8') the decoder's linear layers are
+    quantized as they load; device_map must then come from the quantized
+    skeleton (plan_device_map does that when it is left as None).
+    """
+    shards = safetensors_shards(snapshot)
+    if not shards:
+        raise ValueError(f'No complete safetensors checkpoint in {snapshot}')
+
+    model = meta_model(snapshot, dtype, trust_remote_code=trust_remote_code)
+    if quantization:
+        quantize_model(model, quantization, group_size)
+    quantized = quantized_layers(model)
+    if device_map is None:
+        device_map = plan_device_map(model, dtype)
+
+    # Checkpoint keys may or may not carry the base model prefix (e.g. "transformer.")
+    param_names = set(name for name, _ in model.named_parameters())
+    param_names.update(name for name, _ in model.named_buffers())
+    param_names.update(f'{name}.weight' for name in quantized)
+    prefix = getattr(model, 'base_model_prefix', '')
+    targets = {}
+    for path in shards:
+        with safe_open(path, framework='pt', device='cpu') as f:
+            for key in f.keys():
+                name = key if key in param_names else f'{prefix}.{key}'
+                if name in param_names:
+                    targets[key] = (name, _device_for(name, device_map))
+
+    load_shards(model, shards, targets, dtype, num_workers, quantized, on_shard)
+    return place_model(model, device_map)
+
+
+def load_converted_model(model, files, device_map, num_workers=DEFAULT_WORKERS, on_shard=None):
+    """Fill a meta-device skeleton from shards that already hold its exact tensors (the artifact cache).
+
+    Keys are the model's own state_dict names and tensors keep their stored
+    dtype, so nothing is cast or quantized on the way in.
+    """
+    targets = {}
+    for path in files:
+        with safe_open(path, framework='pt', device='cpu') as f:
+            for key in f.keys():
+                targets[key] = (key, _device_for(key, device_map))
+    load_shards(model, files, targets, None, num_workers, on_shard=on_shard)
+    return place_model(model, device_map)
+
+
+def load_shards(model, shards, targets, dtype, num_workers=DEFAULT_WORKERS, quantized=None, on_shard=None):
+    """Read shards on a thread pool into a meta-device model; targets maps checkpoint key -> (name, device)"""
+    stream_devices = sorted({d for _, d in targets.values() if isinstance(d, int)})
+    assign_lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=max(1, min(num_workers, len(shards)))) as pool:
+        futures = {}
+        for i, path in enumerate(shards):
+            stream_device = stream_devices[i % len(stream_devices)] if stream_devices else None
+            futures[pool.submit(_read_shard, path, targets, dtype, stream_device, quantized)] = path
+        for future in as_completed(futures):
+            loaded = future.result()
+            with assign_lock:
+                for param_name, device, tensor in loaded:
+                    set_module_tensor_to_device(model, param_name, device, value=tensor)
+            if on_shard is not None:
+                on_shard(futures[future], sum(t.numel() * t.element_size() for _, _, t in loaded))
+
+    model.tie_weights()
+    missing = [name for name, p in list(model.named_parameters()) + list(model.named_buffers()) if p.device.type == 'meta']
+    if missing:
+        raise ValueError(f'Checkpoint is missing {len(missing)} weights, e.g. {missing[0]}')
+
+
+def place_model(model, device_map):
+    """Move a loaded model onto device_map and put it in eval mode"""
+    # Non-persistent buffers (rotary tables etc.) were built on CPU; dispatch moves them and adds
+    # the cross-device hooks from_pretrained would have added for a split model
+    devices = set(device_map.values())
+    if len(devices) > 1:
+        dispatch_model(model, device_map=device_map)
+    else:
+        device = devices.pop()
+        model.to(f'cuda:{device}' if isinstance(device, int) else device)
+    model.hf_device_map = device_map
+    model.eval()
+    return model
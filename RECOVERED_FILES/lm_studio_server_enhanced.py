@@ -18,6 +18,11 @@ from flask import Flask, request, jsonify, render_template_string
 from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
 import threading
 import subprocess
+from model_staging import ModelStager, find_snapshot
+import memory_estimator
+from fast_loader import meta_model
+from placement_planner import PlacementError, device_inventory, plan_model
+from telemetry import SystemStats, TelemetrySampler
 
 # Set up environment variables for datalab
 os.environ['HF_HOME'] = '/cluster/tufts/datalab/zwu09/caches/huggingface'
@@ -35,8 +40,12 @@ app = Flask(__name__)
 current_model = None
 current_tokenizer = None
 model_name = None
+current_placement = None
 device = "cuda" if torch.cuda.is_available() else "cpu"
 server_start_time = time.time()
+stager = ModelStager() if os.environ.get('LMSTUDIO_STAGE_MODELS', '1') == '1' else None
+TELEMETRY_INTERVAL = float(os.environ.get('LMSTUDIO_TELEMETRY_INTERVAL', '2.0'))  # seconds between samples
+TELEMETRY_HISTORY_MINUTES = float(os.environ.get('LMSTUDIO_TELEMETRY_HISTORY_MINUTES', '60'))
 
 def get_gpu_memory_info():
     """Get detailed GPU memory information"""
@@ -44,81 +53,57 @@ def get_gpu_memory_info():
         return {"available": False, "total": 0, "used": 0, "free": 0}
     
     try:
-        total_memory = torch.cuda.get_device_properties(0).total_memory
-        allocated_memory = torch.cuda.memory_allocated(0)
-        cached_memory = torch.cuda.memory_reserved(0)
-        free_memory = total_memory - allocated_memory
+        # Totals cover every GPU in the allocation; per-device numbers are under "devices"
+        devices = []
+        for i in range(torch.cuda.device_count()):
+            # The driver's numbers: other processes on the GPU count as used too
+            free_memory, total_memory = torch.cuda.mem_get_info(i)
+            devices.append({
+                "id": i,
+                "total": total_memory / 1e9,  # Convert to GB
+                "used": (total_memory - free_memory) / 1e9,
+                "cached": torch.cuda.memory_reserved(i) / 1e9,
+                "free": free_memory / 1e9
+            })
         
         return {
             "available": True,
-            "total": total_memory / 1e9,  # Convert to GB
-            "used": allocated_memory / 1e9,
-            "cached": cached_memory / 1e9,
-            "free": free_memory / 1e9,
-            "device_name": torch.cuda.get_device_name(0)
+            "total": sum(d["total"] for d in devices),
+            "used": sum(d["used"] for d in devices),
+            "cached": sum(d["cached"] for d in devices),
+            "free": sum(d["free"] for d in devices),
+            "device_name": torch.cuda.get_device_name(0),
+            "device_count": len(devices),
+            "devices": devices
         }
     except Exception as e:
         return {"available": False, "error": str(e)}
 
-def get_system_info():
-    """Get system resource information"""
-    try:
-        cpu_percent = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory()
-        disk = psutil.disk_usage('/cluster/tufts/datalab')
-        
-        return {
-            "cpu_percent": cpu_percent,
-            "memory_total": memory.total / 1e9,
-            "memory_used": memory.used / 1e9,
-            "memory_percent": memory.percent,
-            "disk_total": disk.total / 1e9,
-            "disk_used": disk.used / 1e9,
-            "disk_percent": (disk.used / disk.total) * 100
-        }
-    except Exception as e:
-        return {"error": str(e)}
+# System resource information without blocking: CPU load is measured between calls
+# and the NFS disk figure is refreshed at most once a minute
+get_system_info = SystemStats('/cluster/tufts/datalab')
 
-def estimate_model_memory(model_name):
-    """Estimate memory requirements for different models"""
-    model_sizes = {
-        # Small models (1B parameters or less)
-        "gpt2": {"params": 0.117, "memory_gb": 0.5},
-        "microsoft/DialoGPT-small": {"params": 0.117, "memory_gb": 0.5},
-        "microsoft/DialoGPT-medium": {"params": 0.345, "memory_gb": 1.5},
-        "microsoft/DialoGPT-large": {"params": 0.774, "memory_gb": 3.0},
-        
-        # Medium models (1B-10B parameters)
-        "mistralai/Mistral-7B-Instruct-v0.1": {"params": 7, "memory_gb": 14},
-        "meta-llama/Llama-2-7b-chat-hf": {"params": 7, "memory_gb": 14},
-        "codellama/CodeLlama-7b-Python-hf": {"params": 7, "memory_gb": 14},
-        "meta-llama/Llama-2-13b-chat-hf": {"params": 13, "memory_gb": 26},
-        
-        # Large models (10B+ parameters)
-        "codellama/CodeLlama-34b-Python-hf": {"params": 34, "memory_gb": 68},
-        "meta-llama/Llama-2-70b-chat-hf": {"params": 70, "memory_gb": 140},
-    }
-    
-    # Check for exact match first
-    if model_name in model_sizes:
-        return model_sizes[model_name]
-    
-    # Try to extract size from model name
-    for key, info in model_sizes.items():
-        if any(size in model_name.lower() for size in ["7b", "7b-", "13b", "34b", "70b"]):
-            return info
-    
-    # Default estimate based on common patterns
-    if "7b" in model_name.lower():
-        return {"params": 7, "memory_gb": 14}
-    elif "13b" in model_name.lower():
-        return {"params": 13, "memory_gb": 26}
-    elif "34b" in model_name.lower():
-        return {"params": 34, "memory_gb": 68}
-    elif "70b" in model_name.lower():
-        return {"params": 70, "memory_gb": 140}
-    else:
-        return {"params": "unknown", "memory_gb": "unknown"}
+# /status serves the sampler's latest snapshot, so browser polls never measure anything themselves
+telemetry = TelemetrySampler(
+    {'gpu_memory': get_gpu_memory_info, 'system_info': get_system_info},
+    interval=TELEMETRY_INTERVAL,
+    history_seconds=TELEMETRY_HISTORY_MINUTES * 60
+).start()
+
+def estimate_model_memory(model_name, dtype=None, quantization=None, context_tokens=2048):
+    """Estimate memory requirements from the model's config.json and safetensors headers"""
+    dtype = dtype or ('float16' if device == "cuda" else 'float32')
+    return memory_estimator.estimate_model_memory(
+        model_name, os.environ['HF_HOME'],
+        dtype=dtype, quantization=quantization, context_tokens=context_tokens
+    )
+
+def estimate_max_batch(estimate, gpu_memory, context_tokens):
+    """Concurrent sequences whose KV cache fits next to the weights on the GPU"""
+    if not gpu_memory['available'] or estimate['memory_gb'] == 'unknown':
+        return None
+    kv_budget = (gpu_memory['total'] - estimate['memory_gb'] + estimate['kv_cache_gb']) * 1e9
+    return memory_estimator.max_concurrent_batch(estimate, kv_budget, context_tokens)
 
 # HTML template for the enhanced web interface
 HTML_TEMPLATE = """
@@ -273,7 +258,14 @@ HTML_TEMPLATE = """
                 });
         }
         
+        let estimateTimer = null;
         function estimateModelMemory() {
+            // Wait until typing pauses - each estimate may fetch config.json from the Hub
+            clearTimeout(estimateTimer);
+            estimateTimer = setTimeout(requestEstimate, 600);
+        }
+        
+        function requestEstimate() {
             const modelName = document.getElementById('model-input').value;
             if (!modelName) {
                 document.getElementById('model-estimate').textContent = '';
@@ -290,6 +282,12 @@ HTML_TEMPLATE = """
                 if (data.estimate) {
                     const estimate = data.estimate;
                     let text = `Estimated: ${estimate.params}B parameters, ~${estimate.memory_gb}GB memory`;
+                    if (estimate.weights_gb !== undefined) {
+                        text += ` (weights ${estimate.weights_gb}GB, KV ${estimate.kv_cache_per_token_kb}KB/token)`;
+                    }
+                    if (data.max_batch) {
+                        text += `, up to ${data.max_batch} concurrent 2K-token sequences`;
+                    }
                     if (data.warning) {
                         text += ` ⚠️ ${data.warning}`;
                     }
@@ -445,8 +443,8 @@ def index():
 @app.route('/status')
 def status():
     gpu_info = "Not available"
-    gpu_memory = get_gpu_memory_info()
-    system_info = get_system_info()
+    gpu_memory = telemetry.latest('gpu_memory')
+    system_info = telemetry.latest('system_info')
     
     if torch.cuda.is_available():
         gpu_info = f"GPU {torch.cuda.current_device()}: {torch.cuda.get_device_name()}"
@@ -456,16 +454,34 @@ def status():
         'gpu_info': gpu_info,
         'model_name': model_name,
         'gpu_memory': gpu_memory,
+        'placement': current_placement.stats() if current_placement is not None else None,
         'system_info': system_info,
+        'telemetry': telemetry.stats(),
         'uptime': time.time() - server_start_time
     })
 
+@app.route('/metrics/history')
+def metrics_history():
+    """Sampled CPU / RAM / disk / GPU figures for the last ?minutes=N (default 10) as time series"""
+    try:
+        minutes = float(request.args.get('minutes', 10))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'minutes must be a number'}), 400
+    history = telemetry.history(minutes * 60, prefix=request.args.get('prefix'))
+    return jsonify(dict(history, success=True))
+
 @app.route('/estimate_memory', methods=['POST'])
 def estimate_memory():
     try:
         data = request.get_json()
         model_name = data['model_name']
-        estimate = estimate_model_memory(model_name)
+        context_tokens = int(data.get('context_length', 2048))
+        estimate = estimate_model_memory(
+            model_name,
+            dtype=data.get('dtype'),
+            quantization=data.get('quantization'),
+            context_tokens=context_tokens
+        )
         
         # Check if model will fit in available GPU memory
         gpu_memory = get_gpu_memory_info()
@@ -479,6 +495,7 @@ def estimate_memory():
         
         return jsonify({
             'estimate': estimate,
+            'max_batch': estimate_max_batch(estimate, gpu_memory, context_tokens),
             'warning': warning
         })
         
@@ -487,7 +504,7 @@ def estimate_memory():
 
 @app.route('/load_model', methods=['POST'])
 def load_model():
-    global current_model, current_tokenizer, model_name
+    global current_model, current_tokenizer, model_name, current_placement
     
     try:
         data = request.get_json()
@@ -501,25 +518,51 @@ def load_model():
             if estimate['memory_gb'] > gpu_memory['total']:
                 return jsonify({
                     'success': False,
-                    'error': f'Model requires {estimate["memory_gb"]}GB but GPU only has {gpu_memory["total"]:.1f}GB total memory'
+                    'error': f'Model requires {estimate["memory_gb"]}GB but GPU only has {gpu_memory["total"]:.1f}GB total memory',
+                    'estimate': estimate
                 })
         
-        # Unload previous model to free memory
+        # Unload previous model to free memory (placement below plans against what is then free);
+        # the globals stay defined, so a failed load leaves the server in the unloaded state
         if current_model is not None:
-            del current_model
-            del current_tokenizer
+            current_model = None
+            current_tokenizer = None
+            current_placement = None
             torch.cuda.empty_cache()
             gc.collect()
         
         print(f"Loading model: {model_name}")
         print(f"GPU memory before loading: {get_gpu_memory_info()}")
         
+        # Load from a node-local copy of the cached snapshot when there is one
+        load_path = model_name
+        snapshot = find_snapshot(model_name, os.environ['HF_HOME'])
+        if stager is not None and snapshot and not os.path.isdir(model_name):
+            try:
+                load_path = stager.stage(snapshot) or model_name
+            except Exception as e:
+                print(f"Staging failed, loading from shared cache: {e}")
+        
+        # Balanced layer split across the GPUs, keeping KV headroom on each
+        device_map = "auto" if device == "cuda" else None
+        placement = None
+        if device == "cuda":
+            try:
+                placement = plan_model(meta_model(load_path), torch.float16, device_inventory(), kv_tokens=8192, reserve_bytes=int(2e9))
+                device_map = placement.device_map
+                print(f"Placement: {placement.stats()}")
+            except PlacementError as e:
+                model_name = None
+                return jsonify({'success': False, 'error': str(e), 'estimate': estimate})
+            except Exception as e:
+                print(f"Placement planning failed, using device_map=auto: {e}")
+        
         # Load tokenizer and model
-        current_tokenizer = AutoTokenizer.from_pretrained(model_name)
+        current_tokenizer = AutoTokenizer.from_pretrained(load_path)
         current_model = AutoModelForCausalLM.from_pretrained(
-            model_name,
+            load_path,
             torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-            device_map="auto" if device == "cuda" else None,
+            device_map=device_map,
             low_cpu_mem_usage=True
         )
         
@@ -527,6 +570,8 @@ def load_model():
         if device == "cuda" and not hasattr(current_model, 'hf_device_map'):
             current_model = current_model.to(device)
         
+        current_placement = placement
+        
         # Get model info
         num_params = sum(p.numel() for p in current_model.parameters())
         memory_used = get_gpu_memory_info()['used'] if get_gpu_memory_info()['available'] else 'Unknown'
@@ -539,6 +584,9 @@ def load_model():
             'device': device,
             'parameters': f"{num_params:,}",
             'memory_used': memory_used,
+            'estimate': estimate,
+            'max_batch': estimate_max_batch(estimate, gpu_memory, 2048),
+            'placement': placement.stats() if placement is not None else None,
             'status': 'Loaded successfully'
         })
         
@@ -551,7 +599,7 @@ def load_model():
 
 @app.route('/unload_model', methods=['POST'])
 def unload_model():
-    global current_model, current_tokenizer, model_name
+    global current_model, current_tokenizer, model_name, current_placement
     
     try:
         if current_model is not None:
@@ -563,6 +611,7 @@ def unload_model():
         current_model = None
         current_tokenizer = None
         model_name = None
+        current_placement = None
         
         return jsonify({'success': True})
         
@@ -22,11 +22,11 @@ os.environ['PYTHONWARNINGS'] = 'ignore::UserWarning'
 os.environ['NUMPY_EXPERIMENTAL_ARRAY_FUNCTION'] = '0'
 
 import torch
-import gc
 import psutil
 from flask import Flask, request, jsonify, render_template_string
 import time
 import traceback
+from memory_governor import MemoryGovernor
 
 # Import transformers with error handling for GLIBC issues
 try:
@@ -69,6 +69,8 @@ class ModelState:
         self.model_name = None
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.loading = False
+        # Empties the CUDA cache only when memory is tight, fragmented or a load is waiting
+        self.memory = MemoryGovernor(low_free_bytes=int(MEMORY_BUFFER_GB * 1e9), load_pending=lambda: self.loading)
 
 state = ModelState()
 
@@ -80,18 +82,17 @@ def get_gpu_info():
     try:
         gpu_count = torch.cuda.device_count()
         gpus = []
-        for i in range(gpu_count):
-            props = torch.cuda.get_device_properties(i)
-            allocated = torch.cuda.memory_allocated(i) / 1e9
-            total = props.total_memory / 1e9
-            free = total - allocated
+        for i, device in enumerate(state.memory.devices()):
+            total = device['total'] / 1e9
+            free = device['free'] / 1e9
             gpus.append({
                 "id": i,
                 "name": torch.cuda.get_device_name(i),
                 "total_memory": round(total, 2),
-                "allocated": round(allocated, 2),
+                "allocated": round(device['allocated'] / 1e9, 2),
+                "reserved": round(device['reserved'] / 1e9, 2),
                 "free": round(free, 2),
-                "percent_used": round((allocated / total) * 100, 1)
+                "percent_used": round(((total - free) / total) * 100, 1)
             })
         return {"available": True, "count": gpu_count, "gpus": gpus}
     except Exception as e:
@@ -103,10 +104,8 @@ def check_gpu_memory():
         return True, "CPU mode"
     
     try:
-        props = torch.cuda.get_device_properties(0)
-        allocated = torch.cuda.memory_allocated(0) / 1e9
-        total = props.total_memory / 1e9
-        free = total - allocated
+        # Driver free memory plus our reusable cache - memory_allocated alone ignores other processes
+        free = state.memory.free_bytes()[0] / 1e9
         
         if free < MEMORY_BUFFER_GB:
             return False, f"Low GPU memory: {free:.1f}GB free (need {MEMORY_BUFFER_GB}GB buffer)"
@@ -114,15 +113,9 @@ def check_gpu_memory():
     except Exception as e:
         return False, str(e)
 
-def cleanup_memory():
-    """Aggressively clean up GPU memory"""
-    try:
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-        gc.collect()
-    except Exception as e:
-        print(f"Memory cleanup warning: {e}")
+def cleanup_memory(reason='manual'):
+    """Aggressively clean up GPU memory (loads, unloads, OOM recovery)"""
+    state.memory.trim(reason)
 
 def validate_model_name(name):
     """Validate and clean model name"""
@@ -444,7 +437,8 @@ def status():
     return jsonify({
         'status': 'Loading...' if state.loading else ('Ready' if state.model is None else 'Model loaded'),
         'model_name': state.model_name,
-        'gpu_info': gpu_info_data
+        'gpu_info': gpu_info_data,
+        'memory': state.memory.stats()
     })
 
 @app.route('/load_model', methods=['POST'])
@@ -476,7 +470,7 @@ def load_model():
         # Check memory before loading
         mem_ok, mem_msg = check_gpu_memory()
         if not mem_ok:
-            cleanup_memory()
+            cleanup_memory('load')
             mem_ok, mem_msg = check_gpu_memory()
             if not mem_ok:
                 return jsonify({
@@ -492,7 +486,7 @@ def load_model():
             del state.tokenizer
             state.model = None
             state.tokenizer = None
-            cleanup_memory()
+            cleanup_memory('unload')
         
         # Load tokenizer
         print("Loading tokenizer...")
@@ -584,7 +578,7 @@ def unload_model():
             state.tokenizer = None
             state.model_name = None
         
-        cleanup_memory()
+        cleanup_memory('unload')
         
         return jsonify({'success': True})
     except Exception as e:
@@ -627,7 +621,7 @@ def generate():
         # Check memory before generation
         mem_ok, mem_msg = check_gpu_memory()
         if not mem_ok:
-            cleanup_memory()
+            cleanup_memory('low_free')
             return jsonify({
                 'success': False,
                 'error': 'Low GPU memory before generation',
@@ -676,8 +670,8 @@ def generate():
         print(f"Generated: '{generated_text[:100]}...'")
         print(f"{'='*60}\n")
         
-        # Clean up after generation
-        cleanup_memory()
+        # Keep the allocator's cache warm unless memory is tight, fragmented or a load is waiting
+        state.memory.maybe_trim()
         
         return jsonify({
             'success': True,
@@ -690,7 +684,7 @@ def generate():
         
         # Handle CUDA errors specifically
         if 'CUDA' in error_msg or 'out of memory' in error_msg:
-            cleanup_memory()
+            cleanup_memory('oom')
             return jsonify({
                 'success': False,
                 'error': 'GPU memory error during generation',
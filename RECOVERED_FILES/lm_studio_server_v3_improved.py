@@ -10,6 +10,8 @@ LM Studio Server v3 - Improved for HPC
 import os
 import sys
 import json
+import queue
+import threading
 import warnings
 import traceback
 
@@ -19,10 +21,22 @@ os.environ['PYTHONWARNINGS'] = 'ignore::UserWarning'
 os.environ['NUMPY_EXPERIMENTAL_ARRAY_FUNCTION'] = '0'
 
 import torch
-import gc
 import psutil
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, request, jsonify, render_template_string, Response, stream_with_context, send_from_directory
 import time
+from model_pool import ModelPool, PoolFull
+from load_jobs import LoadJobQueue
+from model_staging import ModelStager, find_snapshot
+from artifact_cache import ArtifactCache, snapshot_revision
+from memory_governor import MemoryGovernor
+from telemetry import SystemStats, TelemetrySampler
+from metrics import LOAD_BUCKETS, Metrics
+from tracing import Tracer
+from response_cache import ResponseCache, cacheable, response_key
+from single_flight import SingleFlight
+from openai_api import (ChatPromptCache, OpenAIError, StopScanner, chat_logprobs, chat_messages, chunk_body,
+                        completion_logprobs, completion_prompts, request_id, response_body, sampling_params, usage)
+from memory_estimator import estimate_memory, estimate_model_memory, max_concurrent_batch
 
 # Try to import transformers with comprehensive error handling
 TRANSFORMERS_AVAILABLE = False
@@ -30,6 +44,15 @@ TRANSFORMERS_ERROR = None
 
 try:
     from transformers import AutoTokenizer, AutoModelForCausalLM
+    from batch_scheduler import LANES, BatchScheduler, GenerationRequest, QueueFull
+    from prefix_cache import PrefixCache
+    from paged_kv_cache import PagedKVCache, plan_num_blocks, bytes_per_token
+    from fast_loader import (safetensors_shards, load_safetensors_model, load_converted_model, meta_model,
+                             plan_device_map, place_model)
+    from quantization import SCHEMES as QUANTIZATION_SCHEMES, quantize_model
+    from placement_planner import PlacementError, device_inventory, plan_model
+    from speculative import DraftModel
+    from stub_backend import STUB_MODEL_NAME, load_stub
     TRANSFORMERS_AVAILABLE = True
     print("✅ Transformers imported successfully")
 except Exception as e:
@@ -53,6 +76,40 @@ app = Flask(__name__)
 MAX_INPUT_LENGTH = 2048
 MAX_NEW_TOKENS = 512
 MEMORY_BUFFER_GB = 2.0
+MEMORY_TRIM_FRAGMENTATION = float(os.environ.get('LMSTUDIO_MEMORY_TRIM_FRAGMENTATION', '0.35'))  # idle share of reserved memory
+MEMORY_TRIM_MIN_CACHED_GB = float(os.environ.get('LMSTUDIO_MEMORY_TRIM_MIN_CACHED_GB', '1.0'))  # smaller caches are never trimmed
+MAX_BATCH_SIZE = int(os.environ.get('LMSTUDIO_MAX_BATCH_SIZE', '16'))
+QUEUE_DEPTH = int(os.environ.get('LMSTUDIO_QUEUE_DEPTH', '64'))  # interactive requests allowed to wait per model
+BATCH_QUEUE_DEPTH = int(os.environ.get('LMSTUDIO_BATCH_QUEUE_DEPTH', '256'))
+QUEUE_TOKEN_BUDGET = int(os.environ.get('LMSTUDIO_QUEUE_TOKEN_BUDGET', '0'))  # 0 = 4x what the KV pool holds
+PREFIX_CACHE_GB = float(os.environ.get('LMSTUDIO_PREFIX_CACHE_GB', '4.0'))  # 0 disables
+KV_BLOCK_SIZE = 16  # tokens per paged KV block
+KV_CACHE_FRACTION = float(os.environ.get('LMSTUDIO_KV_CACHE_FRACTION', '0.6'))  # of free VRAM after load
+KV_CACHE_MAX_GB = float(os.environ.get('LMSTUDIO_KV_CACHE_MAX_GB', '16.0'))  # per resident model
+MODEL_POOL_VRAM_GB = float(os.environ.get('LMSTUDIO_MODEL_POOL_VRAM_GB', '0'))  # 0 = all GPUs minus buffer
+MODEL_POOL_CPU_GB = float(os.environ.get('LMSTUDIO_MODEL_POOL_CPU_GB', '0'))  # 0 = half of system RAM
+STAGE_MODELS = os.environ.get('LMSTUDIO_STAGE_MODELS', '1') == '1'  # copy cached snapshots to node-local scratch
+STAGE_WORKERS = int(os.environ.get('LMSTUDIO_STAGE_WORKERS', '8'))
+# KV-cache tokens the placement planner keeps free next to the layers on every GPU
+PLACEMENT_KV_TOKENS = int(os.environ.get('LMSTUDIO_PLACEMENT_KV_TOKENS', str(MAX_BATCH_SIZE * (MAX_INPUT_LENGTH + MAX_NEW_TOKENS) // 2)))
+FAST_LOADER = os.environ.get('LMSTUDIO_FAST_LOADER', '1') == '1'  # parallel safetensors reads for cached models
+FAST_LOADER_WORKERS = int(os.environ.get('LMSTUDIO_FAST_LOADER_WORKERS', str(min(16, os.cpu_count() or 4))))
+TELEMETRY_INTERVAL = float(os.environ.get('LMSTUDIO_TELEMETRY_INTERVAL', '2.0'))  # seconds between /status samples
+TELEMETRY_HISTORY_MINUTES = float(os.environ.get('LMSTUDIO_TELEMETRY_HISTORY_MINUTES', '60'))
+ARTIFACT_CACHE_DIR = os.environ.get('LMSTUDIO_ARTIFACT_DIR', '/cluster/tufts/datalab/zwu09/caches/lmstudio_artifacts')
+ARTIFACT_CACHE_GB = float(os.environ.get('LMSTUDIO_ARTIFACT_CACHE_GB', '0'))  # converted weights kept on disk; opt-in, 0 disables
+ARTIFACT_MIN_FREE_GB = float(os.environ.get('LMSTUDIO_ARTIFACT_MIN_FREE_GB', '20'))  # disk space an artifact store never eats into
+TRACE_DIR = os.environ.get('LMSTUDIO_TRACE_DIR', '/cluster/tufts/datalab/zwu09/tmp/lmstudio_traces')
+TRACE_MAX_EVENTS = int(os.environ.get('LMSTUDIO_TRACE_MAX_EVENTS', '200000'))  # oldest events are dropped past this
+TRACE_SAMPLE_RATE = float(os.environ.get('LMSTUDIO_TRACE_SAMPLE_RATE', '1.0'))  # share of requests given their own track
+RESPONSE_CACHE_MB = float(os.environ.get('LMSTUDIO_RESPONSE_CACHE_MB', '256'))  # replayed deterministic outputs; 0 disables
+RESPONSE_CACHE_TTL = float(os.environ.get('LMSTUDIO_RESPONSE_CACHE_TTL', '3600'))  # seconds an entry stays valid
+RESPONSE_CACHE_DIR = os.environ.get('LMSTUDIO_RESPONSE_CACHE_DIR', '/cluster/tufts/datalab/zwu09/caches/lmstudio_responses')
+RESPONSE_CACHE_SPILL_GB = float(os.environ.get('LMSTUDIO_RESPONSE_CACHE_SPILL_GB', '0'))  # disk for evicted entries; 0 = memory only
+STUB_TOKEN_MS = float(os.environ.get('LMSTUDIO_STUB_TOKEN_MS', '20'))  # per forward pass of the 'stub' model
+STUB_PREFILL_MS = float(os.environ.get('LMSTUDIO_STUB_PREFILL_MS', '0.2'))  # per prompt token of the 'stub' model
+DRAFT_TOKENS = int(os.environ.get('LMSTUDIO_DRAFT_TOKENS', '4'))  # tokens the draft model proposes per step
+SPECULATIVE_MAX_BATCH = int(os.environ.get('LMSTUDIO_SPECULATIVE_MAX_BATCH', '4'))  # beyond this, plain batching wins
 
 # Best ungated models for H100
 RECOMMENDED_MODELS = {
@@ -62,15 +119,108 @@ RECOMMENDED_MODELS = {
     'xlarge_32b': ['Qwen/Qwen2.5-32B-Instruct']
 }
 
+# Small models that share a tokenizer with the recommended ones, for speculative decoding
+RECOMMENDED_DRAFT_MODELS = {
+    'gpt2': 'distilgpt2',
+    'Qwen/Qwen2.5-7B-Instruct': 'Qwen/Qwen2.5-0.5B-Instruct',
+    'Qwen/Qwen2.5-14B-Instruct': 'Qwen/Qwen2.5-0.5B-Instruct',
+    'Qwen/Qwen2.5-32B-Instruct': 'Qwen/Qwen2.5-0.5B-Instruct',
+    'Qwen/Qwen2.5-Coder-7B-Instruct': 'Qwen/Qwen2.5-Coder-0.5B-Instruct',
+    'Qwen/Qwen2.5-Coder-32B-Instruct': 'Qwen/Qwen2.5-Coder-0.5B-Instruct',
+}
+
+def model_pool_budgets():
+    """(VRAM, CPU RAM) byte budgets for resident and parked models"""
+    if MODEL_POOL_VRAM_GB > 0:
+        vram = MODEL_POOL_VRAM_GB * 1e9
+    elif torch.cuda.is_available():
+        total = sum(torch.cuda.get_device_properties(i).total_memory for i in range(torch.cuda.device_count()))
+        vram = total - MEMORY_BUFFER_GB * 1e9 * torch.cuda.device_count()
+    else:
+        vram = psutil.virtual_memory().total * 0.5
+    cpu = MODEL_POOL_CPU_GB * 1e9 if MODEL_POOL_CPU_GB > 0 else psutil.virtual_memory().total * 0.5
+    return int(vram), int(cpu)
+
+# Prometheus counters and histograms; gauges are read from the pool when /metrics is scraped
+metrics = Metrics()
+for _name, _kind, _help in [
+    ('requests_total', 'counter', 'Generation requests by endpoint and outcome (ok, error, rejected)'),
+    ('request_seconds', 'histogram', 'End-to-end generation latency, tokenization to detokenized text'),
+    ('queue_wait_seconds', 'histogram', 'Time from submission until the scheduler admitted the request'),
+    ('tokenize_seconds', 'histogram', 'Prompt tokenization time'),
+    ('prefill_seconds', 'histogram', 'Prompt forward pass time, including recomputation after preemption'),
+    ('decode_seconds', 'histogram', 'Time from the first to the last generated token'),
+    ('detokenize_seconds', 'histogram', 'Time spent turning generated tokens back into text'),
+    ('time_to_first_token_seconds', 'histogram', 'Time from submission to the first generated token'),
+    ('prompt_tokens_total', 'counter', 'Prompt tokens processed'),
+    ('generated_tokens_total', 'counter', 'Tokens generated'),
+    ('tokens_per_second', 'gauge', 'Decode throughput, averaged over recent steps'),
+    ('decode_batch_size', 'histogram', 'Sequences per decode step'),
+    ('decode_step_seconds', 'histogram', 'Wall time of one decode step'),
+    ('kv_cache_blocks_used', 'gauge', 'Paged KV-cache blocks in use'),
+    ('kv_cache_blocks_total', 'gauge', 'Paged KV-cache blocks in the pool'),
+    ('kv_cache_utilization', 'gauge', 'Share of KV-cache blocks in use'),
+    ('queue_depth', 'gauge', 'Requests waiting for admission'),
+    ('queue_rejections_total', 'counter', 'Requests turned away by admission control'),
+    ('preemptions_total', 'counter', 'Sequences preempted to free KV-cache blocks'),
+    ('resident_models', 'gauge', 'Models resident on the GPUs'),
+    ('model_load_seconds', 'histogram', 'Model load duration by outcome'),
+    ('oom_total', 'counter', 'Out-of-memory failures by phase (load, generate)'),
+    ('gpu_memory_allocated_bytes', 'gauge', 'Memory held by live tensors'),
+    ('gpu_memory_reserved_bytes', 'gauge', 'Memory held by the caching allocator'),
+    ('response_cache_hits_total', 'counter', 'Deterministic requests answered from the response cache, by tier'),
+    ('response_cache_misses_total', 'counter', 'Deterministic requests that had to run the model'),
+    ('response_cache_bytes', 'gauge', 'Memory held by cached responses'),
+    ('coalesced_requests_total', 'counter', 'Requests that followed an identical in-flight request instead of running'),
+    ('in_flight_deterministic_requests', 'gauge', 'Deterministic requests running that identical arrivals can attach to'),
+]:
+    metrics.describe(_name, _kind, _help)
+for _phase in ('load', 'generate'):
+    metrics.counter('oom_total', phase=_phase)  # exported as 0 from the start so rate() works
+for _endpoint in ('generate', 'generate_stream'):
+    metrics.counter('coalesced_requests_total', endpoint=_endpoint)
+
 # Global state
 class ModelState:
     def __init__(self):
-        self.model = None
-        self.tokenizer = None
-        self.model_name = None
+        vram_budget, cpu_budget = model_pool_budgets()
+        self.pool = ModelPool(vram_budget, cpu_budget, build_scheduler=lambda entry: build_scheduler(entry))
+        self.stager = ModelStager(workers=STAGE_WORKERS)
+        self.artifacts = ArtifactCache(ARTIFACT_CACHE_DIR, int(ARTIFACT_CACHE_GB * 1e9),
+                                       min_free_bytes=int(ARTIFACT_MIN_FREE_GB * 1e9)) if ARTIFACT_CACHE_GB > 0 else None
+        self.load_jobs = LoadJobQueue(
+            lambda job: run_load_job(job),
+            describe_error=lambda msg: load_error_suggestion(msg),
+            on_finish=lambda job: record_load(job)
+        )
+        self.memory = MemoryGovernor(
+            low_free_bytes=int(MEMORY_BUFFER_GB * 1e9),
+            fragmentation_threshold=MEMORY_TRIM_FRAGMENTATION,
+            min_cached_bytes=int(MEMORY_TRIM_MIN_CACHED_GB * 1e9),
+            load_pending=lambda: self.loading
+        )
+        self.chat_prompts = ChatPromptCache()
+        self.responses = ResponseCache(
+            int(RESPONSE_CACHE_MB * 1e6),
+            ttl=RESPONSE_CACHE_TTL,
+            spill_dir=RESPONSE_CACHE_DIR,
+            spill_bytes=int(RESPONSE_CACHE_SPILL_GB * 1e9)
+        ) if RESPONSE_CACHE_MB > 0 else None
+        self.flights = SingleFlight()
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.loading = False
         self.demo_mode = not TRANSFORMERS_AVAILABLE
+    
+    @property
+    def loading(self):
+        return self.load_jobs.busy()
+    
+    @property
+    def model_name(self):
+        return self.pool.default_name
+    
+    def default_entry(self):
+        """Entry for the default model without touching its LRU position"""
+        return self.pool.entries.get(self.pool.default_name)
 
 state = ModelState()
 
@@ -82,32 +232,105 @@ def get_gpu_info():
     try:
         gpu_count = torch.cuda.device_count()
         gpus = []
-        for i in range(gpu_count):
-            props = torch.cuda.get_device_properties(i)
-            allocated = torch.cuda.memory_allocated(i) / 1e9
-            total = props.total_memory / 1e9
-            free = total - allocated
+        # Free is what the driver has left plus our allocator's reusable cache, so other processes count too
+        for i, device in enumerate(state.memory.devices()):
+            total = device['total'] / 1e9
+            free = device['free'] / 1e9
             gpus.append({
                 "id": i,
                 "name": torch.cuda.get_device_name(i),
                 "total_memory": round(total, 2),
-                "allocated": round(allocated, 2),
+                "allocated": round(device['allocated'] / 1e9, 2),
+                "reserved": round(device['reserved'] / 1e9, 2),
                 "free": round(free, 2),
-                "percent_used": round((allocated / total) * 100, 1)
+                "percent_used": round(((total - free) / total) * 100, 1)
             })
         return {"available": True, "count": gpu_count, "gpus": gpus}
     except Exception as e:
         return {"available": False, "error": str(e)}
 
-def cleanup_memory():
-    """Aggressively clean up GPU memory"""
-    try:
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.synchronize()
-        gc.collect()
-    except Exception as e:
-        print(f"Memory cleanup warning: {e}")
+# /status serves the sampler's latest snapshot, so browser polls never measure anything themselves
+telemetry = TelemetrySampler(
+    {
+        'gpu_info': get_gpu_info,
+        'system_info': SystemStats('/cluster/tufts/datalab'),
+        # Job progress walks the download directory, so it is measured here rather than per request
+        'load_jobs': lambda: [job.stats() for job in state.load_jobs.pending()],
+    },
+    interval=TELEMETRY_INTERVAL,
+    history_seconds=TELEMETRY_HISTORY_MINUTES * 60
+).start()
+
+# Idle until /trace/start; schedulers record into it only while a capture is running
+tracer = Tracer(max_events=TRACE_MAX_EVENTS, sample_rate=TRACE_SAMPLE_RATE)
+
+def cleanup_memory(reason='manual'):
+    """Aggressively clean up GPU memory (unloads, OOM recovery); requests go through state.memory.maybe_trim()"""
+    state.memory.trim(reason)
+
+def build_scheduler(entry):
+    """Start a batching worker for a model that has just landed on the GPU"""
+    # Carve the paged KV pool out of what is left after the weights
+    prefix_cache = PrefixCache(int(PREFIX_CACHE_GB * 1e9)) if PREFIX_CACHE_GB > 0 else None
+    num_blocks = plan_num_blocks(
+        entry.model, get_gpu_info(),
+        block_size=KV_BLOCK_SIZE,
+        fraction=KV_CACHE_FRACTION,
+        buffer_gb=MEMORY_BUFFER_GB + PREFIX_CACHE_GB
+    )
+    dtype = next(entry.model.parameters()).dtype
+    block_bytes = KV_BLOCK_SIZE * bytes_per_token(entry.model.config, dtype)
+    draft_block_bytes = 0
+    if entry.draft_model is not None:
+        # The draft keeps a pool with the same token capacity; both come out of the same budget
+        draft_block_bytes = KV_BLOCK_SIZE * bytes_per_token(entry.draft_model.config, dtype)
+        num_blocks = max(1, int(num_blocks * block_bytes // (block_bytes + draft_block_bytes)))
+    num_blocks = min(num_blocks, max(1, int(KV_CACHE_MAX_GB * 1e9 // (block_bytes + draft_block_bytes))))
+    kv_cache = PagedKVCache(num_blocks, block_size=KV_BLOCK_SIZE)
+    kv_cache.preallocate(entry.model)
+    
+    draft = None
+    if entry.draft_model is not None:
+        draft_kv_cache = PagedKVCache(num_blocks, block_size=KV_BLOCK_SIZE)
+        draft_kv_cache.preallocate(entry.draft_model)
+        draft = DraftModel(
+            entry.draft_model,
+            kv_cache=draft_kv_cache,
+            num_tokens=DRAFT_TOKENS,
+            max_batch_size=SPECULATIVE_MAX_BATCH,
+            name=entry.draft_name
+        )
+    
+    # Cap the batch at the half-full contexts the KV pool holds; sequences that outgrow it get preempted
+    estimate = estimate_memory(entry.model.config.to_dict(), dtype=str(dtype).replace('torch.', ''))
+    context_tokens = (MAX_INPUT_LENGTH + MAX_NEW_TOKENS) // 2
+    max_batch_size = max(1, min(MAX_BATCH_SIZE, max_concurrent_batch(estimate, num_blocks * block_bytes, context_tokens)))
+    print(f"   KV cache for {entry.name}: {num_blocks} blocks x {KV_BLOCK_SIZE} tokens, batch up to {max_batch_size}")
+    if draft is not None:
+        print(f"   Speculative decoding with {entry.draft_name}: {DRAFT_TOKENS} draft tokens per step")
+    # Bound the work waiting on this model so overload turns into fast 429s instead of unbounded queueing
+    token_budget = QUEUE_TOKEN_BUDGET or 4 * num_blocks * KV_BLOCK_SIZE
+    return BatchScheduler(
+        entry.model,
+        max_batch_size=max_batch_size,
+        prefix_cache=prefix_cache,
+        kv_cache=kv_cache,
+        draft=draft,
+        queue_depth={'interactive': QUEUE_DEPTH, 'batch': BATCH_QUEUE_DEPTH},
+        token_budget=token_budget,
+        tracer=tracer,
+        trace_name=entry.name
+    ).start()
+
+def checkpoint_bytes(model_name):
+    """Size of a model's weight files in the local HF cache (0 if not cached yet)"""
+    snapshot = find_snapshot(model_name, os.environ['HF_HOME'])
+    if snapshot is None:
+        return 0
+    return sum(
+        os.path.getsize(os.path.join(snapshot, f)) for f in os.listdir(snapshot)
+        if f.endswith(('.safetensors', '.bin'))
+    )
 
 def validate_model_name(name):
     """Validate and clean model name"""
@@ -154,6 +377,7 @@ HTML_TEMPLATE = """
         .gpu-bar { width: 100%; height: 20px; background: #e0e0e0; border-radius: 10px; overflow: hidden; margin: 5px 0; }
         .gpu-bar-fill { height: 100%; background: linear-gradient(90deg, #4CAF50, #FFC107, #F44336); transition: width 0.3s; }
         .char-count { font-size: 0.9em; color: #666; margin-top: 5px; }
+        .timings { font-size: 0.85em; color: #666; margin-top: 5px; font-family: monospace; white-space: pre-line; }
         .troubleshooting { background: #f8f9fa; padding: 15px; border-radius: 5px; margin-top: 20px; }
     </style>
 </head>
@@ -228,6 +452,17 @@ HTML_TEMPLATE = """
             <h3>Or Load Custom Model</h3>
             <input type="text" id="model-input" placeholder="Enter HuggingFace model name (e.g., Qwen/Qwen2.5-7B-Instruct)" style="width: 500px;">
             <br><br>
+            <input type="text" id="draft-input" placeholder="Draft model for speculative decoding (optional, 'auto' picks one)" style="width: 500px;">
+            <br><br>
+            <label>Weights:
+                <select id="quantization">
+                    <option value="">16-bit (no quantization)</option>
+                    <option value="int8">int8 (half the memory)</option>
+                    <option value="fp8">fp8 (half the memory)</option>
+                    <option value="int4">int4 (quarter of the memory)</option>
+                </select>
+            </label>
+            <br><br>
             <button onclick="loadModel(false)" id="load-btn">Load Model (Use Cache)</button>
             <button onclick="loadModel(true)" id="force-load-btn">🔄 Force Re-download</button>
             <button onclick="unloadModel()" id="unload-btn">Unload Model</button>
@@ -251,11 +486,13 @@ HTML_TEMPLATE = """
                 <label>Max Tokens: <input type="number" id="max-tokens" value="50" min="10" max="200" style="width: 70px;"></label>
                 <label>Temperature: <input type="number" id="temperature" value="0.8" step="0.1" min="0.1" max="2" style="width: 70px;"></label>
                 <label>Top P: <input type="number" id="top-p" value="0.9" step="0.05" min="0" max="1" style="width: 70px;"></label>
+                <label><input type="checkbox" id="speculative" checked> Speculative</label>
             </div>
             
             <div>
                 <h3>Output</h3>
                 <div class="chat-output" id="output">Generated text will appear here...</div>
+                <div class="timings" id="timings"></div>
             </div>
         </div>
         
@@ -355,38 +592,75 @@ HTML_TEMPLATE = """
                 headers: {'Content-Type': 'application/json'},
                 body: JSON.stringify({
                     model_name: modelName,
-                    force_download: forceDownload
+                    force_download: forceDownload,
+                    draft_model: document.getElementById('draft-input').value.trim(),
+                    quantization: document.getElementById('quantization').value
                 })
             })
             .then(r => r.json())
             .then(data => {
                 if (data.success) {
-                    document.getElementById('model-info').style.display = 'block';
-                    document.getElementById('model-details').innerHTML = 
-                        '<strong>Model:</strong> ' + data.model_name + '<br>' +
-                        '<strong>Device:</strong> ' + data.device + '<br>' +
-                        '<strong>Parameters:</strong> ' + (data.parameters || 'Unknown') + '<br>' +
-                        '<strong>Memory Used:</strong> ' + (data.memory_used || 'Unknown');
-                    showMessage('✅ Model loaded successfully!', 'success');
+                    pollLoadJob(data.job_id);
                 } else {
-                    showMessage('❌ Error: ' + data.error, 'error');
-                    if (data.suggestion) {
-                        showMessage('💡 Suggestion: ' + data.suggestion, 'warning');
-                    }
+                    finishLoad(data);
                 }
-                document.getElementById('load-btn').disabled = false;
-                document.getElementById('force-load-btn').disabled = false;
-                document.getElementById('load-btn').innerHTML = 'Load Model (Use Cache)';
-                updateStatus();
             })
             .catch(e => {
                 showMessage('❌ Network error: ' + e, 'error');
-                document.getElementById('load-btn').disabled = false;
-                document.getElementById('force-load-btn').disabled = false;
-                document.getElementById('load-btn').innerHTML = 'Load Model (Use Cache)';
+                resetLoadButtons();
             });
         }
         
+        function pollLoadJob(jobId) {
+            fetch('/load_status/' + jobId)
+                .then(r => r.json())
+                .then(job => {
+                    if (!job.done) {
+                        let progress = job.phase;
+                        if (job.phase === 'weights' && job.bytes_loaded) {
+                            progress += ` ${(job.bytes_loaded / 1e9).toFixed(1)}GB`;
+                            if (job.total_bytes) progress += ` / ${(job.total_bytes / 1e9).toFixed(1)}GB`;
+                            progress += ` @ ${job.throughput_gbps.toFixed(2)}GB/s`;
+                        }
+                        document.getElementById('load-btn').innerHTML = '<span class="loading"></span> ' + progress;
+                        setTimeout(() => pollLoadJob(jobId), 1000);
+                        return;
+                    }
+                    finishLoad(job.phase === 'ready' ? Object.assign({success: true}, job.result) : job);
+                })
+                .catch(e => {
+                    showMessage('❌ Network error: ' + e, 'error');
+                    resetLoadButtons();
+                });
+        }
+        
+        function finishLoad(data) {
+            if (data.success) {
+                document.getElementById('model-info').style.display = 'block';
+                document.getElementById('model-details').innerHTML = 
+                    '<strong>Model:</strong> ' + data.model_name + '<br>' +
+                    (data.draft_model ? '<strong>Draft Model:</strong> ' + data.draft_model + '<br>' : '') +
+                    '<strong>Weights:</strong> ' + (data.quantization || '16-bit') + '<br>' +
+                    '<strong>Device:</strong> ' + data.device + '<br>' +
+                    '<strong>Parameters:</strong> ' + (data.parameters || 'Unknown') + '<br>' +
+                    '<strong>Memory Used:</strong> ' + (data.memory_used || 'Unknown');
+                showMessage('✅ Model loaded successfully!', 'success');
+            } else {
+                showMessage('❌ Error: ' + data.error, 'error');
+                if (data.suggestion) {
+                    showMessage('💡 Suggestion: ' + data.suggestion, 'warning');
+                }
+            }
+            resetLoadButtons();
+            updateStatus();
+        }
+        
+        function resetLoadButtons() {
+            document.getElementById('load-btn').disabled = false;
+            document.getElementById('force-load-btn').disabled = false;
+            document.getElementById('load-btn').innerHTML = 'Load Model (Use Cache)';
+        }
+        
         function unloadModel() {
             fetch('/unload_model', {method: 'POST'})
                 .then(r => r.json())
@@ -423,32 +697,48 @@ HTML_TEMPLATE = """
             document.getElementById('generate-btn').disabled = true;
             document.getElementById('generate-btn').innerHTML = '<span class="loading"></span> Generating...';
             document.getElementById('output').textContent = 'Generating...';
+            document.getElementById('timings').textContent = '';
             
-            fetch('/generate', {
+            fetch('/generate_stream', {
                 method: 'POST',
                 headers: {'Content-Type': 'application/json'},
                 body: JSON.stringify({
                     text: input,
                     max_new_tokens: parseInt(document.getElementById('max-tokens').value),
                     temperature: parseFloat(document.getElementById('temperature').value),
-                    top_p: parseFloat(document.getElementById('top-p').value)
+                    top_p: parseFloat(document.getElementById('top-p').value),
+                    speculative: document.getElementById('speculative').checked
                 })
             })
-            .then(r => r.json())
-            .then(data => {
-                if (data.success) {
-                    document.getElementById('output').textContent = data.generated_text;
-                    showMessage('✅ Generated successfully!', 'success');
-                } else {
-                    document.getElementById('output').textContent = 'Error: ' + data.error;
-                    showMessage('❌ Generation failed: ' + data.error, 'error');
-                    if (data.suggestion) {
-                        showMessage('💡 ' + data.suggestion, 'warning');
+            .then(async r => {
+                const contentType = r.headers.get('Content-Type') || '';
+                if (!contentType.startsWith('text/event-stream')) {
+                    return finishGeneration(await r.json());
+                }
+                
+                // Render tokens as the server decodes them
+                const output = document.getElementById('output');
+                const reader = r.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let text = '';
+                while (true) {
+                    const chunk = await reader.read();
+                    if (chunk.done) break;
+                    buffer += decoder.decode(chunk.value, {stream: true});
+                    const events = buffer.split('\\n\\n');
+                    buffer = events.pop();
+                    for (const evt of events) {
+                        if (!evt.startsWith('data: ')) continue;
+                        const data = JSON.parse(evt.slice(6));
+                        if (data.done) {
+                            finishGeneration(data);
+                        } else {
+                            text += data.text;
+                            output.textContent = text;
+                        }
                     }
                 }
-                document.getElementById('generate-btn').disabled = false;
-                document.getElementById('generate-btn').innerHTML = 'Generate';
-                updateStatus();
             })
             .catch(e => {
                 document.getElementById('output').textContent = 'Error: ' + e;
@@ -458,9 +748,47 @@ HTML_TEMPLATE = """
             });
         }
         
+        function finishGeneration(data) {
+            if (data.success) {
+                document.getElementById('output').textContent = data.generated_text;
+                let msg = '✅ Generated successfully!';
+                if (data.time_to_first_token !== undefined && data.time_to_first_token !== null) {
+                    msg += ' (first token after ' + data.time_to_first_token.toFixed(2) + 's)';
+                }
+                if (data.speculative) {
+                    msg += ' - draft acceptance ' + (data.speculative.acceptance_rate * 100).toFixed(0) + '%';
+                }
+                showMessage(msg, 'success');
+                showTimings(data.timings);
+            } else {
+                document.getElementById('output').textContent = 'Error: ' + data.error;
+                showMessage('❌ Generation failed: ' + data.error, 'error');
+                if (data.suggestion) {
+                    showMessage('💡 ' + data.suggestion, 'warning');
+                }
+            }
+            document.getElementById('generate-btn').disabled = false;
+            document.getElementById('generate-btn').innerHTML = 'Generate';
+            updateStatus();
+        }
+        
+        function showTimings(timings) {
+            if (!timings) return;
+            const ms = v => v >= 1000 ? (v / 1000).toFixed(2) + 's' : v.toFixed(1) + 'ms';
+            let line = '';
+            if (timings.time_to_first_token_ms !== undefined) line += 'TTFT ' + ms(timings.time_to_first_token_ms);
+            if (timings.per_output_token_ms !== undefined) line += ' | ' + ms(timings.per_output_token_ms) + '/token';
+            line += ' | ' + timings.output_tokens + ' tokens in ' + ms(timings.total_ms);
+            const phases = ['memory_check', 'tokenize', 'queue', 'prefill', 'decode', 'detokenize', 'memory_trim']
+                .filter(p => timings[p + '_ms'] !== undefined)
+                .map(p => p + ' ' + ms(timings[p + '_ms']));
+            document.getElementById('timings').textContent = line + '\\n' + phases.join(' · ');
+        }
+        
         function clearChat() {
             document.getElementById('user-input').value = '';
             document.getElementById('output').textContent = 'Generated text will appear here...';
+            document.getElementById('timings').textContent = '';
             updateCharCount();
         }
         
@@ -477,16 +805,513 @@ def index():
 
 @app.route('/status')
 def status():
-    gpu_info_data = get_gpu_info()
+    gpu_info_data = telemetry.latest('gpu_info')
+    entry = state.default_entry()
+    scheduler_stats = entry.scheduler.stats() if entry is not None and entry.scheduler is not None else None
     
     return jsonify({
-        'status': 'Loading...' if state.loading else ('Ready' if state.model is None else 'Model loaded'),
+        'status': 'Loading...' if state.loading else ('Ready' if entry is None else 'Model loaded'),
         'mode': 'Demo Mode' if state.demo_mode else 'Full Mode',
         'model_name': state.model_name,
+        'quantization': entry.quantization if entry is not None else None,
         'demo_mode': state.demo_mode,
-        'gpu_info': gpu_info_data
+        'gpu_info': gpu_info_data,
+        'system_info': telemetry.latest('system_info'),
+        'telemetry': telemetry.stats(),
+        'model_pool': state.pool.stats(),
+        'load_jobs': telemetry.latest('load_jobs'),
+        'staging': state.stager.stats() if STAGE_MODELS else None,
+        'artifacts': state.artifacts.stats() if state.artifacts is not None else None,
+        'scheduler': scheduler_stats,
+        'prefix_cache': scheduler_stats.pop('prefix_cache') if scheduler_stats else None,
+        'kv_cache': scheduler_stats.pop('kv_cache') if scheduler_stats else None,
+        'speculative': scheduler_stats.pop('speculative') if scheduler_stats else None,
+        'queue': scheduler_stats.pop('queue') if scheduler_stats else None,
+        'memory': state.memory.stats(),
+        'tracing': tracer.stats(),
+        'chat_prompt_cache': state.chat_prompts.stats(),
+        'response_cache': state.responses.stats() if state.responses is not None else None,
+        'coalescing': state.flights.stats()
     })
 
+def pool_metrics():
+    """Scrape-time gauges from the resident models' schedulers and the GPUs"""
+    yield 'resident_models', 'gauge', {}, len(state.pool.names())
+    for name, entry in list(state.pool.entries.items()):
+        scheduler = entry.scheduler
+        if scheduler is None:
+            continue
+        labels = {'model': name}
+        kv = scheduler.kv_cache.stats()
+        queue = scheduler.queue_stats()
+        yield 'tokens_per_second', 'gauge', labels, queue['throughput_tokens_per_s']
+        yield 'decode_batch_size', 'histogram', labels, scheduler.batch_sizes
+        yield 'decode_step_seconds', 'histogram', labels, scheduler.step_seconds
+        yield 'kv_cache_blocks_used', 'gauge', labels, kv['used_blocks']
+        yield 'kv_cache_blocks_total', 'gauge', labels, kv['total_blocks']
+        yield 'kv_cache_utilization', 'gauge', labels, kv['utilization']
+        yield 'preemptions_total', 'counter', labels, scheduler.preemptions
+        for lane, info in queue['lanes'].items():
+            yield 'queue_depth', 'gauge', dict(labels, lane=lane), info['depth']
+            yield 'queue_rejections_total', 'counter', dict(labels, lane=lane), info['rejected']
+    for gpu, device in enumerate(state.memory.devices()):
+        yield 'gpu_memory_allocated_bytes', 'gauge', {'gpu': gpu}, device['allocated']
+        yield 'gpu_memory_reserved_bytes', 'gauge', {'gpu': gpu}, device['reserved']
+    yield 'in_flight_deterministic_requests', 'gauge', {}, state.flights.stats()['in_flight']
+    if state.responses is not None:
+        yield 'response_cache_hits_total', 'counter', {'tier': 'memory'}, state.responses.hits
+        yield 'response_cache_hits_total', 'counter', {'tier': 'disk'}, state.responses.disk_hits
+        yield 'response_cache_misses_total', 'counter', {}, state.responses.misses
+        yield 'response_cache_bytes', 'gauge', {}, state.responses.bytes
+
+metrics.add_collector(pool_metrics)
+
+def record_load(job):
+    """Load duration and OOM count for a finished load job"""
+    if job.started_at is not None:
+        outcome = 'ready' if job.phase == 'ready' else 'failed'
+        metrics.histogram('model_load_seconds', LOAD_BUCKETS, outcome=outcome).observe(job.finished_at - job.started_at)
+    if job.error and 'out of memory' in job.error.lower():
+        metrics.counter('oom_total', phase='load').inc()
+
+def record_generation(endpoint, gen_request, count_request=True, count_prompt=True, finished_at=None):
+    """Per-phase latencies of a finished request; runs on the request thread, never in the decode loop.
+
+    An HTTP request can fan out into several scheduler requests (OpenAI `n`
+    choices). Every choice records its own prefill, decode and token counts.
+    The request counter and request_seconds are observed only for the call
+    with count_request. The prompt token count and tokenize_seconds are
+    observed only for the call with count_prompt. finished_at is when the
+    last choice finished, if that was not this one.
+    """
+    timings = gen_request.timings
+    if count_prompt:
+        metrics.counter('prompt_tokens_total').inc(len(gen_request.input_ids))
+        if 'tokenize' in timings:
+            metrics.histogram('tokenize_seconds').observe(timings['tokenize'])
+    metrics.counter('generated_tokens_total').inc(len(gen_request.output_ids))
+    for phase in ('prefill', 'detokenize'):
+        if phase in timings:
+            metrics.histogram(f'{phase}_seconds').observe(timings[phase])
+    if gen_request.admitted_at is not None:
+        metrics.histogram('queue_wait_seconds', lane=gen_request.lane).observe(
+            gen_request.admitted_at - gen_request.submitted_at)
+    if gen_request.first_token_at is not None:
+        metrics.histogram('time_to_first_token_seconds').observe(gen_request.first_token_at - gen_request.submitted_at)
+        metrics.histogram('decode_seconds').observe(gen_request.finished_at - gen_request.first_token_at)
+    if count_request:
+        metrics.counter('requests_total', endpoint=endpoint, outcome='ok').inc()
+        finished_at = finished_at or gen_request.finished_at
+        total = timings.get('tokenize', 0) + (finished_at - gen_request.submitted_at) + timings.get('detokenize', 0)
+        metrics.histogram('request_seconds', endpoint=endpoint).observe(total)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/history')
+def metrics_history():
+    """Sampled GPU / CPU / RAM / disk figures for the last ?minutes=N (default 10) as time series"""
+    try:
+        minutes = float(request.args.get('minutes', 10))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'minutes must be a number'}), 400
+    history = telemetry.history(minutes * 60, prefix=request.args.get('prefix'))
+    return jsonify(dict(history, success=True))
+
+@app.route('/trace/start', methods=['POST'])
+def trace_start():
+    """Begin a capture; optional JSON body {'sample_rate': 0-1, 'max_events': N}"""
+    data = request.get_json(silent=True) or {}
+    try:
+        sample_rate = float(data.get('sample_rate', TRACE_SAMPLE_RATE))
+        max_events = int(data.get('max_events', TRACE_MAX_EVENTS))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'sample_rate must be a number and max_events an integer'}), 400
+    if not 0 <= sample_rate <= 1 or max_events < 1:
+        return jsonify({'success': False, 'error': 'sample_rate must be between 0 and 1 and max_events positive'}), 400
+    if tracer.active:
+        return jsonify({
+            'success': False,
+            'error': 'A trace capture is already running',
+            'suggestion': 'POST /trace/stop first'
+        }), 409
+    tracer.start(sample_rate=sample_rate, max_events=max_events)
+    print(f"✅ Trace capture started (sample rate {sample_rate}, up to {max_events} events)")
+    return jsonify({'success': True, 'tracing': tracer.stats()})
+
+@app.route('/trace/stop', methods=['POST'])
+def trace_stop():
+    """End the capture and write it as Chrome trace JSON under TRACE_DIR"""
+    if not tracer.active:
+        return jsonify({
+            'success': False,
+            'error': 'No trace capture is running',
+            'suggestion': 'POST /trace/start, send some requests, then stop'
+        }), 409
+    filename = f"trace-{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}.json"
+    try:
+        summary = tracer.stop(os.path.join(TRACE_DIR, filename))
+    except OSError as e:
+        return jsonify({'success': False, 'error': f'Could not write trace: {e}'})
+    print(f"✅ Trace written to {summary['path']} ({summary['events']} events)")
+    return jsonify(dict(summary, success=True, download=f'/trace/{filename}'))
+
+@app.route('/trace/<filename>')
+def trace_download(filename):
+    """A written capture, for loading into chrome://tracing or ui.perfetto.dev"""
+    return send_from_directory(TRACE_DIR, filename, mimetype='application/json', as_attachment=True)
+
+def load_error_suggestion(error_msg):
+    """Map a model-load failure to a hint for the user"""
+    if 'glibc' in error_msg.lower() or 'sentencepiece' in error_msg.lower():
+        return "GLIBC version issue. Try models without sentencepiece: gpt2, distilgpt2, microsoft/DialoGPT-small, or EleutherAI/pythia-70m"
+    elif '429' in error_msg or 'rate limit' in error_msg.lower():
+        return "HuggingFace rate limit hit. Wait a few minutes and try again, or set HF_TOKEN environment variable."
+    elif 'out of memory' in error_msg.lower() or 'oom' in error_msg.lower():
+        return "GPU out of memory. Try a smaller model or unload current model first."
+    elif 'connection' in error_msg.lower() or 'timeout' in error_msg.lower():
+        return "Network issue. Check internet connection on HPC or try again."
+    elif 'not found' in error_msg.lower() or '404' in error_msg:
+        return "Model not found. Check the model name spelling on HuggingFace."
+    elif 'free across' in error_msg.lower():
+        return "Not enough free GPU memory for the weights plus KV headroom. Unload other models, lower LMSTUDIO_PLACEMENT_KV_TOKENS or request more GPUs."
+    elif 'memory budget' in error_msg.lower():
+        return "Model is larger than the GPUs allow. Try quantization int8 or int4, a smaller model, or raise LMSTUDIO_MODEL_POOL_VRAM_GB."
+    elif 'share the tokenizer' in error_msg.lower():
+        return "Draft models must come from the same family as the target, e.g. Qwen/Qwen2.5-0.5B-Instruct for Qwen2.5-32B or distilgpt2 for gpt2."
+    elif 'low gpu memory' in error_msg.lower():
+        return "Try unloading current model or use a smaller model"
+    return None
+
+def stage_snapshot(job, model_name, force_download):
+    """(path to load from, local snapshot or None): a node-local copy of the cached snapshot when there is one"""
+    load_path = model_name
+    snapshot = find_snapshot(model_name, os.environ['HF_HOME']) if not force_download else None
+    if STAGE_MODELS and snapshot and not os.path.isdir(model_name):
+        if job is not None:
+            job.set_phase('staging')
+        try:
+            staged = state.stager.stage(snapshot)
+        except Exception as stage_error:
+            print(f"⚠️  Staging failed, loading from shared cache: {stage_error}")
+            staged = None
+        if staged:
+            load_path = snapshot = staged
+    return load_path, snapshot
+
+def load_tokenizer(load_path, hf_token, force_download):
+    """Fast tokenizer, falling back to the slow one"""
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(
+            load_path,
+            trust_remote_code=True,
+            use_fast=True,
+            token=hf_token,
+            force_download=force_download,
+            resume_download=not force_download
+        )
+    except Exception as tok_error:
+        print(f"Fast tokenizer failed, trying slow tokenizer: {tok_error}")
+        try:
+            tokenizer = AutoTokenizer.from_pretrained(
+                load_path,
+                trust_remote_code=True,
+                use_fast=False,
+                token=hf_token,
+                force_download=force_download,
+                resume_download=not force_download
+            )
+        except Exception as slow_error:
+            raise Exception(f"Both tokenizers failed. Fast: {tok_error}, Slow: {slow_error}")
+    
+    # Add pad token if missing
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+def load_weights(load_path, snapshot, dtype, device_map, hf_token, force_download, quantization=None):
+    """Model weights onto device_map, shard-parallel for cached safetensors checkpoints.
+    
+    With quantization the decoder's linear layers are stored as int8/int4/fp8;
+    device_map must then have been planned on the quantized skeleton.
+    """
+    if FAST_LOADER and snapshot and safetensors_shards(snapshot):
+        try:
+            print(f"   Parallel safetensors load from {snapshot} ({FAST_LOADER_WORKERS} workers)")
+            return load_safetensors_model(
+                snapshot, dtype=dtype, num_workers=FAST_LOADER_WORKERS,
+                device_map=device_map if isinstance(device_map, dict) else None,
+                quantization=quantization
+            )
+        except Exception as fast_error:
+            print(f"⚠️  Parallel loader failed, falling back to from_pretrained: {fast_error}")
+            cleanup_memory('load')
+    
+    if quantization:
+        # Quantize the CPU copy, then place the smaller layers on the GPUs
+        model = AutoModelForCausalLM.from_pretrained(
+            load_path,
+            torch_dtype=dtype,
+            low_cpu_mem_usage=True,
+            trust_remote_code=True,
+            token=hf_token,
+            force_download=force_download,
+            resume_download=not force_download
+        )
+        quantize_model(model, quantization)
+        return place_model(model, device_map if isinstance(device_map, dict) else plan_device_map(model, dtype))
+    
+    return AutoModelForCausalLM.from_pretrained(
+        load_path,
+        torch_dtype=dtype,
+        device_map=device_map,
+        low_cpu_mem_usage=True,
+        trust_remote_code=True,
+        token=hf_token,
+        force_download=force_download,
+        resume_download=not force_download
+    )
+
+def model_revision(model_name):
+    """Revision of the weights a model was loaded from, or None when there is no local snapshot to identify"""
+    snapshot = find_snapshot(model_name, os.environ['HF_HOME'])
+    return snapshot_revision(snapshot) if snapshot else None
+
+def artifact_for(model_name, dtype, quantization):
+    """(artifact ID, local snapshot) for a model's converted weights, or (None, None) when they are not cacheable"""
+    snapshot = find_snapshot(model_name, os.environ['HF_HOME'])
+    if state.artifacts is None or snapshot is None:
+        return None, None
+    return ArtifactCache.artifact_id(model_name, snapshot_revision(snapshot), dtype, quantization), snapshot
+
+def load_artifact(files, config_path, dtype, device_map, quantization, hf_token):
+    """Memory-map a stored artifact into a fresh skeleton - no cast or quantize pass"""
+    skeleton = meta_model(config_path, dtype, token=hf_token)
+    if quantization:
+        quantize_model(skeleton, quantization)
+    if not isinstance(device_map, dict):
+        device_map = plan_device_map(skeleton, dtype)
+    return load_converted_model(skeleton, files, device_map, FAST_LOADER_WORKERS)
+
+def store_artifact(artifact_id, model_name, model, snapshot, dtype, quantization):
+    """Save model's converted weights in the background, unless they are just the checkpoint's own tensors"""
+    try:
+        with open(os.path.join(snapshot, 'config.json')) as f:
+            checkpoint_dtype = json.load(f).get('torch_dtype')
+    except (OSError, ValueError):
+        checkpoint_dtype = None
+    if not quantization and checkpoint_dtype == str(dtype).replace('torch.', ''):
+        return
+    state.artifacts.store_async(artifact_id, model, info={
+        'model_name': model_name,
+        'revision': snapshot_revision(snapshot),
+        'dtype': str(dtype).replace('torch.', ''),
+        'quantization': quantization,
+        'checkpoint_dtype': checkpoint_dtype,
+        # Recorded for reference only: the stored tensors load into any device map
+        'placement': {name: str(device) for name, device in (getattr(model, 'hf_device_map', None) or {'': state.device}).items()},
+    })
+
+def load_draft(job, draft_name, model, tokenizer):
+    """Load a speculative-decoding draft next to model's input embeddings; it must share the tokenizer"""
+    print(f"Loading draft model: {draft_name}")
+    hf_token = os.environ.get('HF_TOKEN') or os.environ.get('HUGGINGFACE_TOKEN')
+    load_path, snapshot = stage_snapshot(None, draft_name, job.force_download)
+    draft_tokenizer = load_tokenizer(load_path, hf_token, job.force_download)
+    if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+        raise Exception(f"Draft model {draft_name} does not share the tokenizer of {job.model_name}")
+    
+    device = model.get_input_embeddings().weight.device
+    dtype = next(model.parameters()).dtype
+    device_map = {'': device.index} if device.type == 'cuda' else None
+    draft_model = load_weights(load_path, snapshot, dtype, device_map, hf_token, job.force_download)
+    if device_map is None:
+        draft_model.to(device)
+    draft_model.eval()
+    print(f"✅ Draft model loaded: {sum(p.numel() for p in draft_model.parameters()):,} parameters on {device}")
+    return draft_model
+
+def load_stub_model(job):
+    """Put the sleep-based stub model in the pool, for benchmarking the server without real weights"""
+    job.set_phase('weights')
+    model, tokenizer = load_stub(STUB_TOKEN_MS / 1000, STUB_PREFILL_MS / 1000, device=state.device)
+    job.set_phase('placement')
+    entry = state.pool.add(STUB_MODEL_NAME, model, tokenizer)
+    entry.revision = STUB_MODEL_NAME
+    print(f"✅ Stub model loaded: {STUB_TOKEN_MS}ms per forward pass, {STUB_PREFILL_MS}ms per prompt token")
+    return {
+        'model_name': STUB_MODEL_NAME,
+        'draft_model': None,
+        'quantization': None,
+        'device': state.device,
+        'parameters': f"{sum(p.numel() for p in model.parameters()):,}",
+        'memory_used': '0.0GB',
+        'stub': {'token_ms': STUB_TOKEN_MS, 'prefill_ms_per_token': STUB_PREFILL_MS}
+    }
+
+def run_load_job(job):
+    """Load job.model_name (and its draft model, if any) into the pool; runs on the loader thread"""
+    model_name = job.model_name
+    force_download = job.force_download
+    
+    print(f"\n{'='*60}")
+    print(f"Loading model: {model_name} (job {job.job_id})")
+    print(f"{'='*60}")
+    
+    # Already resident (or parked in RAM) with the same weights - just make it the default again
+    same_weights = model_name in state.pool and state.pool.entries[model_name].quantization == job.quantization
+    if same_weights and not force_download:
+        entry = state.pool.get(model_name)
+        if job.draft_model and job.draft_model != entry.draft_name:
+            job.set_phase('weights')
+            draft_model = load_draft(job, job.draft_model, entry.model, entry.tokenizer)
+            entry = state.pool.set_draft(model_name, job.draft_model, draft_model)
+        job.set_phase('placement')
+        state.pool.default_name = model_name
+        print(f"✅ {model_name} already in the model pool")
+        return {
+            'model_name': model_name,
+            'draft_model': entry.draft_name,
+            'quantization': entry.quantization,
+            'device': state.device,
+            'parameters': f"{sum(p.numel() for p in entry.model.parameters()):,}",
+            'memory_used': f"{entry.weight_bytes / 1e9:.1f}GB",
+            'already_loaded': True
+        }
+    if model_name in state.pool:
+        state.pool.remove(model_name)
+    if model_name == STUB_MODEL_NAME:
+        return load_stub_model(job)
+    
+    # Size the model from its config before evicting anything for it
+    estimate = estimate_model_memory(
+        model_name, os.environ['HF_HOME'],
+        dtype='float16' if state.device == "cuda" else 'float32',
+        quantization=job.quantization,
+        context_tokens=MAX_INPUT_LENGTH + MAX_NEW_TOKENS
+    )
+    required_bytes = job.total_bytes
+    if estimate['memory_gb'] != 'unknown':
+        print(f"   Estimated: {estimate['params']}B parameters, {estimate['weights_gb']}GB {estimate['dtype']} weights, "
+              f"{estimate['kv_cache_per_token_kb']}KB KV cache per token")
+        required_bytes = estimate['weight_bytes'] + int((estimate['activation_gb'] + estimate['overhead_gb']) * 1e9)
+        if job.draft_model:
+            required_bytes += checkpoint_bytes(job.draft_model)
+        if required_bytes > state.pool.vram_budget_bytes:
+            raise Exception(f"Model needs ~{required_bytes / 1e9:.1f}GB but the GPU memory budget is "
+                            f"{state.pool.vram_budget_bytes / 1e9:.1f}GB")
+    
+    # Evict least recently used models until this one fits the VRAM budget
+    if not state.pool.make_room(required_bytes):
+        print("⚠️  Every resident model is busy - loading without evicting")
+    
+    # Check memory before loading (any GPU with room can take layers)
+    if torch.cuda.is_available():
+        free = max(gpu['free'] for gpu in get_gpu_info()['gpus'])
+        if free < MEMORY_BUFFER_GB:
+            cleanup_memory('load')
+            raise Exception(f'Low GPU memory: {free:.1f}GB free (need {MEMORY_BUFFER_GB}GB buffer)')
+    
+    # Weights converted by an earlier load of this revision skip the checkpoint read and the cast / quantize pass
+    dtype = torch.float16 if state.device == "cuda" else torch.float32
+    artifact_id, source = artifact_for(model_name, dtype, job.quantization) if not force_download else (None, None)
+    artifact_files = state.artifacts.lookup(artifact_id) if artifact_id else None
+    if artifact_files:
+        print(f"✅ Using converted weights from artifact {artifact_id}")
+        load_path, snapshot = source, None
+    else:
+        # Load from a node-local copy of the cached snapshot when there is one
+        load_path, snapshot = stage_snapshot(job, model_name, force_download)
+    
+    # Load tokenizer
+    job.set_phase('tokenizer')
+    print("Loading tokenizer...")
+    hf_token = os.environ.get('HF_TOKEN') or os.environ.get('HUGGINGFACE_TOKEN')
+    
+    # Check if model is cached
+    cache_dir = os.environ.get('HF_HOME', '/cluster/tufts/datalab/zwu09/caches/huggingface')
+    if not force_download and os.path.exists(cache_dir):
+        print(f"✅ Using cache directory: {cache_dir}")
+        print("   Model will be loaded from cache if available")
+    elif force_download:
+        print("🔄 Force download enabled - will re-download from HuggingFace")
+    
+    tokenizer = load_tokenizer(load_path, hf_token, force_download)
+    
+    # Load model with optimizations
+    job.set_phase('weights')
+    print("Loading model (this may take a few minutes)...")
+    
+    if job.quantization and not artifact_files:
+        print(f"   Quantizing decoder weights to {job.quantization} while loading")
+    
+    # Balanced layer split across the allocation's GPUs, with KV headroom kept on each
+    device_map = "auto" if state.device == "cuda" else None
+    placement = None
+    if state.device == "cuda":
+        try:
+            skeleton = meta_model(load_path, dtype, token=hf_token)
+            if job.quantization:
+                quantize_model(skeleton, job.quantization)
+            placement = plan_model(
+                skeleton,
+                dtype, device_inventory(),
+                kv_tokens=PLACEMENT_KV_TOKENS,
+                reserve_bytes=int(MEMORY_BUFFER_GB * 1e9)
+            )
+            device_map = placement.device_map
+            for device, info in placement.stats()['devices'].items():
+                print(f"   GPU {device}: {info['layers']} layers, {info['projected_gb']}GB projected of {info['free_gb']}GB free")
+        except PlacementError:
+            raise
+        except Exception as plan_error:
+            print(f"⚠️  Placement planning failed, using device_map=auto: {plan_error}")
+    
+    model = None
+    if artifact_files:
+        try:
+            model = load_artifact(artifact_files, load_path, dtype, device_map, job.quantization, hf_token)
+        except Exception as artifact_error:
+            print(f"⚠️  Artifact {artifact_id} is unusable, loading the checkpoint: {artifact_error}")
+            state.artifacts.remove(artifact_id)
+            cleanup_memory('load')
+    if model is None:
+        model = load_weights(load_path, snapshot, dtype, device_map, hf_token, force_download, job.quantization)
+        if artifact_id:
+            store_artifact(artifact_id, model_name, model, source, dtype, job.quantization)
+    
+    # Draft model for speculative decoding rides along on the target's first GPU
+    draft_model = None
+    if job.draft_model:
+        draft_model = load_draft(job, job.draft_model, model, tokenizer)
+    
+    # Get stats
+    job.set_phase('placement')
+    num_params = sum(p.numel() for p in model.parameters())
+    gpu_info = get_gpu_info()
+    memory_used = f"{sum(gpu['allocated'] for gpu in gpu_info['gpus']):.1f}GB" if gpu_info.get('available') else "Unknown"
+    
+    entry = state.pool.add(model_name, model, tokenizer, draft_name=job.draft_model, draft_model=draft_model)
+    entry.placement = placement
+    entry.revision = model_revision(model_name)
+    
+    print(f"✅ Model loaded successfully!")
+    print(f"   Parameters: {num_params:,}")
+    print(f"   Memory used: {memory_used}")
+    print(f"   Resident models: {', '.join(state.pool.names())}")
+    print(f"{'='*60}\n")
+    
+    return {
+        'model_name': model_name,
+        'draft_model': job.draft_model,
+        'quantization': job.quantization,
+        'estimated_weights_gb': estimate.get('weights_gb'),
+        'device': state.device,
+        'parameters': f"{num_params:,}",
+        'memory_used': memory_used
+    }
+
 @app.route('/load_model', methods=['POST'])
 def load_model():
     if state.demo_mode:
@@ -496,17 +1321,18 @@ def load_model():
             'suggestion': 'Try the simple server: python simple_lm_studio.py'
         })
     
-    if state.loading:
-        return jsonify({
-            'success': False,
-            'error': 'Another model is currently loading. Please wait.'
-        })
-    
     try:
-        state.loading = True
         data = request.get_json()
         model_name_raw = data['model_name']
         force_download = data.get('force_download', False)
+        draft_model = (data.get('draft_model') or '').strip() or None
+        quantization = data.get('quantization') or None
+        if quantization not in (None,) + QUANTIZATION_SCHEMES:
+            return jsonify({
+                'success': False,
+                'error': f"Unknown quantization '{quantization}'",
+                'suggestion': f"Use one of: {', '.join(QUANTIZATION_SCHEMES)} (or leave empty for 16-bit weights)"
+            })
         
         # Validate and clean model name
         model_name, error = validate_model_name(model_name_raw)
@@ -517,144 +1343,64 @@ def load_model():
                 'suggestion': 'Please enter a single model name from HuggingFace'
             })
         
-        print(f"\n{'='*60}")
-        print(f"Loading model: {model_name}")
-        print(f"{'='*60}")
-        
-        # Check memory before loading
-        if torch.cuda.is_available():
-            allocated = torch.cuda.memory_allocated(0) / 1e9
-            total = torch.cuda.get_device_properties(0).total_memory / 1e9
-            free = total - allocated
-            if free < MEMORY_BUFFER_GB:
-                cleanup_memory()
-                return jsonify({
-                    'success': False,
-                    'error': f'Low GPU memory: {free:.1f}GB free (need {MEMORY_BUFFER_GB}GB buffer)',
-                    'suggestion': 'Try unloading current model or use a smaller model'
-                })
-        
-        # Unload previous model
-        if state.model is not None:
-            print("Unloading previous model...")
-            del state.model
-            del state.tokenizer
-            state.model = None
-            state.tokenizer = None
-            cleanup_memory()
-        
-        # Load tokenizer
-        print("Loading tokenizer...")
-        hf_token = os.environ.get('HF_TOKEN') or os.environ.get('HUGGINGFACE_TOKEN')
-        
-        # Check if model is cached
-        cache_dir = os.environ.get('HF_HOME', '/cluster/tufts/datalab/zwu09/caches/huggingface')
-        if not force_download and os.path.exists(cache_dir):
-            print(f"✅ Using cache directory: {cache_dir}")
-            print("   Model will be loaded from cache if available")
-        elif force_download:
-            print("🔄 Force download enabled - will re-download from HuggingFace")
-        
-        try:
-            state.tokenizer = AutoTokenizer.from_pretrained(
-                model_name,
-                trust_remote_code=True,
-                use_fast=True,
-                token=hf_token,
-                force_download=force_download,
-                resume_download=not force_download
-            )
-        except Exception as tok_error:
-            print(f"Fast tokenizer failed, trying slow tokenizer: {tok_error}")
-            try:
-                state.tokenizer = AutoTokenizer.from_pretrained(
-                    model_name,
-                    trust_remote_code=True,
-                    use_fast=False,
-                    token=hf_token,
-                    force_download=force_download,
-                    resume_download=not force_download
-                )
-            except Exception as slow_error:
-                raise Exception(f"Both tokenizers failed. Fast: {tok_error}, Slow: {slow_error}")
-        
-        # Add pad token if missing
-        if state.tokenizer.pad_token is None:
-            state.tokenizer.pad_token = state.tokenizer.eos_token
-        
-        # Load model with optimizations
-        print("Loading model (this may take a few minutes)...")
-        hf_token = os.environ.get('HF_TOKEN') or os.environ.get('HUGGINGFACE_TOKEN')
-        
-        state.model = AutoModelForCausalLM.from_pretrained(
+        # Loading runs on the loader thread; the caller polls /load_status/<job_id>
+        download_dir = None
+        if not os.path.isdir(model_name):
+            download_dir = os.path.join(os.environ['HF_HOME'], 'hub', 'models--' + model_name.replace('/', '--'))
+        if draft_model == 'auto':
+            draft_model = RECOMMENDED_DRAFT_MODELS.get(model_name)
+        if draft_model == model_name:
+            draft_model = None
+        job = state.load_jobs.submit(
             model_name,
-            torch_dtype=torch.float16 if state.device == "cuda" else torch.float32,
-            device_map="auto" if state.device == "cuda" else None,
-            low_cpu_mem_usage=True,
-            trust_remote_code=True,
-            token=hf_token,
             force_download=force_download,
-            resume_download=not force_download
+            total_bytes=checkpoint_bytes(model_name) + (checkpoint_bytes(draft_model) if draft_model else 0),
+            download_dir=download_dir,
+            draft_model=draft_model,
+            quantization=quantization
         )
         
-        state.model_name = model_name
-        
-        # Get stats
-        num_params = sum(p.numel() for p in state.model.parameters())
-        gpu_info = get_gpu_info()
-        memory_used = f"{gpu_info['gpus'][0]['allocated']:.1f}GB" if gpu_info.get('available') else "Unknown"
-        
-        print(f"✅ Model loaded successfully!")
-        print(f"   Parameters: {num_params:,}")
-        print(f"   Memory used: {memory_used}")
-        print(f"{'='*60}\n")
-        
-        state.loading = False
-        
         return jsonify({
             'success': True,
+            'job_id': job.job_id,
             'model_name': model_name,
-            'device': state.device,
-            'parameters': f"{num_params:,}",
-            'memory_used': memory_used
-        })
+            'draft_model': draft_model,
+            'quantization': quantization,
+            'status_url': f'/load_status/{job.job_id}',
+            'queue_position': len(state.load_jobs.pending())
+        }), 202
         
     except Exception as e:
-        state.loading = False
         error_msg = str(e)
-        print(f"❌ Error loading model: {error_msg}")
-        traceback.print_exc()
-        
-        # Provide helpful suggestions
-        suggestion = None
-        if 'glibc' in error_msg.lower() or 'sentencepiece' in error_msg.lower():
-            suggestion = "GLIBC version issue. Try models without sentencepiece: gpt2, distilgpt2, microsoft/DialoGPT-small, or EleutherAI/pythia-70m"
-        elif '429' in error_msg or 'rate limit' in error_msg.lower():
-            suggestion = "HuggingFace rate limit hit. Wait a few minutes and try again, or set HF_TOKEN environment variable."
-        elif 'out of memory' in error_msg.lower() or 'oom' in error_msg.lower():
-            suggestion = "GPU out of memory. Try a smaller model or unload current model first."
-        elif 'connection' in error_msg.lower() or 'timeout' in error_msg.lower():
-            suggestion = "Network issue. Check internet connection on HPC or try again."
-        elif 'not found' in error_msg.lower() or '404' in error_msg:
-            suggestion = "Model not found. Check the model name spelling on HuggingFace."
-        
+        print(f"❌ Error queueing model load: {error_msg}")
         return jsonify({
             'success': False,
             'error': error_msg,
-            'suggestion': suggestion
+            'suggestion': load_error_suggestion(error_msg)
         })
 
+@app.route('/load_status/<job_id>')
+def load_status(job_id):
+    job = state.load_jobs.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': f'Unknown load job {job_id}'}), 404
+    stats = job.stats()
+    stats['success'] = job.phase != 'failed'
+    return jsonify(stats)
+
 @app.route('/unload_model', methods=['POST'])
 def unload_model():
     try:
-        if state.model is not None:
-            del state.model
-            del state.tokenizer
-            state.model = None
-            state.tokenizer = None
-            state.model_name = None
+        # Unload one named model, or everything when no name is given
+        data = request.get_json(silent=True) or {}
+        model_name = data.get('model_name')
+        if model_name:
+            if not state.pool.remove(model_name):
+                return jsonify({'success': False, 'error': f'Model {model_name} is not loaded'})
+        else:
+            state.pool.clear()
         
-        cleanup_memory()
+        cleanup_memory('unload')
         
         return jsonify({'success': True})
     except Exception as e:
@@ -668,131 +1414,819 @@ def clear_cache():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
-@app.route('/generate', methods=['POST'])
-def generate():
-    if state.demo_mode:
+@app.route('/cache')
+def list_artifacts():
+    """Converted-weight artifacts on disk, most recently used first"""
+    if state.artifacts is None:
         return jsonify({
+            'success': False,
+            'error': 'Artifact cache is disabled',
+            'suggestion': 'Set LMSTUDIO_ARTIFACT_CACHE_GB to a size above 0 and restart the server'
+        })
+    artifacts = [{
+        'artifact_id': e['artifact_id'],
+        'model_name': e.get('model_name'),
+        'revision': e.get('revision'),
+        'dtype': e.get('dtype'),
+        'quantization': e.get('quantization'),
+        'placement': e.get('placement'),
+        'size_gb': round(e.get('bytes', 0) / 1e9, 2),
+        'files': len(e.get('files', [])),
+        'created_at': e.get('created_at'),
+        'last_used': e['last_used'],
+    } for e in state.artifacts.entries()]
+    return jsonify({'success': True, 'artifacts': artifacts, 'stats': state.artifacts.stats()})
+
+@app.route('/cache/<artifact_id>', methods=['DELETE'])
+def delete_artifact(artifact_id):
+    if state.artifacts is None or not state.artifacts.remove(artifact_id):
+        return jsonify({'success': False, 'error': f'Unknown artifact {artifact_id}'}), 404
+    return jsonify({'success': True})
+
+def generation_entry(requested_model):
+    """(entry, None) for the requested model (default: most recently loaded), or (None, error_dict)"""
+    try:
+        entry = state.pool.get(requested_model)
+    except PoolFull as e:
+        print(f"⚠️  {e}")
+        return None, {
+            'success': False,
+            'error': f'Model unavailable: {e}',
+            'suggestion': f'Retry in {e.retry_after}s, once a resident model has finished its requests',
+            'status_code': 503,
+            'retry_after': e.retry_after
+        }
+    if entry is not None and entry.scheduler is not None:
+        return entry, None
+    if requested_model:
+        return None, {
+            'success': False,
+            'error': f'Model {requested_model} is not loaded',
+            'loaded_models': state.pool.names()
+        }
+    if state.loading:
+        return None, {
+            'success': False,
+            'error': 'A model is still loading',
+            'suggestion': 'Retry once /load_status reports the model as ready',
+            'status_code': 503,
+            'retry_after': 5
+        }
+    return None, {
+        'success': False,
+        'error': 'No model loaded. Please load a model first.'
+    }
+
+def memory_precheck():
+    """Error dict when some GPU is too full to start generating, else None"""
+    if torch.cuda.is_available():
+        free = min(gpu['free'] for gpu in get_gpu_info()['gpus'])
+        if free < 1.0:  # Need at least 1GB free on every GPU
+            cleanup_memory('low_free')
+            return {
+                'success': False,
+                'error': 'Low GPU memory before generation',
+                'suggestion': 'Try clearing cache or using shorter input'
+            }
+    return None
+
+def prepare_generation(data):
+    """Validate a /generate payload and build the scheduler request.
+
+    Returns (gen_request, entry, None) on success or (None, None, error_dict)
+    when the request should be rejected before it reaches the model. The
+    optional `model` field picks a model from the pool; the default is the
+    most recently loaded one. `speculative: false` opts out of draft-model
+    decoding for models loaded with a draft. `priority` picks the queue lane:
+    'interactive' (default) or 'batch' for bulk jobs that can wait. An
+    integer `seed` makes sampling reproducible (and the response cacheable).
+    `top_k` and `min_p` narrow sampling further; each request in a batch
+    keeps its own temperature, top_p, top_k and min_p.
+    """
+    if state.demo_mode:
+        return None, None, {
             'success': False,
             'error': 'Demo mode active - text generation not available',
             'suggestion': 'Try the simple server: python simple_lm_studio.py'
-        })
+        }
+    
+    entry, error = generation_entry(data.get('model') or data.get('model_name'))
+    if error:
+        return None, None, error
+    
+    text = data['text']
+    max_new_tokens = min(data.get('max_new_tokens', 50), MAX_NEW_TOKENS)
+    temperature = data.get('temperature', 0.8)
+    top_p = data.get('top_p', 0.9)
+    top_k = data.get('top_k', 0)  # 0 = off
+    min_p = data.get('min_p', 0.0)  # 0 = off
+    seed = data.get('seed')
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool) or seed < 0):
+        return None, None, {
+            'success': False,
+            'error': 'seed must be a non-negative integer',
+            'suggestion': 'Omit seed for unseeded sampling'
+        }
+    # Speculative decoding is on by default whenever the model was loaded with a draft
+    speculative = bool(data.get('speculative', True)) and entry.draft_model is not None
+    lane = data.get('priority') or 'interactive'
+    if lane not in LANES:
+        return None, None, {
+            'success': False,
+            'error': f"Unknown priority '{lane}'",
+            'suggestion': f"Use one of: {', '.join(LANES)}"
+        }
     
+    # Validate input length
+    if len(text) > 2000:
+        return None, None, {
+            'success': False,
+            'error': 'Input too long (>2000 characters)',
+            'suggestion': 'Please shorten your input to avoid CUDA memory errors'
+        }
+    
+    print(f"\n{'='*60}")
+    print(f"Generating text for: '{text[:50]}...'")
+    
+    # Check memory before generation
+    memory_check_start = time.monotonic()
+    error = memory_precheck()
+    if error:
+        return None, None, error
+    
+    # Tokenize with strict length limit
+    tokenize_start = time.monotonic()
+    inputs = entry.tokenizer(
+        text,
+        return_tensors='pt',
+        padding=True,
+        truncation=True,
+        max_length=MAX_INPUT_LENGTH
+    )
+    
+    input_length = inputs['input_ids'].shape[1]
+    print(f"Input tokens: {input_length} (max: {MAX_INPUT_LENGTH})")
+    
+    if input_length > MAX_INPUT_LENGTH:
+        return None, None, {
+            'success': False,
+            'error': f'Input too long: {input_length} tokens (max: {MAX_INPUT_LENGTH})',
+            'suggestion': 'Please use shorter input text'
+        }
+    
+    # Queue for the batching worker; it shares decode steps with other requests
+    gen_request = GenerationRequest(
+        inputs['input_ids'][0].tolist(),
+        max_new_tokens=max_new_tokens,
+        temperature=temperature,
+        top_p=top_p,
+        top_k=top_k,
+        min_p=min_p,
+        eos_token_id=entry.tokenizer.eos_token_id,
+        speculative=speculative,
+        lane=lane,
+        seed=seed
+    )
+    gen_request.timings['memory_check'] = tokenize_start - memory_check_start
+    gen_request.timings['tokenize'] = time.monotonic() - tokenize_start
+    return gen_request, entry, None
+
+def request_timings(gen_request, received_at):
+    """Phase breakdown of one request in milliseconds, all from monotonic timers.
+
+    queue is submission to admission, prefill includes any recomputation
+    after preemption, decode runs from the first token to the last, and
+    per_output_token is decode spread over the tokens after the first.
+    """
+    timings = gen_request.timings
+    phases = {name: timings.get(name) for name in ('memory_check', 'tokenize')}
+    if gen_request.admitted_at is not None:
+        phases['queue'] = gen_request.admitted_at - gen_request.submitted_at
+    phases['prefill'] = timings.get('prefill')
+    result = {}
+    if gen_request.first_token_at is not None:
+        phases['decode'] = gen_request.finished_at - gen_request.first_token_at
+        result['time_to_first_token_ms'] = round((gen_request.first_token_at - received_at) * 1000, 2)
+        if len(gen_request.output_ids) > 1:
+            result['per_output_token_ms'] = round(phases['decode'] * 1000 / (len(gen_request.output_ids) - 1), 2)
+    phases['detokenize'] = timings.get('detokenize')
+    phases['memory_trim'] = timings.get('memory_trim')
+    result.update({f'{name}_ms': round(seconds * 1000, 2) for name, seconds in phases.items() if seconds is not None})
+    result['output_tokens'] = len(gen_request.output_ids)
+    result['total_ms'] = round((time.monotonic() - received_at) * 1000, 2)
+    return result
+
+def server_timing_header(timings):
+    """Server-Timing value (name;dur=ms, ...) for the *_ms entries of request_timings()"""
+    return ', '.join(f"{name[:-3]};dur={value}" for name, value in timings.items() if name.endswith('_ms'))
+
+def deterministic_key(entry, gen_request):
+    """Key of gen_request's output for the response cache and coalescing, or None when it may differ between runs.
+
+    Sampling without a seed is exempt, and so are models whose weights
+    cannot be identified. Settings that greedy decoding ignores are left out
+    of the key, so greedy requests match regardless of temperature or top_p.
+    """
+    if entry.revision is None or not cacheable(gen_request.temperature, gen_request.seed):
+        return None
+    greedy = gen_request.greedy
+    params = {
+        'max_new_tokens': gen_request.max_new_tokens,
+        'temperature': 0 if greedy else gen_request.temperature,
+        'top_p': None if greedy else gen_request.top_p,
+        'top_k': None if greedy else gen_request.top_k,
+        'min_p': None if greedy else gen_request.min_p,
+        'seed': None if greedy else gen_request.seed,
+        'quantization': entry.quantization,
+        'draft': entry.draft_name if gen_request.speculative else None,
+    }
+    return response_key(entry.name, entry.revision, gen_request.input_ids, params)
+
+def local_timings(gen_request, received_at, output_tokens):
+    """Timings of a request answered without a scheduler run of its own (cache hit or coalesced follower)"""
+    timings = {f'{phase}_ms': round(seconds * 1000, 2) for phase, seconds in gen_request.timings.items()}
+    timings['output_tokens'] = output_tokens
+    timings['total_ms'] = round((time.monotonic() - received_at) * 1000, 2)
+    return timings
+
+def cached_response(key, gen_request, endpoint, received_at):
+    """Cached result for key, with timings, or None; counts a hit as a finished request"""
+    if key is None or state.responses is None:
+        return None
+    lookup_start = time.monotonic()
+    cached = state.responses.get(key)
+    if cached is None:
+        return None
+    gen_request.timings['cache_lookup'] = time.monotonic() - lookup_start
+    metrics.counter('requests_total', endpoint=endpoint, outcome='cached').inc()
+    print(f"✅ Response cache hit: '{cached['generated_text'][:100]}...'")
+    print(f"{'='*60}\n")
+    return dict(cached, timings=local_timings(gen_request, received_at, cached['tokens']))
+
+def store_response(key, gen_request, generated_text):
+    """Remember a finished deterministic request; cancelled or failed ones are never stored"""
+    if key is None or state.responses is None or gen_request.error is not None or gen_request.finish_reason not in ('stop', 'length'):
+        return
+    state.responses.put(key, {
+        'generated_text': generated_text,
+        'finish_reason': gen_request.finish_reason,
+        'tokens': len(gen_request.output_ids)
+    })
+
+def error_response(error, endpoint):
+    """JSON error reply; overload rejections carry their HTTP status and a Retry-After header"""
+    error = dict(error)
+    status_code = error.pop('status_code', 200)
+    metrics.counter('requests_total', endpoint=endpoint, outcome='rejected' if status_code in (429, 503) else 'error').inc()
+    retry_after = error.pop('retry_after', None)
+    headers = {'Retry-After': str(retry_after)} if retry_after is not None else {}
+    return jsonify(error), status_code, headers
+
+def submit_generation(entry, gen_request):
+    """Queue gen_request on entry's scheduler; returns an error dict when admission control turns it away"""
+    scheduler = entry.scheduler
     try:
-        if state.model is None or state.tokenizer is None:
-            return jsonify({
-                'success': False,
-                'error': 'No model loaded. Please load a model first.'
-            })
-        
-        data = request.get_json()
-        text = data['text']
-        max_new_tokens = min(data.get('max_new_tokens', 50), MAX_NEW_TOKENS)
-        temperature = data.get('temperature', 0.8)
-        top_p = data.get('top_p', 0.9)
-        
-        # Validate input length
-        if len(text) > 2000:
-            return jsonify({
-                'success': False,
-                'error': 'Input too long (>2000 characters)',
-                'suggestion': 'Please shorten your input to avoid CUDA memory errors'
-            })
-        
-        print(f"\n{'='*60}")
-        print(f"Generating text for: '{text[:50]}...'")
-        
-        # Check memory before generation
-        if torch.cuda.is_available():
-            allocated = torch.cuda.memory_allocated(0) / 1e9
-            total = torch.cuda.get_device_properties(0).total_memory / 1e9
-            free = total - allocated
-            if free < 1.0:  # Need at least 1GB free
-                cleanup_memory()
-                return jsonify({
-                    'success': False,
-                    'error': 'Low GPU memory before generation',
-                    'suggestion': 'Try clearing cache or using shorter input'
-                })
-        
-        # Tokenize with strict length limit
-        inputs = state.tokenizer(
-            text,
-            return_tensors='pt',
-            padding=True,
-            truncation=True,
-            max_length=MAX_INPUT_LENGTH
-        )
-        
-        if state.device == "cuda":
-            inputs = {k: v.to(state.device) for k, v in inputs.items()}
-        
-        input_length = inputs['input_ids'].shape[1]
-        print(f"Input tokens: {input_length} (max: {MAX_INPUT_LENGTH})")
-        
-        if input_length > MAX_INPUT_LENGTH:
+        if scheduler is None:
+            # Evicted or unloaded since generation_entry() handed it out
+            raise RuntimeError(f'{entry.name} is no longer on the GPU')
+        scheduler.submit(gen_request)
+    except QueueFull as e:
+        print(f"⚠️  Rejected {e.lane} request: {e}")
+        return {
+            'success': False,
+            'error': f'Server busy: {e}',
+            'suggestion': f'Retry in {e.retry_after}s' + (', or send bulk work with priority "batch"' if e.lane == 'interactive' else ''),
+            'status_code': 429,
+            'retry_after': e.retry_after
+        }
+    except RuntimeError as e:
+        # The scheduler stopped under us: the model is being unloaded or moved off the GPU
+        return {
+            'success': False,
+            'error': f'Model unavailable: {e}',
+            'suggestion': 'Retry shortly or load the model again',
+            'status_code': 503,
+            'retry_after': 5
+        }
+    return None
+
+def follow_or_submit(entry, gen_request, key, endpoint):
+    """(scheduler request that answers gen_request, error dict or None).
+
+    A deterministic request identical to one still running follows that
+    one instead of being queued; everything else is submitted as usual.
+    """
+    if key is None:
+        return gen_request, submit_generation(entry, gen_request)
+    shared, error = state.flights.join(key, gen_request, lambda r: submit_generation(entry, r))
+    if shared is not gen_request:
+        metrics.counter('coalesced_requests_total', endpoint=endpoint).inc()
+        print("✅ Attached to an identical in-flight request")
+    return shared, error
+
+def release_flight(key, shared):
+    """Stop following shared; True when no other client is waiting on it"""
+    return key is None or state.flights.leave(key, shared)
+
+def generation_error(error_msg):
+    """Map a generation failure to the JSON error the UI expects"""
+    if 'CUDA' in error_msg or 'out of memory' in error_msg:
+        metrics.counter('oom_total', phase='generate').inc()
+        cleanup_memory('oom')
+        return {
+            'success': False,
+            'error': 'GPU memory error during generation',
+            'suggestion': 'Try: 1) Shorter input, 2) Fewer max tokens, 3) Clear cache, or 4) Restart server'
+        }
+    return {
+        'success': False,
+        'error': error_msg,
+        'suggestion': 'Try reducing input length or max tokens'
+    }
+
+class IncrementalDetokenizer:
+    """Turn a growing list of token IDs into text deltas.
+
+    Only a short window of recent tokens is re-decoded per step, and output
+    is held back while the tail decodes to an incomplete UTF-8 sequence, so
+    multi-byte characters are never split across events.
+    """
+    
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+    
+    def push(self, token_id):
+        self.token_ids.append(token_id)
+        prefix_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:self.read_offset], skip_special_tokens=True)
+        new_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:], skip_special_tokens=True)
+        if len(new_text) > len(prefix_text) and not new_text.endswith('\ufffd'):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ''
+    
+    def flush(self):
+        """Emit whatever is still held back once generation has finished"""
+        if self.read_offset >= len(self.token_ids):
+            return ''
+        prefix_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:self.read_offset], skip_special_tokens=True)
+        new_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:], skip_special_tokens=True)
+        self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+def speculation_stats(gen_request):
+    """Per-request draft acceptance, or None when the request did not speculate"""
+    if not gen_request.speculative:
+        return None
+    return {
+        'drafted': gen_request.drafted,
+        'accepted': gen_request.draft_accepted,
+        'acceptance_rate': round(gen_request.draft_accepted / gen_request.drafted, 3) if gen_request.drafted else 0
+    }
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+@app.route('/generate', methods=['POST'])
+def generate():
+    received_at = time.monotonic()
+    try:
+        gen_request, entry, error = prepare_generation(request.get_json())
+        if error:
+            return error_response(error, 'generate')
+        cache_key = deterministic_key(entry, gen_request)
+        cached = cached_response(cache_key, gen_request, 'generate', received_at)
+        if cached is not None:
             return jsonify({
-                'success': False,
-                'error': f'Input too long: {input_length} tokens (max: {MAX_INPUT_LENGTH})',
-                'suggestion': 'Please use shorter input text'
-            })
+                'success': True,
+                'generated_text': cached['generated_text'],
+                'model': entry.name,
+                'speculative': None,
+                'cached': True,
+                'coalesced': False,
+                'timings': cached['timings']
+            }), 200, {'Server-Timing': server_timing_header(cached['timings'])}
+        shared, error = follow_or_submit(entry, gen_request, cache_key, 'generate')
+        if error:
+            return error_response(error, 'generate')
+        coalesced = shared is not gen_request
         
-        # Generate with safety limits
-        with torch.no_grad():
-            outputs = state.model.generate(
-                **inputs,
-                max_new_tokens=max_new_tokens,
-                temperature=temperature,
-                top_p=top_p,
-                do_sample=True,
-                pad_token_id=state.tokenizer.pad_token_id,
-                eos_token_id=state.tokenizer.eos_token_id,
-                repetition_penalty=1.1,
-                no_repeat_ngram_size=3
-            )
+        wait_start = time.monotonic()
+        try:
+            output_ids = shared.wait()
+        finally:
+            release_flight(cache_key, shared)
+        if coalesced:
+            gen_request.timings['coalesced_wait'] = time.monotonic() - wait_start
         
         # Decode only new tokens
-        generated_text = state.tokenizer.decode(outputs[0][input_length:], skip_special_tokens=True)
+        detokenize_start = time.monotonic()
+        generated_text = entry.tokenizer.decode(output_ids, skip_special_tokens=True)
+        gen_request.timings['detokenize'] = time.monotonic() - detokenize_start
+        if coalesced:
+            metrics.counter('requests_total', endpoint='generate', outcome='coalesced').inc()
+        else:
+            record_generation('generate', gen_request)
+            store_response(cache_key, gen_request, generated_text)
         
         print(f"Generated: '{generated_text[:100]}...'")
         print(f"{'='*60}\n")
         
-        # Clean up after generation
-        cleanup_memory()
+        # Keep the allocator's cache warm unless memory is tight, fragmented or a load is waiting
+        trim_start = time.monotonic()
+        state.memory.maybe_trim()
+        gen_request.timings['memory_trim'] = time.monotonic() - trim_start
         
+        if coalesced:
+            timings = local_timings(gen_request, received_at, len(output_ids))
+        else:
+            timings = request_timings(gen_request, received_at)
         return jsonify({
             'success': True,
-            'generated_text': generated_text
-        })
+            'generated_text': generated_text,
+            'model': entry.name,
+            'speculative': speculation_stats(shared),
+            'cached': False,
+            'coalesced': coalesced,
+            'timings': timings
+        }), 200, {'Server-Timing': server_timing_header(timings)}
         
     except RuntimeError as e:
         error_msg = str(e)
         print(f"❌ Runtime error: {error_msg}")
-        
-        # Handle CUDA errors specifically
-        if 'CUDA' in error_msg or 'out of memory' in error_msg:
-            cleanup_memory()
-            return jsonify({
-                'success': False,
-                'error': 'GPU memory error during generation',
-                'suggestion': 'Try: 1) Shorter input, 2) Fewer max tokens, 3) Clear cache, or 4) Restart server'
-            })
-        
-        return jsonify({
-            'success': False,
-            'error': error_msg,
-            'suggestion': 'Try reducing input length or max tokens'
-        })
+        metrics.counter('requests_total', endpoint='generate', outcome='error').inc()
+        return jsonify(generation_error(error_msg))
         
     except Exception as e:
         error_msg = str(e)
         print(f"❌ Error during generation: {error_msg}")
         traceback.print_exc()
+        metrics.counter('requests_total', endpoint='generate', outcome='error').inc()
         
         return jsonify({
             'success': False,
             'error': error_msg
         })
 
+@app.route('/generate_stream', methods=['POST'])
+def generate_stream():
+    """Same contract as /generate, but tokens are sent as server-sent events.
+
+    The response headers go out before decoding starts, so Server-Timing
+    only carries the pre-queue phases; the full breakdown is in the final
+    event's `timings`.
+    """
+    received_at = time.monotonic()
+    try:
+        gen_request, entry, error = prepare_generation(request.get_json())
+        if error:
+            return error_response(error, 'generate_stream')
+        cache_key = deterministic_key(entry, gen_request)
+        cached = cached_response(cache_key, gen_request, 'generate_stream', received_at)
+        shared = None
+        if cached is None:
+            # A follower replays the shared request's tokens from the start, however far it has got
+            shared, error = follow_or_submit(entry, gen_request, cache_key, 'generate_stream')
+            if error:
+                return error_response(error, 'generate_stream')
+    except Exception as e:
+        traceback.print_exc()
+        metrics.counter('requests_total', endpoint='generate_stream', outcome='error').inc()
+        return jsonify({'success': False, 'error': str(e)})
+    
+    def replay():
+        # A cache hit arrives as one text event, then the usual final event
+        if cached['generated_text']:
+            yield sse_event({'text': cached['generated_text']})
+        yield sse_event({
+            'done': True,
+            'success': True,
+            'finish_reason': cached['finish_reason'],
+            'generated_text': cached['generated_text'],
+            'model': entry.name,
+            'tokens': cached['tokens'],
+            'time_to_first_token': None,
+            'speculative': None,
+            'cached': True,
+            'coalesced': False,
+            'timings': cached['timings']
+        })
+    
+    def events():
+        coalesced = shared is not gen_request
+        follow_start = time.monotonic()
+        first_token_at = None
+        detokenizer = IncrementalDetokenizer(entry.tokenizer)
+        pieces = []
+        detokenize_seconds = 0.0
+        try:
+            for token_id in shared.iter_tokens():
+                first_token_at = first_token_at or time.monotonic()
+                detokenize_start = time.monotonic()
+                delta = detokenizer.push(token_id)
+                detokenize_seconds += time.monotonic() - detokenize_start
+                if delta:
+                    pieces.append(delta)
+                    flush_start = time.monotonic()
+                    yield sse_event({'text': delta})
+                    shared.trace_span('stream flush', flush_start, time.monotonic(), chars=len(delta))
+            tail = detokenizer.flush()
+            if tail:
+                pieces.append(tail)
+                yield sse_event({'text': tail})
+            gen_request.timings['detokenize'] = detokenize_seconds
+            generated_text = ''.join(pieces)
+            if coalesced:
+                gen_request.timings['coalesced_wait'] = time.monotonic() - follow_start - detokenize_seconds
+                metrics.counter('requests_total', endpoint='generate_stream', outcome='coalesced').inc()
+                timings = local_timings(gen_request, received_at, len(shared.output_ids))
+                ttft = round(first_token_at - follow_start, 4) if first_token_at is not None else None
+            else:
+                record_generation('generate_stream', gen_request)
+                store_response(cache_key, gen_request, generated_text)
+                timings = request_timings(gen_request, received_at)
+                ttft = None
+                if gen_request.first_token_at is not None:
+                    ttft = round(gen_request.first_token_at - gen_request.submitted_at, 4)
+            
+            print(f"Streamed: '{generated_text[:100]}...'")
+            print(f"{'='*60}\n")
+            yield sse_event({
+                'done': True,
+                'success': True,
+                'finish_reason': shared.finish_reason,
+                'generated_text': generated_text,
+                'model': entry.name,
+                'tokens': len(shared.output_ids),
+                'time_to_first_token': ttft,
+                'speculative': speculation_stats(shared),
+                'cached': False,
+                'coalesced': coalesced,
+                'timings': timings
+            })
+        except RuntimeError as e:
+            print(f"❌ Runtime error: {e}")
+            metrics.counter('requests_total', endpoint='generate_stream', outcome='error').inc()
+            yield sse_event(dict(generation_error(str(e)), done=True))
+        except Exception as e:
+            print(f"❌ Error during streaming: {e}")
+            traceback.print_exc()
+            metrics.counter('requests_total', endpoint='generate_stream', outcome='error').inc()
+            yield sse_event({'done': True, 'success': False, 'error': str(e)})
+        finally:
+            # Client went away (tunnel drop, tab closed) - stop spending GPU on it, unless another client still follows it
+            if release_flight(cache_key, shared) and not shared.done:
+                shared.cancel()
+            state.memory.maybe_trim()
+    
+    return Response(
+        stream_with_context(events() if cached is None else replay()),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+            'Server-Timing': server_timing_header(cached['timings'] if cached is not None else
+                                                  request_timings(gen_request, received_at))
+        }
+    )
+
+# ----------------------------------------------------------------------
+# OpenAI-compatible API
+# ----------------------------------------------------------------------
+
+def openai_error_response(error):
+    headers = {'Retry-After': str(error.retry_after)} if error.retry_after is not None else {}
+    return jsonify(error.body()), error.status_code, headers
+
+def openai_entry(requested_model):
+    """Pool entry for an OpenAI request; unknown model names fall back to the default model"""
+    if requested_model not in state.pool:
+        requested_model = None
+    entry, error = generation_entry(requested_model)
+    if error:
+        if error.get('status_code') == 503:
+            raise OpenAIError(error['error'], status_code=503, error_type='server_error',
+                              retry_after=error.get('retry_after'))
+        raise OpenAIError(error['error'], param='model', status_code=error.get('status_code', 404),
+                          error_type='model_not_loaded', code='model_not_found')
+    return entry
+
+def submit_all(entry, gen_requests):
+    """Queue every choice, or none of them: a rejection cancels the ones already queued"""
+    for submitted, gen_request in enumerate(gen_requests):
+        error = submit_generation(entry, gen_request)
+        if error:
+            for queued in gen_requests[:submitted]:
+                queued.cancel()
+            raise OpenAIError(error['error'], status_code=error.get('status_code', 503),
+                              error_type='server_busy' if error.get('status_code') == 429 else 'server_error',
+                              retry_after=error.get('retry_after'))
+
+def stream_choice(index, gen_request, tokenizer, stops, events):
+    """Detokenize one choice on its own thread; puts (index, text, tokens consumed, finish_reason, error) on events"""
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    scanner = StopScanner(stops)
+    consumed = 0
+    detokenize_seconds = 0.0
+    try:
+        for token_id in gen_request.iter_tokens():
+            if scanner.stopped:
+                continue  # cancelled; the scheduler drops it at its next step
+            consumed += 1
+            detokenize_start = time.monotonic()
+            text = scanner.feed(detokenizer.push(token_id))
+            detokenize_seconds += time.monotonic() - detokenize_start
+            if scanner.stopped:
+                # Matched a stop string - no need to generate the rest
+                gen_request.cancel()
+            elif text:
+                events.put((index, text, consumed, None, None))
+        if not scanner.stopped:
+            text = scanner.feed(detokenizer.flush(), final=True)
+        gen_request.timings['detokenize'] = detokenize_seconds
+        reason = 'stop' if scanner.stopped or gen_request.finish_reason == 'stop' else 'length'
+        events.put((index, text, consumed, reason, None))
+    except Exception as e:
+        events.put((index, '', consumed, None, e))
+
+def openai_logprobs(kind, tokenizer, gen_request, start, end):
+    if gen_request.logprobs is None:
+        return None
+    token_ids = gen_request.output_ids[start:end]
+    entries = gen_request.token_logprobs[start:end]
+    if kind == 'chat':
+        return chat_logprobs(tokenizer, entries, token_ids)
+    return completion_logprobs(tokenizer, entries, token_ids)
+
+def openai_generate(kind):
+    """Shared body of /v1/completions and /v1/chat/completions"""
+    received_at = time.monotonic()
+    endpoint = 'chat_completions' if kind == 'chat' else 'completions'
+    try:
+        if state.demo_mode:
+            raise OpenAIError('Demo mode active - text generation not available', status_code=503, error_type='server_error')
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            raise OpenAIError('Request body must be a JSON object')
+        params = sampling_params(data, kind, MAX_NEW_TOKENS)
+        entry = openai_entry(data.get('model'))
+        
+        tokenize_start = time.monotonic()
+        if kind == 'chat':
+            prompts = [state.chat_prompts.render(entry.name, entry.tokenizer, chat_messages(data))]
+        else:
+            prompts = [p if isinstance(p, list) else entry.tokenizer(p)['input_ids'] for p in completion_prompts(data)]
+        tokenize_seconds = (time.monotonic() - tokenize_start) / len(prompts)
+        for ids in prompts:
+            if len(ids) > MAX_INPUT_LENGTH:
+                raise OpenAIError(f'Prompt is {len(ids)} tokens; the maximum is {MAX_INPUT_LENGTH}',
+                                  param='messages' if kind == 'chat' else 'prompt', code='context_length_exceeded')
+        
+        memory_check_start = time.monotonic()
+        error = memory_precheck()
+        if error:
+            raise OpenAIError(error['error'], status_code=503, error_type='server_error')
+        memory_check_seconds = time.monotonic() - memory_check_start
+        
+        gen_requests = []
+        for ids in prompts:
+            for choice in range(params['n']):
+                gen_request = GenerationRequest(
+                    ids,
+                    max_new_tokens=params['max_tokens'],
+                    temperature=params['temperature'],
+                    top_p=params['top_p'],
+                    top_k=params['top_k'],
+                    min_p=params['min_p'],
+                    eos_token_id=entry.tokenizer.eos_token_id,
+                    speculative=entry.draft_model is not None,
+                    logprobs=params['logprobs'],
+                    # Choices of one seeded request must still differ from each other
+                    seed=None if params['seed'] is None else params['seed'] + choice
+                )
+                gen_request.timings.update(tokenize=tokenize_seconds, memory_check=memory_check_seconds)
+                gen_requests.append(gen_request)
+        submit_all(entry, gen_requests)
+    except OpenAIError as e:
+        metrics.counter('requests_total', endpoint=endpoint,
+                        outcome='rejected' if e.status_code in (429, 503) else 'error').inc()
+        return openai_error_response(e)
+    except Exception as e:
+        traceback.print_exc()
+        metrics.counter('requests_total', endpoint=endpoint, outcome='error').inc()
+        return openai_error_response(OpenAIError(str(e), status_code=500, error_type='server_error'))
+    
+    events = queue.Queue()
+    for index, gen_request in enumerate(gen_requests):
+        threading.Thread(target=stream_choice, args=(index, gen_request, entry.tokenizer, params['stop'], events),
+                         name='openai-choice', daemon=True).start()
+    response_id = request_id(kind)
+    prompt_tokens = sum(len(ids) for ids in prompts)
+    
+    def finish(consumed):
+        # gen_requests holds the n choices of each prompt back to back
+        finished_at = max(gen_request.finished_at for gen_request in gen_requests)
+        for index, gen_request in enumerate(gen_requests):
+            record_generation(endpoint, gen_request, count_request=index == 0, count_prompt=index % params['n'] == 0,
+                              finished_at=finished_at)
+        state.memory.maybe_trim()
+        return usage(prompt_tokens, sum(consumed))
+    
+    if not params['stream']:
+        texts = [''] * len(gen_requests)
+        consumed = [0] * len(gen_requests)
+        reasons = [None] * len(gen_requests)
+        try:
+            while None in reasons:
+                index, text, count, reason, error = events.get()
+                if error is not None:
+                    raise error
+                texts[index] += text
+                consumed[index] = count
+                reasons[index] = reason
+        except Exception as e:
+            for gen_request in gen_requests:
+                gen_request.cancel()
+            print(f"❌ Error during generation: {e}")
+            metrics.counter('requests_total', endpoint=endpoint, outcome='error').inc()
+            return openai_error_response(OpenAIError(generation_error(str(e))['error'], status_code=500,
+                                                     error_type='server_error'))
+        choices = [{
+            'index': index,
+            'text': texts[index],
+            'finish_reason': reasons[index],
+            'logprobs': openai_logprobs(kind, entry.tokenizer, gen_request, 0, consumed[index]),
+        } for index, gen_request in enumerate(gen_requests)]
+        usage_info = finish(consumed)
+        timings = request_timings(gen_requests[0], received_at)
+        return jsonify(response_body(kind, response_id, entry.name, choices, usage_info)), 200, {
+            'Server-Timing': server_timing_header(timings)
+        }
+    
+    def stream():
+        consumed = [0] * len(gen_requests)
+        finished = [False] * len(gen_requests)
+        try:
+            while not all(finished):
+                index, text, count, reason, error = events.get()
+                if error is not None:
+                    raise error
+                logprobs = openai_logprobs(kind, entry.tokenizer, gen_requests[index], consumed[index], count)
+                chunk = chunk_body(kind, response_id, entry.name, index, text, reason, logprobs,
+                                   first=consumed[index] == 0)
+                consumed[index] = count
+                finished[index] = reason is not None
+                yield sse_event(chunk)
+            usage_info = finish(consumed)
+            if params['include_usage']:
+                yield sse_event({'id': response_id, 'object': 'chat.completion.chunk' if kind == 'chat' else 'text_completion',
+                                 'created': int(time.time()), 'model': entry.name, 'choices': [], 'usage': usage_info})
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            print(f"❌ Error during streaming: {e}")
+            metrics.counter('requests_total', endpoint=endpoint, outcome='error').inc()
+            yield sse_event(OpenAIError(str(e), status_code=500, error_type='server_error').body())
+        finally:
+            # Client went away or a choice failed - stop spending GPU on the rest
+            for gen_request in gen_requests:
+                if not gen_request.done:
+                    gen_request.cancel()
+    
+    return Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/v1/models')
+def openai_models():
+    return jsonify({
+        'object': 'list',
+        'data': [{
+            'id': name,
+            'object': 'model',
+            'created': int(state.pool.entries[name].loaded_at),
+            'owned_by': 'lmstudio'
+        } for name in state.pool.names()]
+    })
+
+@app.route('/v1/completions', methods=['POST'])
+def openai_completions():
+    """OpenAI text completions: prompt, max_tokens, temperature, top_p, n, stop, logprobs, stream"""
+    return openai_generate('completions')
+
+@app.route('/v1/chat/completions', methods=['POST'])
+def openai_chat_completions():
+    """OpenAI chat completions: messages rendered through the model's chat template"""
+    return openai_generate('chat')
+
 if __name__ == '__main__':
     print("\n" + "="*60)
     print("🚀 Starting LM Studio Server v3 - Improved")
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Background Model Loading for LM Studio Server v3
+- /load_model hands back a job ID instead of blocking the request
+- One loader thread works through jobs in order
+- Jobs report phase, bytes loaded and throughput while they run
+"""
+
+import itertools
+import os
+import queue
+import threading
+import time
+
+import psutil
+import torch
+
+
+def loaded_bytes():
+    """Memory currently held by model weights: all GPUs, or process RSS without CUDA"""
+    if torch.cuda.is_available():
+        return sum(torch.cuda.memory_allocated(i) for i in range(torch.cuda.device_count()))
+    return psutil.Process().memory_info().rss
+
+
+def directory_bytes(path):
+    """Total size of the files under path (0 if it does not exist yet)"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class LoadJob:
+    """One queued or running model load"""
+
+    PHASES = ('queued', 'staging', 'tokenizer', 'weights', 'placement', 'ready', 'failed')
+
+    def __init__(self, job_id, model_name, force_download=False, total_bytes=0, download_dir=None, draft_model=None,
+                 quantization=None):
+        self.job_id = job_id
+        self.model_name = model_name
+        self.draft_model = draft_model
+        self.quantization = quantization
+        self.force_download = force_download
+        self.total_bytes = total_bytes
+        self.download_dir = download_dir
+        self.phase = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.phase_started_at = {}
+        self.result = None
+        self.error = None
+        self.suggestion = None
+        self._base_loaded = 0
+        self._base_downloaded = 0
+        self._final_bytes = None
+        self._final_downloaded = None
+
+    @property
+    def done(self):
+        return self.phase in ('ready', 'failed')
+
+    def set_phase(self, phase):
+        now = time.time()
+        if self.started_at is None:
+            self.started_at = now
+            if self.download_dir:
+                self._base_downloaded = directory_bytes(self.download_dir)
+        if phase == 'weights':
+            self._base_loaded = loaded_bytes()
+        elif phase == 'placement':
+            self._final_bytes = self.bytes_loaded()
+        self.phase = phase
+        self.phase_started_at[phase] = now
+        print(f"   [load {self.job_id}] {phase}")
+
+    def bytes_loaded(self):
+        if self._final_bytes is not None:
+            return self._final_bytes
+        if self.phase != 'weights':
+            return 0
+        current = max(0, loaded_bytes() - self._base_loaded)
+        return min(current, self.total_bytes) if self.total_bytes else current
+
+    def bytes_downloaded(self):
+        if self._final_downloaded is not None:
+            return self._final_downloaded
+        if not self.download_dir or self.started_at is None:
+            return 0
+        return max(0, directory_bytes(self.download_dir) - self._base_downloaded)
+
+    def finish(self, result):
+        self._final_downloaded = self.bytes_downloaded()
+        self.result = result
+        self.finished_at = time.time()
+        self.set_phase('ready')
+
+    def fail(self, error, suggestion=None):
+        self._final_bytes = self.bytes_loaded()
+        self._final_downloaded = self.bytes_downloaded()
+        self.error = error
+        self.suggestion = suggestion
+        self.finished_at = time.time()
+        self.set_phase('failed')
+
+    def stats(self):
+        now = time.time()
+        weights_started = self.phase_started_at.get('weights')
+        weights_ended = self.phase_started_at.get('placement') or self.finished_at or now
+        weights_seconds = (weights_ended - weights_started) if weights_started else 0
+        loaded = self.bytes_loaded()
+        stats = {
+            'job_id': self.job_id,
+            'model_name': self.model_name,
+            'draft_model': self.draft_model,
+            'quantization': self.quantization,
+            'phase': self.phase,
+            'done': self.done,
+            'bytes_loaded': loaded,
+            'total_bytes': self.total_bytes,
+            'progress': round(loaded / self.total_bytes, 3) if self.total_bytes else None,
+            'bytes_downloaded': self.bytes_downloaded(),
+            'throughput_gbps': round(loaded / weights_seconds / 1e9, 3) if weights_seconds > 0 else 0,
+            'queued_seconds': round((self.started_at or now) - self.created_at, 2),
+            'elapsed_seconds': round((self.finished_at or now) - self.started_at, 2) if self.started_at else 0,
+        }
+        if self.result is not None:
+            stats['result'] = self.result
+        if self.error is not None:
+            stats['error'] = self.error
+            stats['suggestion'] = self.suggestion
+        return stats
+
+
+class LoadJobQueue:
+    """Runs `run_job(job)` for each submitted job on a single background thread.
+
+    `run_job` returns the result dict for a successful load and raises on
+    failure; `describe_error(message)` turns the failure into a suggestion.
+    `on_finish(job)` runs after every job, successful or not.
+    Submitting a model that is already queued or loading returns the
+    existing job instead of starting a second one.
+    """
+
+    def __init__(self, run_job, describe_error=None, max_history=50, on_finish=None):
+        self.run_job = run_job
+        self.describe_error = describe_error
+        self.on_finish = on_finish
+        self.max_history = max_history
+        self.jobs = {}
+        self.current = None
+        self._ids = itertools.count(1)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, model_name, force_download=False, total_bytes=0, download_dir=None, draft_model=None,
+               quantization=None):
+        with self._lock:
+            for job in self.jobs.values():
+                if (job.model_name == model_name and not job.done and job.force_download == force_download
+                        and job.draft_model == draft_model and job.quantization == quantization):
+                    return job
+            job = LoadJob(str(next(self._ids)), model_name, force_download, total_bytes, download_dir, draft_model,
+                          quantization)
+            self.jobs[job.job_id] = job
+            self._trim()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='model-loader', daemon=True)
+                self._thread.start()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def busy(self):
+        return self.current is not None or not self._queue.empty()
+
+    def pending(self):
+        return [job for job in self.jobs.values() if not job.done]
+
+    def _trim(self):
+        finished = [job for job in self.jobs.values() if job.done]
+        for job in finished[:max(0, len(self.jobs) - self.max_history)]:
+            del self.jobs[job.job_id]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            self.current = job
+            try:
+                job.finish(self.run_job(job))
+            except Exception as e:
+                error_msg = str(e)
+                suggestion = self.describe_error(error_msg) if self.describe_error else None
+                job.fail(error_msg, suggestion)
+            finally:
+                self.current = None
+            if self.on_finish is not None:
+                try:
+                    self.on_finish(job)
+                except Exception as e:
+                    print(f"⚠️  Load job hook failed: {e}")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Batched Repetition Controls for the v3 Scheduler
+- Drop-in equivalents of transformers' RepetitionPenaltyLogitsProcessor and NoRepeatNGramLogitsProcessor
+- Each sequence keeps an n-gram table that is extended by the tokens added since the last step, never rebuilt
+- Penalties and bans for the whole decode batch are applied with one gather/scatter and one index_put
+"""
+
+import torch
+
+
+class TokenHistory:
+    """Incremental index over one sequence's token IDs (prompt and output).
+
+    `ngrams` maps each (n-1)-token prefix seen so far to the tokens that
+    followed it, and `unique` holds every distinct token, in order of first
+    appearance, as a CPU tensor that only grows when a new token shows up.
+    update() indexes the tokens appended since the last call.
+    Lookups accept a history that runs past the indexed part (speculative
+    drafts that may still be rejected); that tail is scanned directly and
+    never enters the index.
+    """
+
+    def __init__(self, ngram_size):
+        self.ngram_size = ngram_size
+        self.length = 0
+        self.ngrams = {}
+        self.unique = torch.empty(0, dtype=torch.long)
+        self._seen = set()
+
+    def update(self, token_ids):
+        """Index token_ids[self.length:]; token_ids must extend what was indexed before"""
+        n = self.ngram_size
+        new = []
+        for position in range(self.length, len(token_ids)):
+            token = token_ids[position]
+            if token not in self._seen:
+                self._seen.add(token)
+                new.append(token)
+            if n and position >= n - 1:
+                self.ngrams.setdefault(tuple(token_ids[position - n + 1:position]), set()).add(token)
+        if new:
+            self.unique = torch.cat([self.unique, torch.tensor(new, dtype=torch.long)])
+        self.length = len(token_ids)
+
+    def tokens(self, token_ids):
+        """Distinct tokens of token_ids (which starts with the indexed history) as a 1-D tensor"""
+        tail = [token for token in dict.fromkeys(token_ids[self.length:]) if token not in self._seen]
+        return torch.cat([self.unique, torch.tensor(tail, dtype=torch.long)]) if tail else self.unique
+
+    def banned(self, token_ids):
+        """Tokens that would complete an n-gram already present in token_ids"""
+        n = self.ngram_size
+        if not n or len(token_ids) + 1 < n:
+            return []
+        prefix = tuple(token_ids[len(token_ids) - n + 1:])
+        banned = set(self.ngrams.get(prefix, ()))
+        for position in range(max(self.length, n - 1), len(token_ids)):
+            if tuple(token_ids[position - n + 1:position]) == prefix:
+                banned.add(token_ids[position])
+        return list(banned)
+
+
+def apply_repetition_penalty(scores, token_lists, penalty):
+    """In place on `[batch, vocab]` scores: divide positive (multiply negative) logits of every listed token.
+
+    token_lists holds one 1-D tensor of distinct token IDs per row. Short
+    rows are padded with their own first token, so the scatter only ever
+    writes identical values to a repeated index; empty rows are padded with
+    token 0 and masked.
+    """
+    width = max((len(tokens) for tokens in token_lists), default=0)
+    if width == 0:
+        return scores
+    index = torch.zeros((len(token_lists), width), dtype=torch.long)
+    empty = []
+    for row, tokens in enumerate(token_lists):
+        if len(tokens):
+            index[row, :len(tokens)] = tokens
+            index[row, len(tokens):] = tokens[0]
+        else:
+            empty.append(row)
+    index = index.to(scores.device)
+    gathered = scores.gather(1, index)
+    penalized = torch.where(gathered < 0, gathered * penalty, gathered / penalty)
+    if empty:
+        penalized[empty] = gathered[empty]
+    return scores.scatter_(1, index, penalized)
+
+
+def apply_bans(scores, banned_lists):
+    """In place on `[batch, vocab]` scores: set every banned token of every row to -inf"""
+    rows = [row for row, banned in enumerate(banned_lists) for _ in banned]
+    if not rows:
+        return scores
+    cols = [token for banned in banned_lists for token in banned]
+    scores[torch.tensor(rows, device=scores.device), torch.tensor(cols, device=scores.device)] = float('-inf')
+    return scores
+
+
+class RepetitionControls:
+    """Repetition penalty and n-gram blocking for a whole batch of sequences.
+
+    Scores match the transformers processors applied one after the other
+    (penalty first) to each row with its full history.
+    """
+
+    def __init__(self, repetition_penalty=1.0, no_repeat_ngram_size=0):
+        self.repetition_penalty = repetition_penalty
+        self.no_repeat_ngram_size = no_repeat_ngram_size
+
+    @property
+    def enabled(self):
+        return self.repetition_penalty != 1.0 or bool(self.no_repeat_ngram_size)
+
+    def history(self):
+        """Fresh per-sequence index for this configuration"""
+        return TokenHistory(self.no_repeat_ngram_size)
+
+    def __call__(self, histories, token_lists, scores):
+        """Penalized copy of `[batch, vocab]` scores; histories[i] indexes (a prefix of) token_lists[i]"""
+        if not self.enabled:
+            return scores
+        scores = scores.clone()
+        if self.repetition_penalty != 1.0:
+            apply_repetition_penalty(scores, [h.tokens(ids) for h, ids in zip(histories, token_lists)],
+                                     self.repetition_penalty)
+        if self.no_repeat_ngram_size:
+            apply_bans(scores, [h.banned(ids) for h, ids in zip(histories, token_lists)])
+        return scores
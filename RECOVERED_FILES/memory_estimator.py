@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Config-Driven Memory Estimator for the LM Studio Servers
+- Weights from safetensors headers when the checkpoint is cached, else from config.json
+- KV cache per token from layers x KV heads x head dim
+- Activation and CUDA context overhead for a prefill of the requested length
+"""
+
+import json
+import os
+import struct
+
+from model_staging import find_snapshot
+
+DTYPE_BYTES = {
+    'float32': 4, 'float16': 2, 'bfloat16': 2,
+    'int8': 1, 'fp8': 1, 'int4': 0.5,
+}
+QUANTIZATION_GROUP_SIZE = 128  # input channels sharing one int4 scale (quantization.DEFAULT_GROUP_SIZE); int8 / fp8 scale per row
+SAFETENSORS_DTYPE_BYTES = {
+    'F64': 8, 'F32': 4, 'F16': 2, 'BF16': 2, 'I64': 8, 'I32': 4, 'I16': 2, 'I8': 1, 'U8': 1, 'BOOL': 1,
+    'F8_E4M3': 1, 'F8_E5M2': 1,
+}
+GATED_ACTIVATIONS = ('silu', 'swiglu', 'geglu')
+GATED_MODEL_TYPES = ('gemma', 'gemma2')
+LEARNED_POSITION_MODEL_TYPES = ('gpt2', 'gpt_bigcode', 'gpt_neo', 'opt', 'biogpt')
+CUDA_CONTEXT_GB = 0.5
+
+
+def _get(config, *names, default=None):
+    """First of several alias keys present in a config dict (GPT-2 and Llama name things differently)"""
+    for name in names:
+        if config.get(name) is not None:
+            return config[name]
+    return default
+
+
+def load_config(model_name, hf_home, allow_download=True):
+    """config.json for model_name from the local cache, or fetched from the Hub (None if unavailable)"""
+    snapshot = find_snapshot(model_name, hf_home)
+    path = os.path.join(snapshot, 'config.json') if snapshot else None
+    if (path is None or not os.path.exists(path)) and allow_download:
+        try:
+            from huggingface_hub import hf_hub_download
+            path = hf_hub_download(model_name, 'config.json', cache_dir=os.path.join(hf_home, 'hub'),
+                                   token=os.environ.get('HF_TOKEN') or os.environ.get('HUGGINGFACE_TOKEN'))
+        except Exception as e:
+            print(f"Could not fetch config.json for {model_name}: {e}")
+            return None
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        config = json.load(f)
+    # Multimodal wrappers keep the language model under text_config
+    if 'text_config' in config and 'num_hidden_layers' not in config:
+        config = dict(config['text_config'], **{k: v for k, v in config.items() if k != 'text_config'})
+    return config
+
+
+def safetensors_weights(snapshot):
+    """(parameter count, bytes) read from the shard headers, or None if the snapshot has no safetensors"""
+    if snapshot is None:
+        return None
+    shards = [f for f in os.listdir(snapshot) if f.endswith('.safetensors')]
+    if not shards:
+        return None
+    params = 0
+    nbytes = 0
+    for shard in shards:
+        with open(os.path.join(snapshot, shard), 'rb') as f:
+            header_len = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(header_len))
+        for name, info in header.items():
+            if name == '__metadata__':
+                continue
+            count = 1
+            for dim in info['shape']:
+                count *= dim
+            params += count
+            nbytes += count * SAFETENSORS_DTYPE_BYTES.get(info['dtype'], 2)
+    return params, nbytes
+
+
+def config_dims(config):
+    """Architecture sizes under their common names"""
+    hidden = _get(config, 'hidden_size', 'n_embd', 'd_model')
+    heads = _get(config, 'num_attention_heads', 'n_head', 'num_heads')
+    dims = {
+        'hidden': hidden,
+        'layers': _get(config, 'num_hidden_layers', 'n_layer', 'num_layers'),
+        'heads': heads,
+        'kv_heads': _get(config, 'num_key_value_heads', 'multi_query_group_num', default=heads),
+        'head_dim': _get(config, 'head_dim', default=hidden // heads if hidden and heads else None),
+        'intermediate': _get(config, 'intermediate_size', 'n_inner', 'ffn_dim', default=4 * hidden if hidden else None),
+        'vocab': _get(config, 'vocab_size', default=32000),
+        'experts': _get(config, 'num_local_experts', 'num_experts', default=1),
+        'max_positions': _get(config, 'max_position_embeddings', 'n_positions', 'max_sequence_length'),
+    }
+    if config.get('multi_query') and 'num_key_value_heads' not in config:
+        dims['kv_heads'] = 1
+    return dims
+
+
+def linear_params_from_config(config):
+    """Parameters in the decoder layers' linear projections - the part weight-only quantization shrinks"""
+    d = config_dims(config)
+    hidden, head_dim = d['hidden'], d['head_dim']
+    attention = hidden * head_dim * (2 * d['heads'] + 2 * d['kv_heads'])
+    gated = (str(config.get('hidden_act', config.get('activation_function', ''))) in GATED_ACTIVATIONS
+             or config.get('model_type') in GATED_MODEL_TYPES)
+    mlp = (3 if gated else 2) * hidden * d['intermediate'] * d['experts']
+    return d['layers'] * (attention + mlp)
+
+
+def params_from_config(config):
+    """Parameter count for a decoder-only transformer described by config"""
+    d = config_dims(config)
+    hidden = d['hidden']
+    embeddings = d['vocab'] * hidden
+    if config.get('model_type') in LEARNED_POSITION_MODEL_TYPES and d['max_positions']:
+        embeddings += d['max_positions'] * hidden
+    lm_head = 0 if config.get('tie_word_embeddings', True) else d['vocab'] * hidden
+    return linear_params_from_config(config) + d['layers'] * 4 * hidden + embeddings + lm_head
+
+
+def estimate_memory(config, dtype='float16', quantization=None, context_tokens=2048, batch_size=1,
+                    snapshot=None, kv_dtype=None):
+    """Memory needed to serve a model: weights, KV cache and prefill activations (all in bytes and GB).
+
+    quantization ('int8', 'int4', 'fp8') applies to the decoder's linear
+    layers, which also carry one dtype-sized scale per group of input
+    channels; embeddings, norms and the head stay in dtype. kv_dtype
+    defaults to dtype because the KV cache is kept unquantized.
+    """
+    d = config_dims(config)
+    weight_dtype = quantization or dtype
+    from_headers = safetensors_weights(snapshot)
+    if from_headers is not None:
+        num_params, _ = from_headers
+        source = 'safetensors'
+    else:
+        num_params = params_from_config(config)
+        source = 'config'
+    if quantization:
+        linear = min(linear_params_from_config(config), num_params)
+        scale_group = QUANTIZATION_GROUP_SIZE if quantization == 'int4' else (d['hidden'] or QUANTIZATION_GROUP_SIZE)
+        weight_bytes = int((num_params - linear) * DTYPE_BYTES[dtype] + linear * DTYPE_BYTES[quantization]
+                           + linear / scale_group * DTYPE_BYTES[dtype])
+    else:
+        weight_bytes = int(num_params * DTYPE_BYTES[dtype])
+
+    kv_bytes_per_token = int(2 * d['layers'] * d['kv_heads'] * d['head_dim'] * DTYPE_BYTES[kv_dtype or dtype])
+    if d['max_positions']:
+        context_tokens = min(context_tokens, d['max_positions'])
+    kv_bytes = kv_bytes_per_token * context_tokens * batch_size
+
+    # Prefill peak: a few hidden-sized buffers plus the MLP expansion per token, and fp32 logits
+    act_dtype = DTYPE_BYTES[dtype]
+    prefill_tokens = context_tokens * batch_size
+    activation_bytes = int(prefill_tokens * (4 * d['hidden'] + 2 * d['intermediate']) * act_dtype
+                           + prefill_tokens * d['vocab'] * 4)
+    overhead_bytes = int(CUDA_CONTEXT_GB * 1e9)
+    total = weight_bytes + kv_bytes + activation_bytes + overhead_bytes
+
+    return {
+        'params': round(num_params / 1e9, 2),
+        'param_count': num_params,
+        'source': source,
+        'dtype': weight_dtype,
+        'layers': d['layers'],
+        'weights_gb': round(weight_bytes / 1e9, 2),
+        'kv_cache_per_token_kb': round(kv_bytes_per_token / 1e3, 1),
+        'kv_cache_gb': round(kv_bytes / 1e9, 2),
+        'activation_gb': round(activation_bytes / 1e9, 2),
+        'overhead_gb': CUDA_CONTEXT_GB,
+        'context_tokens': context_tokens,
+        'batch_size': batch_size,
+        'memory_gb': round(total / 1e9, 1),
+        'weight_bytes': weight_bytes,
+        'kv_bytes_per_token': kv_bytes_per_token,
+        'activation_bytes_per_token': int((4 * d['hidden'] + 2 * d['intermediate']) * act_dtype + d['vocab'] * 4),
+    }
+
+
+def estimate_model_memory(model_name, hf_home, dtype='float16', quantization=None, context_tokens=2048,
+                          batch_size=1, allow_download=True):
+    """estimate_memory() for a model name, or the old 'unknown' result when its config cannot be found"""
+    config = load_config(model_name, hf_home, allow_download=allow_download)
+    if config is None:
+        return {'params': 'unknown', 'memory_gb': 'unknown'}
+    try:
+        return estimate_memory(config, dtype=dtype, quantization=quantization, context_tokens=context_tokens,
+                               batch_size=batch_size, snapshot=find_snapshot(model_name, hf_home))
+    except (KeyError, TypeError, ZeroDivisionError) as e:
+        print(f"Could not estimate memory for {model_name}: {e}")
+        return {'params': 'unknown', 'memory_gb': 'unknown'}
+
+
+def max_concurrent_batch(estimate, kv_budget_bytes, context_tokens):
+    """How many sequences of context_tokens have room for their KV cache in kv_budget_bytes"""
+    per_sequence = estimate['kv_bytes_per_token'] * context_tokens
+    if per_sequence <= 0 or kv_budget_bytes <= 0:
+        return 0
+    return int(kv_budget_bytes // per_sequence)
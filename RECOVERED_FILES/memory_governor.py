@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+GPU Memory Governor for the LM Studio Servers
+- Tracks allocated vs reserved memory per GPU instead of emptying the cache after every request
+- Hands cached blocks back to the driver only when free memory runs low, the cache is fragmented, or a load is waiting
+- Reads free memory from the driver (mem_get_info) plus the reusable cache, not from memory_allocated alone
+
+The trigger policy works on plain byte counts; run this file to replay it
+against a simulated allocator on a machine without GPUs.
+"""
+
+import gc
+import threading
+import time
+
+import torch
+
+GB = 1024 ** 3
+
+
+class CudaAllocator:
+    """The real PyTorch caching allocator, one entry per visible GPU"""
+
+    def devices(self):
+        return list(range(torch.cuda.device_count())) if torch.cuda.is_available() else []
+
+    def snapshot(self, device):
+        """(allocated, reserved, driver free, total) bytes for one GPU"""
+        free, total = torch.cuda.mem_get_info(device)
+        return torch.cuda.memory_allocated(device), torch.cuda.memory_reserved(device), free, total
+
+    def empty_cache(self):
+        torch.cuda.empty_cache()
+
+    def synchronize(self):
+        for device in self.devices():
+            torch.cuda.synchronize(device)
+
+
+class SimulatedAllocator:
+    """Stand-in allocator with caching-allocator semantics, for exercising the policy without GPUs.
+
+    Freed bytes stay reserved until empty_cache(); `other_process_bytes`
+    is memory someone else holds on the same device.
+    """
+
+    def __init__(self, total_bytes, num_devices=1):
+        self.total = total_bytes
+        self.allocated = [0] * num_devices
+        self.reserved = [0] * num_devices
+        self.other_process_bytes = [0] * num_devices
+        self.empty_cache_calls = 0
+
+    def alloc(self, num_bytes, device=0):
+        self.allocated[device] += num_bytes
+        self.reserved[device] = max(self.reserved[device], self.allocated[device])
+
+    def free(self, num_bytes, device=0):
+        self.allocated[device] = max(0, self.allocated[device] - num_bytes)
+
+    def devices(self):
+        return list(range(len(self.allocated)))
+
+    def snapshot(self, device):
+        free = self.total - self.reserved[device] - self.other_process_bytes[device]
+        return self.allocated[device], self.reserved[device], max(0, free), self.total
+
+    def empty_cache(self):
+        self.empty_cache_calls += 1
+        self.reserved = list(self.allocated)
+
+    def synchronize(self):
+        pass
+
+
+def device_state(allocated, reserved, driver_free, total):
+    """Derived figures for one device; `free` counts the cache this process can reuse"""
+    cached = max(0, reserved - allocated)
+    return {
+        'allocated': allocated,
+        'reserved': reserved,
+        'cached': cached,
+        'free': driver_free + cached,
+        'driver_free': driver_free,
+        'total': total,
+        'fragmentation': cached / reserved if reserved else 0.0,
+    }
+
+
+def trim_reason(devices, low_free_bytes, fragmentation_threshold, min_cached_bytes, load_pending=False):
+    """Why the cache should be emptied now, or None to leave it warm.
+
+    devices: list of device_state() dicts
+    low_free_bytes: driver free memory below which other users (loads, other processes) are starved
+    fragmentation_threshold: share of reserved memory sitting unused in the cache
+    min_cached_bytes: below this much cached memory a trim is not worth the stall
+    load_pending: a model load is waiting and needs every byte it can get
+    """
+    cached = max((d['cached'] for d in devices), default=0)
+    if cached == 0:
+        return None
+    if load_pending:
+        return 'load'
+    if cached < min_cached_bytes:
+        return None
+    if any(d['driver_free'] < low_free_bytes and d['cached'] >= min_cached_bytes for d in devices):
+        return 'low_free'
+    if any(d['fragmentation'] > fragmentation_threshold and d['cached'] >= min_cached_bytes for d in devices):
+        return 'fragmentation'
+    return None
+
+
+class MemoryGovernor:
+    """Decides when to give the caching allocator's idle blocks back.
+
+    Call maybe_trim() where cleanup_memory() used to run after each request;
+    it returns without touching the allocator unless trim_reason() fires and
+    the last trim was at least `min_interval` seconds ago (loads skip the
+    wait). trim() is the unconditional version for unloads, OOM recovery and
+    the /clear_cache button.
+    """
+
+    def __init__(self, allocator=None, low_free_bytes=2 * GB, fragmentation_threshold=0.35,
+                 min_cached_bytes=1 * GB, min_interval=30.0, load_pending=None, clock=time.monotonic):
+        self.allocator = allocator or CudaAllocator()
+        self.low_free_bytes = low_free_bytes
+        self.fragmentation_threshold = fragmentation_threshold
+        self.min_cached_bytes = min_cached_bytes
+        self.min_interval = min_interval
+        self.load_pending = load_pending or (lambda: False)
+        self.clock = clock
+        self.trims = {}
+        self.checks = 0
+        self.trim_seconds = 0.0
+        self.bytes_released = 0
+        self.last_trim_at = None
+        self._lock = threading.Lock()
+
+    def devices(self):
+        return [device_state(*self.allocator.snapshot(d)) for d in self.allocator.devices()]
+
+    def free_bytes(self):
+        """Memory each GPU can still hand out to this process: driver free plus our reusable cache"""
+        return [d['free'] for d in self.devices()]
+
+    def maybe_trim(self):
+        """Trim if the policy says so; returns the reason, or None if the cache stayed warm"""
+        with self._lock:
+            self.checks += 1
+            devices = self.devices()
+            if not devices:
+                return None
+            load_pending = self.load_pending()
+            reason = trim_reason(devices, self.low_free_bytes, self.fragmentation_threshold,
+                                 self.min_cached_bytes, load_pending)
+            if reason is None:
+                return None
+            if reason != 'load' and self.last_trim_at is not None and self.clock() - self.last_trim_at < self.min_interval:
+                return None
+            self._trim(reason, devices, collect=load_pending)
+            return reason
+
+    def trim(self, reason='manual'):
+        """Empty the cache now: gc, release idle blocks, wait for the GPUs"""
+        with self._lock:
+            self._trim(reason, self.devices(), collect=True, synchronize=True)
+
+    def _trim(self, reason, devices, collect=False, synchronize=False):
+        start = time.monotonic()
+        try:
+            if collect:
+                gc.collect()
+            if devices:
+                self.allocator.empty_cache()
+                if synchronize:
+                    self.allocator.synchronize()
+        except Exception as e:
+            print(f"Memory cleanup warning: {e}")
+        self.trim_seconds += time.monotonic() - start
+        self.trims[reason] = self.trims.get(reason, 0) + 1
+        self.last_trim_at = self.clock()
+        after = self.devices()
+        self.bytes_released += max(0, sum(d['reserved'] for d in devices) - sum(d['reserved'] for d in after))
+
+    def stats(self):
+        return {
+            'checks': self.checks,
+            'trims': dict(self.trims),
+            'trim_seconds': round(self.trim_seconds, 3),
+            'released_gb': round(self.bytes_released / 1e9, 2),
+            'devices': [
+                {
+                    'allocated_gb': round(d['allocated'] / 1e9, 2),
+                    'reserved_gb': round(d['reserved'] / 1e9, 2),
+                    'cached_gb': round(d['cached'] / 1e9, 2),
+                    'free_gb': round(d['free'] / 1e9, 2),
+                    'fragmentation': round(d['fragmentation'], 3),
+                }
+                for d in self.devices()
+            ],
+        }
+
+
+if __name__ == '__main__':
+    # Replay the situations the per-request cleanup_memory() used to paper over
+    now = [0.0]
+    sim = SimulatedAllocator(80 * GB)
+    loading = [False]
+    governor = MemoryGovernor(sim, low_free_bytes=2 * GB, min_cached_bytes=1 * GB, min_interval=30,
+                              load_pending=lambda: loading[0], clock=lambda: now[0])
+    failed = False
+
+    def expect(label, want):
+        global failed
+        got = governor.maybe_trim()
+        ok = got == want
+        failed |= not ok
+        print(f"{'✅' if ok else '❌'} {label:<58} -> {got}")
+
+    sim.alloc(30 * GB)                       # weights + KV pool
+    for _ in range(3):                       # steady-state requests reuse the same activations
+        sim.alloc(2 * GB)
+        sim.free(2 * GB)
+    expect('warm cache after ordinary requests', None)
+    sim.alloc(20 * GB)
+    sim.free(20 * GB)                        # one long prompt leaves a big idle block
+    expect('20GB idle after a long prompt (fragmented)', 'fragmentation')
+    sim.alloc(20 * GB)
+    sim.free(20 * GB)
+    now[0] += 5
+    expect('same again 5s later (rate limited)', None)
+    now[0] += 60
+    expect('same again 60s later', 'fragmentation')
+    sim.alloc(5 * GB)
+    sim.free(5 * GB)
+    sim.other_process_bytes[0] = 44 * GB     # another job grabs the rest of the GPU
+    now[0] += 60
+    expect('another process leaves <2GB driver free', 'low_free')
+    sim.other_process_bytes[0] = 0
+    sim.alloc(GB // 2)
+    sim.free(GB // 2)
+    loading[0] = True
+    expect('load pending, even with little cached', 'load')
+    expect('load pending, nothing left to release', None)
+    print(f"   empty_cache() ran {sim.empty_cache_calls}x across {governor.checks} checks; stats: {governor.stats()['trims']}")
+    raise SystemExit(1 if failed else 0)
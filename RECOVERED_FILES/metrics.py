@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Prometheus Metrics for LM Studio Server v3
+- Counters and fixed-bucket histograms rendered in the Prometheus text format
+- Hot paths only bump a few numbers; gauges are read from live objects at scrape time
+- No prometheus_client dependency, so it runs in the same bare conda env as the server
+"""
+
+import bisect
+import threading
+
+# Request phases span sub-millisecond tokenization to multi-minute generations
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+LOAD_BUCKETS = (1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    """Cumulative-bucket histogram; observe() is a bisect and three additions"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def cumulative(self):
+        """[(upper bound, observations <= bound)], ending with +Inf"""
+        with self._lock:
+            counts = list(self.counts)
+        total, result = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Registry of labelled counters and histograms, plus scrape-time collectors.
+
+    counter() / histogram() return the series for one label set, creating
+    it on first use, so callers can keep the object and skip the lookup on
+    hot paths. A collector is a callable yielding (name, kind, labels,
+    value) tuples - value is a number, or a Histogram for kind 'histogram' -
+    and is run only when /metrics is scraped.
+    """
+
+    def __init__(self, prefix='lmstudio'):
+        self.prefix = prefix
+        self._families = {}   # name -> (kind, help)
+        self._series = {}     # name -> {label tuple: Counter / Histogram}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help_text):
+        self._families[name] = (kind, help_text)
+
+    def _get(self, name, labels, factory):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(name, {}).get(key)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(name, {}).setdefault(key, factory())
+        return series
+
+    def counter(self, name, **labels):
+        return self._get(name, labels, Counter)
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS, **labels):
+        return self._get(name, labels, lambda: Histogram(buckets))
+
+    def add_collector(self, collect):
+        self._collectors.append(collect)
+
+    def render(self):
+        """Everything in the Prometheus text exposition format (version 0.0.4)"""
+        samples = {}
+        with self._lock:
+            for name, series in self._series.items():
+                kind = self._families.get(name, ('histogram' if any(isinstance(s, Histogram) for s in series.values()) else 'counter', ''))[0]
+                for key, value in series.items():
+                    samples.setdefault(name, []).append((kind, dict(key), value))
+        for collect in self._collectors:
+            try:
+                for name, kind, labels, value in collect():
+                    samples.setdefault(name, []).append((kind, labels, value))
+            except Exception as e:
+                print(f"⚠️  Metrics collector failed: {e}")
+
+        lines = []
+        for name in sorted(samples):
+            full = f'{self.prefix}_{name}'
+            kind = samples[name][0][0]
+            help_text = self._families.get(name, (kind, ''))[1]
+            if help_text:
+                lines.append(f'# HELP {full} {help_text}')
+            lines.append(f'# TYPE {full} {kind}')
+            for _, labels, value in samples[name]:
+                if isinstance(value, Histogram):
+                    for bound, count in value.cumulative():
+                        lines.append(f'{full}_bucket{_labels(dict(labels, le=_number(bound)))} {count}')
+                    lines.append(f'{full}_sum{_labels(labels)} {_number(value.sum)}')
+                    lines.append(f'{full}_count{_labels(labels)} {value.count}')
+                else:
+                    value = value.value if isinstance(value, Counter) else value
+                    lines.append(f'{full}{_labels(labels)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
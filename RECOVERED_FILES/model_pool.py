@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Multi-Model Pool for LM Studio Server v3
+- Keeps several models resident on the GPUs up to a VRAM budget
+- Least recently used models are parked in CPU RAM, then dropped
+- Each resident model has its own batching scheduler
+"""
+
+import gc
+import threading
+import time
+
+import torch
+
+
+def module_bytes(model):
+    """Bytes held by a model's parameters and buffers"""
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+
+class PoolFull(Exception):
+    """A parked model could not be restored because every resident model is busy"""
+
+    def __init__(self, message, retry_after=5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ModelEntry:
+    """One loaded model plus everything needed to serve it"""
+
+    def __init__(self, name, model, tokenizer):
+        self.name = name
+        self.model = model
+        self.tokenizer = tokenizer
+        self.scheduler = None
+        self.location = 'gpu'  # 'gpu', 'cpu' (parked) or 'restoring' (moving back to the GPU)
+        self.restored = None  # threading.Event while restoring, set once the move has finished or failed
+        self.device_map = getattr(model, 'hf_device_map', None)
+        self.placement = None
+        self.quantization = getattr(model.config, 'quantization_scheme', None)
+        self.draft_name = None
+        self.draft_model = None
+        self.revision = None  # checkpoint revision, set by the loader; part of every response cache key
+        self.weight_bytes = module_bytes(model)
+        self.loaded_at = time.time()
+        self.last_used = time.time()
+        self.uses = 0
+
+    @property
+    def gpu_bytes(self):
+        if self.location == 'restoring':
+            return self.weight_bytes
+        if self.location != 'gpu':
+            return 0
+        kv_bytes = 0
+        if self.scheduler is not None:
+            kv_bytes = int(self.scheduler.kv_cache.stats()['pool_gb'] * 1e9)
+            if self.scheduler.draft is not None:
+                kv_bytes += int(self.scheduler.draft.kv_cache.stats()['pool_gb'] * 1e9)
+        return self.weight_bytes + kv_bytes
+
+    def busy(self):
+        if self.scheduler is None:
+            return False
+        stats = self.scheduler.stats()
+        return stats['active'] > 0 or stats['waiting'] > 0
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'location': self.location,
+            'weights_gb': round(self.weight_bytes / 1e9, 2),
+            'gpu_gb': round(self.gpu_bytes / 1e9, 2),
+            'last_used': round(time.time() - self.last_used, 1),
+            'uses': self.uses,
+            'placement': self.placement.stats() if self.placement is not None else None,
+            'quantization': self.quantization,
+            'draft_model': self.draft_name,
+        }
+
+
+class ModelPool:
+    """LRU pool of models keyed by name.
+
+    `build_scheduler(entry)` is called whenever a model (re)enters the GPU
+    so its KV pool is sized against the memory that is actually free then;
+    the scheduler is stopped before the model leaves the GPU.
+    """
+
+    def __init__(self, vram_budget_bytes, cpu_budget_bytes, build_scheduler):
+        self.vram_budget_bytes = vram_budget_bytes
+        self.cpu_budget_bytes = cpu_budget_bytes
+        self.build_scheduler = build_scheduler
+        self.entries = {}
+        self.default_name = None
+        self.evictions_to_cpu = 0
+        self.evictions_dropped = 0
+        self.restores = 0
+        self._lock = threading.RLock()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self):
+        return list(self.entries)
+
+    def add(self, name, model, tokenizer, draft_name=None, draft_model=None):
+        with self._lock:
+            if name in self.entries:
+                self.remove(name)
+            entry = ModelEntry(name, model, tokenizer)
+            if draft_model is not None:
+                entry.draft_name = draft_name
+                entry.draft_model = draft_model
+                entry.weight_bytes += module_bytes(draft_model)
+            entry.scheduler = self.build_scheduler(entry)
+            self.entries[name] = entry
+            self.default_name = name
+            return entry
+
+    def set_draft(self, name, draft_name, draft_model):
+        """Attach a speculative-decoding draft to a loaded model and restart its scheduler around it"""
+        with self._lock:
+            entry = self.entries[name]
+            self._stop_scheduler(entry, 'Draft model changed')
+            if entry.draft_model is not None:
+                entry.weight_bytes -= module_bytes(entry.draft_model)
+            entry.draft_name = draft_name
+            entry.draft_model = draft_model
+            if draft_model is not None:
+                entry.weight_bytes += module_bytes(draft_model)
+            self._release()
+            if entry.location == 'gpu':
+                entry.scheduler = self.build_scheduler(entry)
+            return entry
+
+    def get(self, name=None):
+        """Return a GPU-resident entry for name (default: last loaded), restoring it if parked.
+
+        The copy back to the GPU runs outside the pool lock, so requests for
+        other models are not held up by it; concurrent callers for the same
+        model wait for that one restore. Raises PoolFull when the model
+        cannot fit without evicting a busy one.
+        """
+        restore = False
+        with self._lock:
+            name = name or self.default_name
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            if entry.location == 'cpu':
+                if not self.make_room(entry.weight_bytes, exclude=name):
+                    raise PoolFull(f'{name} is parked in CPU RAM and every resident model is busy')
+                entry.location = 'restoring'
+                entry.restored = threading.Event()
+                restore = True
+            restored = entry.restored if entry.location == 'restoring' else None
+            entry.last_used = time.time()
+            entry.uses += 1
+        if restore:
+            self._restore(entry)
+        elif restored is not None:
+            restored.wait()
+        if entry.location != 'gpu':
+            raise PoolFull(f'{name} could not be restored to the GPU')
+        return entry
+
+    def make_room(self, required_bytes, exclude=None):
+        """Evict idle models, least recently used first, until required_bytes fit the VRAM budget"""
+        with self._lock:
+            while self.resident_bytes() + required_bytes > self.vram_budget_bytes:
+                candidates = [
+                    e for e in self.entries.values()
+                    if e.location == 'gpu' and e.name != exclude and not e.busy()
+                ]
+                if not candidates:
+                    return False
+                self._evict(min(candidates, key=lambda e: e.last_used))
+            return True
+
+    def resident_bytes(self):
+        return sum(e.gpu_bytes for e in self.entries.values())
+
+    def parked_bytes(self):
+        return sum(e.weight_bytes for e in self.entries.values() if e.location == 'cpu')
+
+    def remove(self, name):
+        with self._lock:
+            entry = self.entries.pop(name, None)
+            if entry is None:
+                return False
+            self._stop_scheduler(entry, 'Model was unloaded')
+            entry.model = None
+            entry.draft_model = None
+            entry.tokenizer = None
+            if self.default_name == name:
+                remaining = sorted(self.entries.values(), key=lambda e: e.last_used)
+                self.default_name = remaining[-1].name if remaining else None
+            self._release()
+            return True
+
+    def clear(self):
+        with self._lock:
+            for name in list(self.entries):
+                self.remove(name)
+
+    def _stop_scheduler(self, entry, reason):
+        if entry.scheduler is not None:
+            entry.scheduler.stop(reason)
+            entry.scheduler = None
+
+    def _evict(self, entry):
+        """Park a model in CPU RAM, or drop it when RAM is over budget too"""
+        self._stop_scheduler(entry, 'Model was evicted from GPU')
+        if not torch.cuda.is_available() or self.parked_bytes() + entry.weight_bytes > self.cpu_budget_bytes:
+            print(f"Dropping {entry.name} from the model pool")
+            self.evictions_dropped += 1
+            self.remove(entry.name)
+            return
+        print(f"Parking {entry.name} in CPU RAM")
+        entry.model.to('cpu')
+        if entry.draft_model is not None:
+            entry.draft_model.to('cpu')
+        entry.location = 'cpu'
+        self.evictions_to_cpu += 1
+        self._release()
+
+    def _restore(self, entry):
+        """Move a model marked 'restoring' back to the GPU and start its scheduler (called without the lock)"""
+        print(f"Restoring {entry.name} to GPU")
+        try:
+            self._to_gpu(entry)
+            scheduler = self.build_scheduler(entry)
+        except Exception as e:
+            print(f"❌ Could not restore {entry.name}: {e}")
+            for model in (entry.model, entry.draft_model):
+                if model is not None:
+                    model.to('cpu')
+            entry.location = 'cpu'
+            entry.restored.set()
+            self._release()
+            return
+        with self._lock:
+            entry.location = 'gpu'
+            entry.scheduler = scheduler
+            self.restores += 1
+            entry.restored.set()
+            if self.entries.get(entry.name) is not entry:
+                # Unloaded while it was being restored
+                self._stop_scheduler(entry, 'Model was unloaded')
+
+    def _to_gpu(self, entry):
+        devices = set((entry.device_map or {}).values())
+        if len(devices) > 1:
+            # Put every submodule back where device_map="auto" originally placed it
+            for module_name, device in entry.device_map.items():
+                if isinstance(device, int):
+                    device = f'cuda:{device}'
+                target = entry.model.get_submodule(module_name) if module_name else entry.model
+                target.to(device)
+        else:
+            device = devices.pop() if devices else 'cuda'
+            entry.model.to(f'cuda:{device}' if isinstance(device, int) else device)
+        if entry.draft_model is not None:
+            # The draft sits next to the target's embeddings, where decode steps start
+            entry.draft_model.to(entry.model.get_input_embeddings().weight.device)
+
+    def _release(self):
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'default': self.default_name,
+                'models': [e.stats() for e in sorted(self.entries.values(), key=lambda e: -e.last_used)],
+                'resident_gb': round(self.resident_bytes() / 1e9, 2),
+                'vram_budget_gb': round(self.vram_budget_bytes / 1e9, 2),
+                'parked_gb': round(self.parked_bytes() / 1e9, 2),
+                'cpu_budget_gb': round(self.cpu_budget_bytes / 1e9, 2),
+                'evictions_to_cpu': self.evictions_to_cpu,
+                'evictions_dropped': self.evictions_dropped,
+                'restores': self.restores,
+            }
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Node-Local Model Staging for the LM Studio Servers
+- Copies (or hardlinks) a cached snapshot from the shared HF cache to node-local scratch
+- Large files are copied in parallel chunks, then verified against their checksums
+- Staged copies are reused across server restarts within the same allocation
+"""
+
+import filecmp
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+CHUNK_BYTES = 64 * 1024 * 1024
+MANIFEST = '.staged.json'
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def find_snapshot(model_name, hf_home):
+    """Local directory holding model_name's files (a path, or its HF cache snapshot), or None"""
+    if os.path.isdir(model_name):
+        return model_name
+    repo_dir = 'models--' + model_name.replace('/', '--')
+    for root in [hf_home, os.path.join(hf_home, 'hub')]:
+        snapshots = os.path.join(root, repo_dir, 'snapshots')
+        if not os.path.isdir(snapshots):
+            continue
+        # Newest snapshot first, in case the repo was updated since the first download
+        for name in sorted(os.listdir(snapshots), key=lambda d: -os.path.getmtime(os.path.join(snapshots, d))):
+            path = os.path.join(snapshots, name)
+            if os.path.exists(os.path.join(path, 'config.json')):
+                return path
+    return None
+
+
+def default_stage_root():
+    """Node-local scratch for this allocation: the RAM disk under /tmp, keyed by SLURM job"""
+    base = os.environ.get('LMSTUDIO_STAGE_DIR', '/tmp/lmstudio_models')
+    return os.path.join(base, os.environ.get('SLURM_JOB_ID', 'local'))
+
+
+def _snapshot_files(snapshot):
+    """(relative path, resolved source path, expected sha256 or None) for every file in a snapshot"""
+    files = []
+    for root, _, names in os.walk(snapshot):
+        for name in names:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, snapshot)
+            if rel == MANIFEST:
+                continue
+            real = os.path.realpath(path)
+            # The HF cache names LFS blobs after the sha256 of their content
+            blob = os.path.basename(real)
+            files.append((rel, real, blob if SHA256_RE.match(blob) else None))
+    return sorted(files)
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _copy_chunk(src, dst, offset, length):
+    with open(src, 'rb') as fin:
+        fin.seek(offset)
+        data = fin.read(length)
+    fd = os.open(dst, os.O_WRONLY)
+    try:
+        os.pwrite(fd, data, offset)
+    finally:
+        os.close(fd)
+    return len(data)
+
+
+def _verify(src, dst, sha256):
+    if sha256 is not None:
+        return _sha256(dst) == sha256
+    return filecmp.cmp(src, dst, shallow=False)
+
+
+class ModelStager:
+    """Stages HF cache snapshots under `root`, one directory per repo revision.
+
+    A snapshot counts as staged once its manifest exists and the source file
+    sizes still match it; staging happens in a temporary directory that is
+    renamed into place, so a crash never leaves a half-copied model behind.
+    Least recently used staged models are removed when scratch runs short.
+    """
+
+    def __init__(self, root=None, workers=8, reserve_gb=4.0):
+        self.root = root or default_stage_root()
+        self.workers = workers
+        self.reserve_bytes = int(reserve_gb * 1e9)
+        self.hits = 0
+        self.staged = 0
+        self.bytes_copied = 0
+        self.bytes_linked = 0
+
+    def staged_path(self, snapshot):
+        parts = os.path.normpath(snapshot).split(os.sep)
+        name = '--'.join(p for p in parts[-3:] if p != 'snapshots') if 'snapshots' in parts else parts[-1]
+        return os.path.join(self.root, name)
+
+    def lookup(self, snapshot):
+        """Staged directory for snapshot if a complete, up-to-date copy exists"""
+        dest = self.staged_path(snapshot)
+        manifest_path = os.path.join(dest, MANIFEST)
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            for rel, _, _ in _snapshot_files(snapshot):
+                if os.path.getsize(os.path.join(snapshot, rel)) != manifest['files'].get(rel):
+                    return None
+        except (OSError, ValueError, KeyError):
+            return None
+        os.utime(manifest_path)
+        return dest
+
+    def stage(self, snapshot):
+        """Return a node-local copy of snapshot, staging it first if needed (None if scratch is too small)"""
+        dest = self.lookup(snapshot)
+        if dest is not None:
+            self.hits += 1
+            print(f"✅ Using staged copy: {dest}")
+            return dest
+
+        files = _snapshot_files(snapshot)
+        total = sum(os.path.getsize(real) for _, real, _ in files)
+        os.makedirs(self.root, exist_ok=True)
+        same_device = os.stat(self.root).st_dev == os.stat(files[0][1]).st_dev if files else True
+        if not same_device and not self._make_room(total):
+            print(f"⚠️  Not enough node-local scratch to stage {total / 1e9:.1f}GB - loading from shared cache")
+            return None
+
+        dest = self.staged_path(snapshot)
+        partial = f'{dest}.partial-{os.getpid()}'
+        shutil.rmtree(partial, ignore_errors=True)
+        start = time.time()
+        try:
+            if same_device:
+                # Same filesystem: hardlinks stage the model without copying a byte
+                for rel, real, _ in files:
+                    os.makedirs(os.path.dirname(os.path.join(partial, rel)), exist_ok=True)
+                    os.link(real, os.path.join(partial, rel))
+                self.bytes_linked += total
+            else:
+                self._copy(files, partial)
+                self.bytes_copied += total
+            manifest = {
+                'source': snapshot,
+                'files': {rel: os.path.getsize(real) for rel, real, _ in files},
+                'staged_at': time.time(),
+            }
+            with open(os.path.join(partial, MANIFEST), 'w') as f:
+                json.dump(manifest, f)
+            shutil.rmtree(dest, ignore_errors=True)
+            os.rename(partial, dest)
+        except Exception:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+
+        seconds = time.time() - start
+        self.staged += 1
+        print(f"✅ Staged {total / 1e9:.1f}GB to {dest} in {seconds:.1f}s "
+              f"({'hardlinked' if same_device else f'{total / 1e9 / max(seconds, 1e-6):.2f}GB/s'})")
+        return dest
+
+    def _copy(self, files, partial):
+        """Copy every file in CHUNK_BYTES pieces on the thread pool, then verify checksums"""
+        chunks = []
+        for rel, real, _ in files:
+            target = os.path.join(partial, rel)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            size = os.path.getsize(real)
+            with open(target, 'wb') as f:
+                f.truncate(size)
+            chunks += [(real, target, offset, min(CHUNK_BYTES, size - offset)) for offset in range(0, size, CHUNK_BYTES)]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(lambda chunk: _copy_chunk(*chunk), chunks))
+            checks = pool.map(lambda f: (f[0], _verify(f[1], os.path.join(partial, f[0]), f[2])), files)
+            bad = [rel for rel, ok in checks if not ok]
+        if bad:
+            raise IOError(f"Checksum mismatch after staging: {', '.join(bad)}")
+
+    def _make_room(self, required_bytes):
+        """Drop least recently used staged models until required_bytes fit alongside the reserve"""
+        while shutil.disk_usage(self.root).free - self.reserve_bytes < required_bytes:
+            staged = [
+                os.path.join(self.root, d) for d in os.listdir(self.root)
+                if os.path.exists(os.path.join(self.root, d, MANIFEST))
+            ]
+            if not staged:
+                return False
+            victim = min(staged, key=lambda d: os.path.getmtime(os.path.join(d, MANIFEST)))
+            print(f"Removing staged model {victim}")
+            shutil.rmtree(victim, ignore_errors=True)
+        return True
+
+    def stats(self):
+        return {
+            'root': self.root,
+            'hits': self.hits,
+            'staged': self.staged,
+            'copied_gb': round(self.bytes_copied / 1e9, 2),
+            'linked_gb': round(self.bytes_linked / 1e9, 2),
+        }
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+"""
+OpenAI API Compatibility Helpers for LM Studio Server v3
+- Request parsing, response / chunk shapes, logprobs and usage for /v1/completions and /v1/chat/completions
+- Chat prompts are rendered through the tokenizer's chat template and cached per conversation prefix
+- Stop strings are matched on the detokenized text, holding back output that could still become a stop
+"""
+
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+MAX_CHOICES = 8
+MAX_STOP_SEQUENCES = 4
+MAX_TOP_LOGPROBS = 20
+
+
+class OpenAIError(Exception):
+    """A request the OpenAI API would reject; rendered as {'error': {...}} with `status_code`"""
+
+    def __init__(self, message, param=None, status_code=400, error_type='invalid_request_error', code=None,
+                 retry_after=None):
+        super().__init__(message)
+        self.param = param
+        self.status_code = status_code
+        self.error_type = error_type
+        self.code = code
+        self.retry_after = retry_after
+
+    def body(self):
+        return {'error': {'message': str(self), 'type': self.error_type, 'param': self.param, 'code': self.code}}
+
+
+def request_id(kind):
+    return f"{'chatcmpl' if kind == 'chat' else 'cmpl'}-{uuid.uuid4().hex[:24]}"
+
+
+def _number(data, name, default, cast, low, high):
+    value = data.get(name)
+    if value is None:
+        return default
+    try:
+        value = cast(value)
+    except (TypeError, ValueError):
+        raise OpenAIError(f'{name} must be a number', param=name)
+    if not low <= value <= high:
+        raise OpenAIError(f'{name} must be between {low} and {high}', param=name)
+    return value
+
+
+def sampling_params(data, kind, max_new_tokens):
+    """Validated generation settings shared by both endpoints"""
+    stop = data.get('stop')
+    if stop is None:
+        stop = []
+    elif isinstance(stop, str):
+        stop = [stop]
+    if not isinstance(stop, list) or not all(isinstance(s, str) for s in stop) or len(stop) > MAX_STOP_SEQUENCES:
+        raise OpenAIError(f'stop must be a string or a list of at most {MAX_STOP_SEQUENCES} strings', param='stop')
+
+    if kind == 'chat':
+        max_tokens = data.get('max_completion_tokens', data.get('max_tokens'))
+        logprobs = None
+        if data.get('logprobs'):
+            logprobs = _number(data, 'top_logprobs', 0, int, 0, MAX_TOP_LOGPROBS)
+        elif data.get('top_logprobs') is not None:
+            raise OpenAIError('top_logprobs requires logprobs to be true', param='top_logprobs')
+    else:
+        max_tokens = data.get('max_tokens', 16)  # the completions API default
+        logprobs = _number(data, 'logprobs', None, int, 0, MAX_TOP_LOGPROBS)
+    # Clients routinely ask for more than the server allows; clamp like /generate does instead of refusing
+    max_tokens = min(_number({'max_tokens': max_tokens}, 'max_tokens', max_new_tokens, int, 1, 1 << 31), max_new_tokens)
+    return {
+        'max_tokens': max_tokens,
+        'temperature': _number(data, 'temperature', 1.0, float, 0.0, 2.0),
+        'top_p': _number(data, 'top_p', 1.0, float, 0.0, 1.0),
+        # Not in the OpenAI API, but accepted the way other OpenAI-compatible servers accept them
+        'top_k': _number(data, 'top_k', 0, int, -1, 1 << 31),
+        'min_p': _number(data, 'min_p', 0.0, float, 0.0, 1.0),
+        'n': _number(data, 'n', 1, int, 1, MAX_CHOICES),
+        'seed': _number(data, 'seed', None, int, 0, (1 << 63) - 1),
+        'stop': [s for s in stop if s],
+        'logprobs': logprobs,
+        'stream': bool(data.get('stream')),
+        'include_usage': bool((data.get('stream_options') or {}).get('include_usage')),
+    }
+
+
+def completion_prompts(data):
+    """The completions API's `prompt`: a string, a list of strings, a token list or a list of token lists"""
+    prompt = data.get('prompt')
+    if isinstance(prompt, str):
+        return [prompt]
+    if isinstance(prompt, list) and prompt:
+        if all(isinstance(p, str) for p in prompt):
+            return prompt
+        if all(isinstance(t, int) for t in prompt):
+            return [prompt]
+        if all(isinstance(p, list) and p and all(isinstance(t, int) for t in p) for p in prompt):
+            return prompt
+    raise OpenAIError('prompt must be a string, a list of strings or a list of token IDs', param='prompt')
+
+
+def chat_messages(data):
+    messages = data.get('messages')
+    if not isinstance(messages, list) or not messages:
+        raise OpenAIError('messages must be a non-empty list', param='messages')
+    cleaned = []
+    for message in messages:
+        if not isinstance(message, dict) or 'role' not in message:
+            raise OpenAIError('every message needs a role', param='messages')
+        content = message.get('content') or ''
+        if isinstance(content, list):
+            # Content parts: only text is supported
+            content = ''.join(part.get('text', '') for part in content if isinstance(part, dict) and part.get('type') == 'text')
+        cleaned.append({'role': message['role'], 'content': content})
+    return cleaned
+
+
+def plain_chat_prompt(messages, add_generation_prompt=True):
+    """Prompt for tokenizers without a chat template (gpt2 and friends)"""
+    text = ''.join(f"{m['role'].capitalize()}: {m['content']}\n" for m in messages)
+    return text + 'Assistant:' if add_generation_prompt else text
+
+
+class ChatPromptCache:
+    """Chat-template renderings as token IDs, cached per conversation prefix.
+
+    Entries are keyed by a running hash over the messages and hold the
+    rendered history (no generation prompt) with its token IDs. The next
+    turn of a conversation finds its longest cached prefix and, as long as
+    the template renders that history the same way, only tokenizes the new
+    messages and the generation prompt. The history IDs stay identical
+    across turns, which also keeps the scheduler's prefix cache hitting.
+
+    Pieces tokenized separately only match a full tokenization when no BPE
+    merge crosses the seam. A seam next to a special or added token never
+    merges, so pieces are stitched only there. Any other seam falls back to
+    tokenizing the whole text.
+
+    The template is rendered once per request. The generation prompt it
+    appends is learned per model from a probe conversation.
+    """
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.tokens_reused = 0
+        self._entries = OrderedDict()  # key -> (rendered history, token ids)
+        self._suffixes = {}  # model name -> generation prompt the template appends, or None if it is not a suffix
+        self._atomic = {}  # model name -> special and added token strings
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _keys(model_name, messages):
+        digest = hashlib.sha1(model_name.encode())
+        keys = []
+        for message in messages:
+            digest.update(json.dumps([message['role'], message['content']]).encode())
+            keys.append(digest.copy().hexdigest())
+        return keys
+
+    def _generation_suffix(self, model_name, tokenizer):
+        if model_name not in self._suffixes:
+            probe = [{'role': 'user', 'content': 'ping'}]
+            suffix = None
+            try:
+                history = tokenizer.apply_chat_template(probe, tokenize=False)
+                prompt = tokenizer.apply_chat_template(probe, tokenize=False, add_generation_prompt=True)
+                if prompt.startswith(history):
+                    suffix = prompt[len(history):]
+            except Exception:
+                pass
+            self._suffixes[model_name] = suffix
+        return self._suffixes[model_name]
+
+    def _render(self, model_name, tokenizer, messages):
+        """(history, prompt) text; one template call when the generation prompt is a known suffix"""
+        if not getattr(tokenizer, 'chat_template', None):
+            return plain_chat_prompt(messages, False), plain_chat_prompt(messages)
+        prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+        suffix = self._generation_suffix(model_name, tokenizer)
+        if suffix is not None and prompt.endswith(suffix):
+            return prompt[:len(prompt) - len(suffix)], prompt
+        return tokenizer.apply_chat_template(messages, tokenize=False), prompt
+
+    def _atomic_seam(self, model_name, tokenizer, left, right):
+        """Whether a special or added token sits on either side of the seam between left and right"""
+        if model_name not in self._atomic:
+            self._atomic[model_name] = tuple(t for t in set(tokenizer.all_special_tokens) | set(tokenizer.get_added_vocab()) if t)
+        tokens = self._atomic[model_name]
+        return left.endswith(tokens) or right.startswith(tokens)
+
+    def render(self, model_name, tokenizer, messages):
+        """Token IDs of the prompt for `messages`, ending with the assistant's generation prompt"""
+        templated = bool(getattr(tokenizer, 'chat_template', None))
+        history, prompt = self._render(model_name, tokenizer, messages)
+
+        def encode(text, first):
+            # Templates spell out BOS themselves; only a bare prompt gets the tokenizer's special tokens
+            return tokenizer(text, add_special_tokens=first and not templated)['input_ids'] if text else []
+
+        def joinable(left, right):
+            return not left or not right or self._atomic_seam(model_name, tokenizer, left, right)
+
+        keys = self._keys(model_name, messages)
+        cached = None
+        with self._lock:
+            for key in reversed(keys):
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    cached = self._entries[key]
+                    break
+        reuse = cached is not None and history.startswith(cached[0]) and joinable(cached[0], history[len(cached[0]):])
+        ids = cached[1] + encode(history[len(cached[0]):], False) if reuse else encode(history, True)
+        tail = prompt[len(history):] if prompt.startswith(history) else None
+        if tail is not None and joinable(history, tail):
+            prompt_ids = ids + encode(tail, False)
+        else:
+            prompt_ids = encode(prompt, True)
+
+        with self._lock:
+            if reuse:
+                self.hits += 1
+                self.tokens_reused += len(cached[1])
+            else:
+                self.misses += 1
+            self._entries[keys[-1]] = (history, ids)
+            self._entries.move_to_end(keys[-1])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return prompt_ids
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'tokens_reused': self.tokens_reused,
+            }
+
+
+def find_stop(text, stops, start=0):
+    """Index of the earliest stop string in text at or after start, or -1"""
+    hits = [i for i in (text.find(stop, start) for stop in stops) if i >= 0]
+    return min(hits) if hits else -1
+
+
+class StopScanner:
+    """Feeds generated text through the stop strings.
+
+    feed() returns the part of the text that is safe to emit: everything
+    except a tail that could still grow into a stop string. Once a stop
+    matches, `stopped` is set and the text is cut just before it.
+    """
+
+    def __init__(self, stops):
+        self.stops = stops
+        self.holdback = max((len(s) for s in stops), default=1) - 1
+        self.text = ''
+        self.emitted = 0
+        self.stopped = False
+
+    def feed(self, delta, final=False):
+        if self.stopped:
+            return ''
+        self.text += delta
+        if self.stops:
+            index = find_stop(self.text, self.stops, max(0, self.emitted - self.holdback))
+            if index >= 0:
+                self.text = self.text[:index]
+                self.stopped = True
+                final = True
+        safe = len(self.text) if final or not self.stops else max(self.emitted, len(self.text) - self.holdback)
+        out = self.text[self.emitted:safe]
+        self.emitted = safe
+        return out
+
+
+def chat_logprobs(tokenizer, entries, token_ids):
+    """choices[].logprobs for chat completions: {'content': [{token, logprob, bytes, top_logprobs}]}"""
+    def item(token_id, logprob):
+        token = tokenizer.decode([token_id])
+        return {'token': token, 'logprob': logprob, 'bytes': list(token.encode('utf-8'))}
+
+    content = []
+    for token_id, (logprob, top) in zip(token_ids, entries):
+        content.append(dict(item(token_id, logprob), top_logprobs=[item(t, lp) for t, lp in top]))
+    return {'content': content}
+
+
+def completion_logprobs(tokenizer, entries, token_ids):
+    """choices[].logprobs for legacy completions: parallel tokens / token_logprobs / top_logprobs / text_offset lists"""
+    tokens, offsets, offset = [], [], 0
+    for token_id in token_ids:
+        token = tokenizer.decode([token_id])
+        tokens.append(token)
+        offsets.append(offset)
+        offset += len(token)
+    return {
+        'tokens': tokens,
+        'token_logprobs': [logprob for logprob, _ in entries],
+        'top_logprobs': [{tokenizer.decode([t]): lp for t, lp in top} for _, top in entries],
+        'text_offset': offsets,
+    }
+
+
+def usage(prompt_tokens, completion_tokens):
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+    }
+
+
+def response_body(kind, response_id, model, choices, usage_info):
+    """Full (non-streamed) response; choices are dicts with index, text, finish_reason and logprobs"""
+    body = {
+        'id': response_id,
+        'object': 'chat.completion' if kind == 'chat' else 'text_completion',
+        'created': int(time.time()),
+        'model': model,
+        'usage': usage_info,
+    }
+    if kind == 'chat':
+        body['choices'] = [{
+            'index': c['index'],
+            'message': {'role': 'assistant', 'content': c['text']},
+            'logprobs': c['logprobs'],
+            'finish_reason': c['finish_reason'],
+        } for c in choices]
+    else:
+        body['choices'] = [{
+            'index': c['index'],
+            'text': c['text'],
+            'logprobs': c['logprobs'],
+            'finish_reason': c['finish_reason'],
+        } for c in choices]
+    return body
+
+
+def chunk_body(kind, response_id, model, index, text=None, finish_reason=None, logprobs=None, first=False):
+    """One streamed chunk for one choice"""
+    body = {
+        'id': response_id,
+        'object': 'chat.completion.chunk' if kind == 'chat' else 'text_completion',
+        'created': int(time.time()),
+        'model': model,
+    }
+    if kind == 'chat':
+        delta = {}
+        if first:
+            delta['role'] = 'assistant'
+        if text:
+            delta['content'] = text
+        body['choices'] = [{'index': index, 'delta': delta, 'logprobs': logprobs, 'finish_reason': finish_reason}]
+    else:
+        body['choices'] = [{'index': index, 'text': text or '', 'logprobs': logprobs, 'finish_reason': finish_reason}]
+    return body
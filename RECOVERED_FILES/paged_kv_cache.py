@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+Paged KV-Cache for LM Studio Server v3
+- Fixed-size KV blocks handed out from one preallocated pool per layer
+- Sequences own a block table instead of a contiguous cache
+- Blocks return to the free list as soon as a sequence finishes
+"""
+
+import torch
+
+try:
+    from transformers.cache_utils import Cache
+except ImportError:
+    Cache = object
+
+
+def decoder_layers(model):
+    """Return the model's list of transformer blocks (model.layers, transformer.h, ...)"""
+    num_layers = getattr(model.config, 'num_hidden_layers', None)
+    for module in model.modules():
+        if isinstance(module, torch.nn.ModuleList) and len(module) == num_layers:
+            return list(module)
+    return []
+
+
+def kv_shape(config):
+    """(layers, kv_heads, head_dim) for a HF config"""
+    layers = config.num_hidden_layers
+    heads = config.num_attention_heads
+    kv_heads = getattr(config, 'num_key_value_heads', None) or heads
+    head_dim = getattr(config, 'head_dim', None) or config.hidden_size // heads
+    return layers, kv_heads, head_dim
+
+
+def bytes_per_token(config, dtype):
+    """KV bytes one token occupies across all layers"""
+    layers, kv_heads, head_dim = kv_shape(config)
+    element_size = torch.tensor([], dtype=dtype).element_size()
+    return 2 * layers * kv_heads * head_dim * element_size
+
+
+def plan_num_blocks(model, gpu_info, block_size=16, fraction=0.9, buffer_gb=2.0, cpu_budget_gb=4.0):
+    """Size the pool from what get_gpu_info() reports as free after model load.
+
+    Each GPU only holds the layers placed on it, so the pool is limited by
+    the device whose free memory runs out first. A decode step reads one
+    layer at a time out of the pool (see PagedBatchView), and in the worst
+    case - the batch holds every block - that layer's gathered keys and
+    values are as large as its slice of the pool. The budget therefore
+    covers the pool's layers plus one more layer's worth of headroom.
+    """
+    config = model.config
+    dtype = next(model.parameters()).dtype
+    _, kv_heads, head_dim = kv_shape(config)
+    element_size = torch.tensor([], dtype=dtype).element_size()
+    layer_block_bytes = 2 * kv_heads * head_dim * block_size * element_size
+
+    if not gpu_info.get('available'):
+        return max(1, int(cpu_budget_gb * 1e9 // (layer_block_bytes * config.num_hidden_layers)))
+
+    layers_per_device = {}
+    for layer in decoder_layers(model):
+        device = next(layer.parameters()).device
+        if device.type == 'cuda':
+            layers_per_device[device.index] = layers_per_device.get(device.index, 0) + 1
+    if not layers_per_device:
+        layers_per_device = {gpu_info['gpus'][0]['id']: config.num_hidden_layers}
+
+    free_by_id = {gpu['id']: gpu['free'] for gpu in gpu_info['gpus']}
+    blocks = None
+    for device_id, layer_count in layers_per_device.items():
+        usable = max(0.0, free_by_id.get(device_id, 0.0) - buffer_gb) * fraction * 1e9
+        device_blocks = int(usable // (layer_block_bytes * (layer_count + 1)))
+        blocks = device_blocks if blocks is None else min(blocks, device_blocks)
+    return max(1, blocks or 0)
+
+
+class PagedKVCache:
+    """Block allocator plus per-layer slot storage.
+
+    Every layer owns a `[num_blocks * block_size, kv_heads, head_dim]` pool
+    for keys and one for values on the layer's device, allocated right after
+    model load by `preallocate()` (or on first write if the decoder layers
+    cannot be located). A token lives in slot
+    `block * block_size + offset`. `view()` hands the model a cache that
+    writes each new position straight into its slot and reads the batch's
+    KV from the pool one layer at a time; its `commit()` then records the
+    new lengths.
+    """
+
+    def __init__(self, num_blocks, block_size=16):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+        self.block_tables = {}
+        self.lengths = {}
+        self.pools = None
+        self.peak_blocks_used = 0
+
+    def blocks_needed(self, num_tokens):
+        return -(-num_tokens // self.block_size)
+
+    def can_allocate(self, num_tokens):
+        return self.blocks_needed(num_tokens) <= len(self.free_blocks)
+
+    def fits_at_all(self, num_tokens):
+        return self.blocks_needed(num_tokens) <= self.num_blocks
+
+    def reserve(self, seq_id, num_tokens):
+        """Grow seq_id's block table so it can hold num_tokens; False if the pool is exhausted"""
+        table = self.block_tables.setdefault(seq_id, [])
+        self.lengths.setdefault(seq_id, 0)
+        missing = self.blocks_needed(num_tokens) - len(table)
+        if missing > len(self.free_blocks):
+            return False
+        for _ in range(missing):
+            table.append(self.free_blocks.pop())
+        self.peak_blocks_used = max(self.peak_blocks_used, self.num_blocks - len(self.free_blocks))
+        return True
+
+    def free(self, seq_id):
+        self.free_blocks.extend(reversed(self.block_tables.pop(seq_id, [])))
+        self.lengths.pop(seq_id, None)
+
+    def _slots(self, seq_id, start, end, device):
+        table = self.block_tables[seq_id]
+        positions = torch.arange(start, end)
+        blocks = torch.tensor(table)[positions // self.block_size]
+        return (blocks * self.block_size + positions % self.block_size).to(device)
+
+    def preallocate(self, model):
+        """Allocate every layer's pool up front, on the device that layer was placed on"""
+        layers = decoder_layers(model)
+        if not layers:
+            return False
+        _, kv_heads, head_dim = kv_shape(model.config)
+        dtype = next(model.parameters()).dtype
+        num_slots = self.num_blocks * self.block_size
+        self.pools = []
+        for layer in layers:
+            device = next(layer.parameters()).device
+            self.pools.append((
+                torch.zeros((num_slots, kv_heads, head_dim), dtype=dtype, device=device),
+                torch.zeros((num_slots, kv_heads, head_dim), dtype=dtype, device=device),
+            ))
+        return True
+
+    def _ensure_pools(self, kv):
+        if self.pools is not None:
+            return
+        num_slots = self.num_blocks * self.block_size
+        self.pools = [
+            (torch.zeros((num_slots,) + tuple(k.shape[1:2]) + tuple(k.shape[3:]), dtype=k.dtype, device=k.device),
+             torch.zeros((num_slots,) + tuple(v.shape[1:2]) + tuple(v.shape[3:]), dtype=v.dtype, device=v.device))
+            for k, v in kv
+        ]
+
+    def write(self, seq_id, kv, start=0):
+        """Store a `[1, heads, T, head_dim]` per-layer prefill at positions start..start+T"""
+        self._ensure_pools(kv)
+        count = kv[0][0].shape[-2]
+        slots = {}
+        for (k, v), (k_pool, v_pool) in zip(kv, self.pools):
+            index = slots.get(k_pool.device)
+            if index is None:
+                index = slots[k_pool.device] = self._slots(seq_id, start, start + count, k_pool.device)
+            k_pool.index_copy_(0, index, k[0, :, -count:, :].transpose(0, 1).to(k_pool.dtype))
+            v_pool.index_copy_(0, index, v[0, :, -count:, :].transpose(0, 1).to(v_pool.dtype))
+        self.lengths[seq_id] = start + count
+
+    def view(self, seq_ids, count, device):
+        """(cache, mask) for a forward pass over `count` new positions per sequence.
+
+        The mask is `[B, L + count]`: the left-padded cached positions (L is
+        the longest cached length) followed by the new ones. Blocks for the
+        new positions must already be reserved.
+        """
+        lengths = [self.lengths[seq_id] for seq_id in seq_ids]
+        width = max(lengths)
+        index = torch.zeros((len(seq_ids), width + count), dtype=torch.long)
+        mask = torch.zeros((len(seq_ids), width + count), dtype=torch.long)
+        for row, (seq_id, length) in enumerate(zip(seq_ids, lengths)):
+            index[row, width - length:] = self._slots(seq_id, 0, length + count, 'cpu')
+            mask[row, width - length:] = 1
+        return PagedBatchView(self, seq_ids, index, width), mask.to(device)
+
+    def truncate(self, seq_id, length):
+        """Forget positions from `length` on (rejected draft tokens); the blocks stay reserved"""
+        self.lengths[seq_id] = min(self.lengths[seq_id], length)
+
+    def stats(self):
+        used = self.num_blocks - len(self.free_blocks)
+        pool_bytes = 0
+        if self.pools is not None:
+            pool_bytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in self.pools)
+        return {
+            'block_size': self.block_size,
+            'total_blocks': self.num_blocks,
+            'used_blocks': used,
+            'free_blocks': len(self.free_blocks),
+            'utilization': round(used / self.num_blocks, 3) if self.num_blocks else 0,
+            'peak_blocks_used': self.peak_blocks_used,
+            'sequences': len(self.block_tables),
+            'capacity_tokens': self.num_blocks * self.block_size,
+            'pool_gb': round(pool_bytes / 1e9, 3),
+        }
+
+
+class PagedBatchView(Cache):
+    """HF cache for one batched forward pass that reads and writes the pool in place.
+
+    `index` is the `[B, past + new]` slot of every position the pass can
+    see, left-padded (padding points at slot 0 and is masked out). When a
+    layer calls update(), its new keys and values are written to their
+    slots and the layer's full KV is read back out of the pool. Only that
+    one layer's copy is alive at a time - there is no per-step copy of the
+    whole batch's cache and no concatenation.
+
+    Models that still take the legacy tuple format index the view per layer
+    instead; they get that layer's past read out of the pool, concatenate
+    the new positions themselves and return the result, which commit()
+    writes back. Those models keep a full copy of the batch's KV alive for
+    the pass, as before.
+    """
+
+    def __init__(self, kv_cache, seq_ids, index, past_width):
+        try:
+            super().__init__()
+        except (TypeError, ValueError):
+            super().__init__(layers=[])  # releases whose Cache requires a layer list
+        self.kv_cache = kv_cache
+        self.seq_ids = seq_ids
+        self.past_width = past_width
+        self._index = {}
+        self._flat = index
+        self._new = index[:, past_width:]
+
+    def _on(self, device):
+        """(all slots, new slots) on device, moved once per device"""
+        if device not in self._index:
+            self._index[device] = (self._flat.reshape(-1).to(device), self._new.reshape(-1).to(device))
+        return self._index[device]
+
+    def _store(self, layer_idx, key_states, value_states):
+        """Write the last positions of `[B, heads, new, head_dim]` keys and values to their slots"""
+        k_pool, v_pool = self.kv_cache.pools[layer_idx]
+        _, new_slots = self._on(k_pool.device)
+        count = self._new.shape[1]
+        k_pool.index_copy_(0, new_slots, key_states[:, :, -count:, :].transpose(1, 2).flatten(0, 1).to(k_pool.dtype))
+        v_pool.index_copy_(0, new_slots, value_states[:, :, -count:, :].transpose(1, 2).flatten(0, 1).to(v_pool.dtype))
+
+    def _read(self, layer_idx, width):
+        """`[B, heads, width, head_dim]` keys and values of the first `width` visible positions"""
+        k_pool, v_pool = self.kv_cache.pools[layer_idx]
+        all_slots, _ = self._on(k_pool.device)
+        slots = all_slots.view(self._flat.shape)[:, :width].reshape(-1)
+        shape = (self._flat.shape[0], width) + tuple(k_pool.shape[1:])
+        return (k_pool.index_select(0, slots).view(shape).transpose(1, 2),
+                v_pool.index_select(0, slots).view(shape).transpose(1, 2))
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        self._store(layer_idx, key_states, value_states)
+        keys, values = self._read(layer_idx, self._flat.shape[1])
+        return keys.to(key_states.dtype), values.to(value_states.dtype)
+
+    def __len__(self):
+        return len(self.kv_cache.pools)
+
+    def __getitem__(self, layer_idx):
+        if layer_idx >= len(self):
+            raise IndexError(layer_idx)
+        return self._read(layer_idx, self.past_width)
+
+    def __iter__(self):
+        return (self[layer_idx] for layer_idx in range(len(self)))
+
+    def commit(self, past_key_values):
+        """Finish the pass: store a legacy model's returned KV, then advance every sequence's length"""
+        if past_key_values is not None and past_key_values is not self:
+            for layer_idx, (k, v) in enumerate(past_key_values):
+                self._store(layer_idx, k, v)
+        for seq_id in self.seq_ids:
+            self.kv_cache.lengths[seq_id] += self._new.shape[1]
+
+    def get_seq_length(self, layer_idx=0):
+        return self.past_width
+
+    def get_max_length(self):
+        return None
+
+    def get_max_cache_shape(self):
+        return None
+
+    def get_mask_sizes(self, cache_position, layer_idx=0):
+        return self._flat.shape[1], 0
+
+    @property
+    def is_compileable(self):
+        return False
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Multi-GPU Placement Planner for the LM Studio Servers
+- Splits decoder layers into contiguous per-GPU ranges from each device's free memory
+- Every layer carries its share of KV-cache headroom, so all GPUs keep room to decode
+- The split minimises the fullest GPU instead of filling GPU 0 first like device_map="auto"
+
+The planning core works on plain byte counts; run this file to see plans
+for simulated inventories on a machine without GPUs.
+"""
+
+import torch
+
+from paged_kv_cache import decoder_layers, kv_shape
+
+
+class PlacementError(Exception):
+    """The model does not fit on the devices it was offered"""
+
+
+class Placement:
+    """A layer-to-device split plus what it is projected to use on each device"""
+
+    def __init__(self, layer_devices, devices, utilization, device_map=None):
+        self.layer_devices = layer_devices
+        self.devices = devices
+        self.utilization = utilization
+        self.device_map = device_map or {}
+
+    def stats(self):
+        return {
+            'utilization': round(self.utilization, 3),
+            'devices': {
+                str(device): {
+                    'layers': info['layers'],
+                    'weights_gb': round(info['weights'] / 1e9, 2),
+                    'kv_reserve_gb': round(info['kv_reserve'] / 1e9, 2),
+                    'projected_gb': round((info['weights'] + info['kv_reserve']) / 1e9, 2),
+                    'free_gb': round(info['free'] / 1e9, 2),
+                }
+                for device, info in self.devices.items()
+            },
+        }
+
+
+def _pack(layer_costs, capacities, first_fixed, last_fixed, ratio):
+    """Fill devices in order up to ratio x capacity; per-layer device indices, or None if layers are left over"""
+    count = len(capacities)
+    loads = [0.0] * count
+    loads[0] += first_fixed
+    loads[-1] += last_fixed
+    if any(load > cap * ratio for load, cap in zip(loads, capacities)):
+        return None
+    assignment = []
+    device = 0
+    for cost in layer_costs:
+        while loads[device] + cost > capacities[device] * ratio:
+            device += 1
+            if device == count:
+                return None
+        loads[device] += cost
+        assignment.append(device)
+    return assignment
+
+
+def plan_layers(layer_bytes, device_free, kv_bytes_per_layer=0, first_bytes=0, last_bytes=0, reserve_bytes=0):
+    """Contiguous split of layers over devices that minimises the highest utilisation.
+
+    layer_bytes: weight bytes of each decoder layer, in model order
+    device_free: {device_id: free bytes}, in pipeline order
+    kv_bytes_per_layer: KV-cache headroom to keep next to every layer
+    first_bytes / last_bytes: embeddings (first device) and final norm + head (last device)
+    reserve_bytes: activation / allocator headroom left untouched on every device
+    """
+    device_ids = list(device_free)
+    if not device_ids:
+        raise PlacementError('No devices to place the model on')
+    capacities = [max(0.0, device_free[d] - reserve_bytes) for d in device_ids]
+    costs = [b + kv_bytes_per_layer for b in layer_bytes]
+    needed = sum(costs) + first_bytes + last_bytes
+    if sum(capacities) <= 0 or _pack(costs, capacities, first_bytes, last_bytes, 1.0) is None:
+        raise PlacementError(
+            f'Model needs {needed / 1e9:.1f}GB including KV headroom but only '
+            f'{sum(capacities) / 1e9:.1f}GB is free across {len(device_ids)} device(s)'
+        )
+
+    # Bisect on the utilisation ceiling; the smallest feasible one is the balanced split
+    low, high = 0.0, 1.0
+    for _ in range(40):
+        mid = (low + high) / 2
+        if _pack(costs, capacities, first_bytes, last_bytes, mid) is None:
+            low = mid
+        else:
+            high = mid
+    assignment = _pack(costs, capacities, first_bytes, last_bytes, high)
+
+    devices = {d: {'layers': 0, 'weights': 0, 'kv_reserve': 0, 'free': device_free[d]} for d in device_ids}
+    devices[device_ids[0]]['weights'] += first_bytes
+    devices[device_ids[-1]]['weights'] += last_bytes
+    for index, size in zip(assignment, layer_bytes):
+        info = devices[device_ids[index]]
+        info['layers'] += 1
+        info['weights'] += size
+        info['kv_reserve'] += kv_bytes_per_layer
+    return Placement([device_ids[i] for i in assignment], devices, high)
+
+
+def device_inventory():
+    """{gpu index: bytes actually free right now}, counting memory held by other processes"""
+    return {i: torch.cuda.mem_get_info(i)[0] for i in range(torch.cuda.device_count())}
+
+
+def _module_bytes(module, element_size):
+    """Parameters at the load dtype, plus buffers (quantized weights and their scales) at their own size"""
+    params = sum(p.numel() for p in module.parameters()) * element_size
+    return params + sum(b.numel() * b.element_size() for b in module.buffers())
+
+
+def plan_model(model, dtype, device_free, kv_tokens, reserve_bytes=0):
+    """Placement plus a from_pretrained-compatible device_map for a (meta-device) model skeleton"""
+    layers = decoder_layers(model)
+    if not layers:
+        raise PlacementError('Could not find the decoder layers of this model')
+    element_size = torch.tensor([], dtype=dtype).element_size()
+    names = {id(module): name for name, module in model.named_modules()}
+    layer_names = [names[id(layer)] for layer in layers]
+    container = layer_names[0].rsplit('.', 1)[0]
+
+    # Modules registered before the layer stack (embeddings) go first, the rest (norm, head) last
+    first, last = [], []
+    seen_layers = False
+    for name, module in model.named_modules():
+        if name == container:
+            seen_layers = True
+            continue
+        if not name or name.startswith(container + '.') or container.startswith(name + '.'):
+            continue
+        if any(name.startswith(other + '.') for other in first + last):
+            continue
+        if next(module.parameters(), None) is None:
+            # Parameterless modules only matter for their buffers (e.g. rotary tables); keep them up front
+            if next(module.buffers(), None) is not None:
+                first.append(name)
+            continue
+        (last if seen_layers else first).append(name)
+
+    # Tied heads share the embedding tensor, so they have to sit with it
+    tied = getattr(model.config, 'tie_word_embeddings', False)
+    head_names = [n for n in last if n.split('.')[-1] in ('lm_head', 'embed_out')]
+    if tied:
+        for name in head_names:
+            last.remove(name)
+            first.append(name)
+
+    _, kv_heads, head_dim = kv_shape(model.config)
+    kv_bytes_per_layer = 2 * kv_heads * head_dim * element_size * kv_tokens
+    unique_bytes = lambda names_: sum(
+        _module_bytes(model.get_submodule(n), element_size) for n in names_ if not (tied and n in head_names)
+    )
+    placement = plan_layers(
+        [_module_bytes(layer, element_size) for layer in layers],
+        device_free,
+        kv_bytes_per_layer=kv_bytes_per_layer,
+        first_bytes=unique_bytes(first),
+        last_bytes=unique_bytes(last),
+        reserve_bytes=reserve_bytes,
+    )
+    device_ids = list(device_free)
+    device_map = {name: device_ids[0] for name in first}
+    device_map.update({name: device for name, device in zip(layer_names, placement.layer_devices)})
+    device_map.update({name: device_ids[-1] for name in last})
+    placement.device_map = device_map
+    return placement
+
+
+if __name__ == '__main__':
+    # Simulated inventories for the allocations the GUI requests by default
+    GB = 1e9
+    layer = 0.47 * GB    # Qwen2.5-7B decoder layer in fp16
+    kv = 2 * 4 * 128 * 2 * 4096     # 4 KV heads x 128 dims, fp16, 4K tokens of headroom per layer
+    inventories = {
+        'l40s:2': {0: 44 * GB, 1: 44 * GB},
+        'h100:2 (GPU 0 busy)': {0: 50 * GB, 1: 79 * GB},
+        'a100:2 40GB': {0: 39 * GB, 1: 39 * GB},
+    }
+    for label, free in inventories.items():
+        for layers in (28, 64):
+            try:
+                plan = plan_layers([layer] * layers, free, kv_bytes_per_layer=kv,
+                                   first_bytes=1.1 * GB, last_bytes=1.1 * GB, reserve_bytes=2 * GB)
+                split = {d: info['layers'] for d, info in plan.devices.items()}
+                print(f"{label:<22} {layers} layers -> {split}, peak utilisation {plan.utilization:.0%}")
+            except PlacementError as e:
+                print(f"{label:<22} {layers} layers -> {e}")
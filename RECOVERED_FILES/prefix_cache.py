@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Radix-Tree Prefix Cache for LM Studio Server v3
+- Keeps prefill KV tensors keyed on token-ID prefixes
+- Shared system prompts / few-shot headers are prefilled once
+- LRU eviction of leaves under a GPU-memory budget
+"""
+
+import time
+
+import torch
+
+
+def _kv_nbytes(kv):
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+
+
+def _slice_kv(kv, start, end):
+    """Copy positions [start, end) out of per-layer KV so the source can be freed"""
+    return [(k[:, :, start:end, :].clone(), v[:, :, start:end, :].clone()) for k, v in kv]
+
+
+class _Node:
+    __slots__ = ('tokens', 'kv', 'children', 'parent', 'last_access', 'nbytes')
+
+    def __init__(self, tokens=(), kv=None, parent=None):
+        self.tokens = tokens
+        self.kv = kv
+        self.children = {}
+        self.parent = parent
+        self.last_access = time.monotonic()
+        self.nbytes = _kv_nbytes(kv) if kv else 0
+
+
+class PrefixCache:
+    """Radix tree over token IDs whose edges carry the KV for their tokens.
+
+    `match()` walks the tree and returns the KV for the longest cached
+    prefix (partial edges included), `insert()` adds a fully prefilled
+    prompt, splitting edges where it diverges from what is cached.
+    """
+
+    def __init__(self, budget_bytes, min_tokens=8):
+        self.budget_bytes = budget_bytes
+        self.min_tokens = min_tokens
+        self.root = _Node()
+        self.total_bytes = 0
+
+        self.lookups = 0
+        self.hits = 0
+        self.prompt_tokens = 0
+        self.saved_tokens = 0
+        self.evictions = 0
+
+    def match(self, token_ids):
+        """Return (matched_length, kv) for the longest cached prefix of token_ids"""
+        self.lookups += 1
+        self.prompt_tokens += len(token_ids)
+
+        node = self.root
+        matched = 0
+        pieces = []
+        now = time.monotonic()
+        while matched < len(token_ids):
+            child = node.children.get(token_ids[matched])
+            if child is None:
+                break
+            common = 0
+            edge = child.tokens
+            while (common < len(edge) and matched + common < len(token_ids)
+                   and edge[common] == token_ids[matched + common]):
+                common += 1
+            child.last_access = now
+            if common == len(edge):
+                pieces.append(child.kv)
+            else:
+                pieces.append([(k[:, :, :common, :], v[:, :, :common, :]) for k, v in child.kv])
+            matched += common
+            if common < len(edge):
+                break
+            node = child
+
+        if matched < self.min_tokens:
+            return 0, None
+
+        self.hits += 1
+        self.saved_tokens += matched
+        if len(pieces) == 1:
+            return matched, pieces[0]
+        kv = [
+            (torch.cat([piece[layer][0] for piece in pieces], dim=-2),
+             torch.cat([piece[layer][1] for piece in pieces], dim=-2))
+            for layer in range(len(pieces[0]))
+        ]
+        return matched, kv
+
+    def insert(self, token_ids, kv):
+        """Cache the KV of a prefilled prompt; kv must cover every token in token_ids"""
+        if self.budget_bytes <= 0 or len(token_ids) < self.min_tokens:
+            return
+
+        node = self.root
+        offset = 0
+        now = time.monotonic()
+        while offset < len(token_ids):
+            child = node.children.get(token_ids[offset])
+            if child is None:
+                leaf = _Node(tuple(token_ids[offset:]), _slice_kv(kv, offset, len(token_ids)), node)
+                node.children[token_ids[offset]] = leaf
+                self.total_bytes += leaf.nbytes
+                break
+
+            edge = child.tokens
+            common = 0
+            while (common < len(edge) and offset + common < len(token_ids)
+                   and edge[common] == token_ids[offset + common]):
+                common += 1
+            child.last_access = now
+            if common < len(edge):
+                child = self._split(child, common)
+            node = child
+            offset += common
+
+        self._evict()
+
+    def _split(self, node, at):
+        """Split node's edge so that its first `at` tokens become a new parent"""
+        parent = node.parent
+        head = _Node(node.tokens[:at], [(k[:, :, :at, :].clone(), v[:, :, :at, :].clone()) for k, v in node.kv], parent)
+        head.last_access = node.last_access
+        tail_kv = [(k[:, :, at:, :].clone(), v[:, :, at:, :].clone()) for k, v in node.kv]
+
+        parent.children[node.tokens[0]] = head
+        self.total_bytes -= node.nbytes
+        node.tokens = node.tokens[at:]
+        node.kv = tail_kv
+        node.nbytes = _kv_nbytes(tail_kv)
+        node.parent = head
+        head.children[node.tokens[0]] = node
+        self.total_bytes += head.nbytes + node.nbytes
+        return head
+
+    def _evict(self):
+        while self.total_bytes > self.budget_bytes:
+            leaves = []
+            stack = list(self.root.children.values())
+            while stack:
+                current = stack.pop()
+                if current.children:
+                    stack.extend(current.children.values())
+                else:
+                    leaves.append(current)
+            if not leaves:
+                break
+            victim = min(leaves, key=lambda n: n.last_access)
+            del victim.parent.children[victim.tokens[0]]
+            self.total_bytes -= victim.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self.root = _Node()
+        self.total_bytes = 0
+
+    def stats(self):
+        return {
+            'lookups': self.lookups,
+            'hits': self.hits,
+            'hit_rate': round(self.hits / self.lookups, 3) if self.lookups else 0,
+            'saved_tokens': self.saved_tokens,
+            'saved_token_ratio': round(self.saved_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0,
+            'cached_gb': round(self.total_bytes / 1e9, 3),
+            'budget_gb': round(self.budget_bytes / 1e9, 3),
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""
+Weight-Only Quantization for LM Studio Server v3
+- int4 weights with one scale per group of input channels; int8 and fp8 (e4m3, where torch supports it) with one per output row
+- Linear layers inside the decoder blocks are swapped for QuantizedLinear; embeddings and the head stay 16-bit
+- On CUDA the matmul runs in torch's fused weight-only kernels; dequantize + F.linear is the CPU path and reference
+
+Run this file to check round-trip error and layer outputs on CPU (and on a GPU if there is one).
+"""
+
+import torch
+import torch.nn.functional as F
+
+from paged_kv_cache import decoder_layers
+
+try:
+    from transformers.pytorch_utils import Conv1D
+except ImportError:
+    Conv1D = None
+
+DEFAULT_GROUP_SIZE = 128
+FP8_AVAILABLE = hasattr(torch, 'float8_e4m3fn')
+SCHEMES = ('int8', 'int4', 'fp8') if FP8_AVAILABLE else ('int8', 'int4')
+# Largest magnitude each scheme stores; a group's scale maps its absmax onto it
+QMAX = {'int8': 127, 'int4': 7, 'fp8': 448.0}
+# torch's int8 and fp8 matmul kernels take one scale per output channel, so those schemes are never grouped
+ROW_SCALED = ('int8', 'fp8')
+# torch's tinygemm int4 kernel: supported group sizes and the K-tiling its packed layout uses
+INT4_KERNEL_GROUPS = (32, 64, 128, 256)
+INT4_INNER_K_TILES = 8
+
+
+def fused_kernel_for(scheme, group_size):
+    """Whether torch has a fused CUDA matmul for this scheme (int4's kernel only takes some group sizes)"""
+    if scheme == 'int8':
+        return hasattr(torch, '_weight_int8pack_mm')
+    if scheme == 'int4':
+        return group_size in INT4_KERNEL_GROUPS and hasattr(torch, '_weight_int4pack_mm')
+    return hasattr(torch, '_scaled_mm')
+
+
+def group_size_for(in_features, group_size=DEFAULT_GROUP_SIZE, scheme='int4'):
+    """group_size if it divides the row (and keeps int4 pairs whole), else one group per row; int8 / fp8 always use rows"""
+    if scheme not in ROW_SCALED and group_size and in_features % group_size == 0 and group_size % 2 == 0:
+        return group_size
+    return in_features
+
+
+def quantize_weight(weight, scheme, group_size=DEFAULT_GROUP_SIZE):
+    """`[out, in]` weight -> (packed weight, `[out, in / group]` scales in the weight's dtype)"""
+    if scheme not in SCHEMES:
+        raise ValueError(f"Unknown quantization '{scheme}' (supported: {', '.join(SCHEMES)})")
+    out_features, in_features = weight.shape
+    group = group_size_for(in_features, group_size, scheme)
+    grouped = weight.float().reshape(out_features, in_features // group, group)
+    scales = grouped.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / QMAX[scheme]
+    scaled = grouped / scales
+    if scheme == 'int8':
+        packed = scaled.round().clamp(-127, 127).to(torch.int8).reshape(out_features, in_features)
+    elif scheme == 'int4':
+        # Two 4-bit values per byte, offset by 8 so they are unsigned
+        nibbles = (scaled.round().clamp(-8, 7) + 8).to(torch.uint8).reshape(out_features, in_features)
+        packed = nibbles[:, 0::2] | (nibbles[:, 1::2] << 4)
+    else:
+        packed = scaled.to(torch.float8_e4m3fn).reshape(out_features, in_features)
+    return packed, scales.squeeze(-1).to(weight.dtype)
+
+
+def dequantize_weight(packed, scales, scheme, dtype=torch.float16):
+    """Inverse of quantize_weight, producing a `[out, in]` weight in dtype"""
+    if scheme == 'int4':
+        values = torch.stack([(packed & 0x0F), (packed >> 4)], dim=-1).flatten(-2).to(torch.int8) - 8
+    else:
+        values = packed
+    out_features, in_features = values.shape
+    groups = scales.shape[-1]
+    grouped = values.to(dtype).reshape(out_features, groups, in_features // groups)
+    return (grouped * scales.to(dtype).unsqueeze(-1)).reshape(out_features, in_features)
+
+
+class QuantizedLinear(torch.nn.Module):
+    """nn.Linear with a quantized weight.
+
+    The packed weight and its scales are buffers, so device moves, state
+    dicts and accelerate's dispatch treat them like any other tensor.
+    `transposed` marks layers converted from GPT-2 style Conv1D, whose
+    checkpoint weights are stored `[in, out]`.
+
+    On CUDA, forward() calls torch's fused weight-only matmul:
+    _weight_int8pack_mm, _weight_int4pack_mm or _scaled_mm with fp8
+    activations quantized per row. On CPU, for int4 groups the kernel does
+    not take, or if the GPU rejects the kernel, the weight is expanded per
+    forward pass.
+
+    The int4 kernel reads its own tiled layout. On first use the packed
+    weight is converted into the `int4_tiles` buffer and `qweight` is
+    dropped, so only one copy sits in VRAM. Any device move or cast, and
+    state_dict(), turn the tiles back into the checkpoint layout.
+    """
+
+    def __init__(self, in_features, out_features, bias=True, scheme='int8', group_size=DEFAULT_GROUP_SIZE,
+                 dtype=torch.float16, device=None, transposed=False):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.scheme = scheme
+        self.group_size = group_size_for(in_features, group_size, scheme)
+        self.transposed = transposed
+        packed_dtype = {'int8': torch.int8, 'int4': torch.uint8}.get(scheme) or torch.float8_e4m3fn
+        packed_width = in_features // 2 if scheme == 'int4' else in_features
+        self.register_buffer('qweight', torch.empty((out_features, packed_width), dtype=packed_dtype, device=device))
+        self.register_buffer('scales', torch.empty((out_features, in_features // self.group_size), dtype=dtype, device=device))
+        self.bias = torch.nn.Parameter(torch.empty(out_features, dtype=dtype, device=device), requires_grad=False) if bias else None
+        self.fused = fused_kernel_for(scheme, self.group_size)
+        # tinygemm layout of an int4 weight while it replaces qweight; never saved
+        self.register_buffer('int4_tiles', None, persistent=False)
+        self.register_buffer('int4_scales', None, persistent=False)
+
+    @classmethod
+    def from_module(cls, module, scheme, group_size=DEFAULT_GROUP_SIZE):
+        """Quantized replacement for an nn.Linear / Conv1D; stays on the meta device for skeletons"""
+        transposed = Conv1D is not None and isinstance(module, Conv1D)
+        weight = module.weight.t() if transposed else module.weight
+        out_features, in_features = weight.shape
+        layer = cls(in_features, out_features, bias=module.bias is not None, scheme=scheme, group_size=group_size,
+                    dtype=weight.dtype, device=weight.device, transposed=transposed)
+        if weight.device.type != 'meta':
+            layer.load_weight(weight.detach())
+            if module.bias is not None:
+                layer.bias.data.copy_(module.bias.detach())
+        return layer
+
+    def quantize(self, weight):
+        """(qweight, scales) for a checkpoint weight, in the checkpoint's own layout"""
+        if self.transposed:
+            weight = weight.t()
+        return quantize_weight(weight, self.scheme, self.group_size)
+
+    def load_weight(self, weight):
+        """Quantize an `[out, in]` weight into this layer"""
+        self.qweight, self.scales = quantize_weight(weight, self.scheme, self.group_size)
+        self.int4_tiles = self.int4_scales = None
+
+    def packed_weight(self):
+        """qweight in the checkpoint layout, rebuilt from the int4 tiles if they replaced it"""
+        return self.qweight if self.qweight is not None else self._untile()
+
+    def dequantize(self, dtype=None):
+        return dequantize_weight(self.packed_weight(), self.scales, self.scheme, dtype or self.scales.dtype)
+
+    @property
+    def weight(self):
+        # Some model code reads .weight.dtype / .device; hand it the expanded weight
+        return self.dequantize()
+
+    def _tile(self):
+        """Build the int4 tiles and their scales-and-zeros from qweight (which stays until the kernel has run)"""
+        # tinygemm wants the even input channel in the high nibble; ours is in the low one
+        swapped = (self.qweight << 4) | (self.qweight >> 4)
+        tiles = torch._convert_weight_to_int4pack(swapped.contiguous(), INT4_INNER_K_TILES)
+        scales = self.scales.t().to(torch.bfloat16)
+        # Dequantized as (q - 8) * scale + zero; symmetric groups have zero = 0
+        self.int4_scales = torch.stack([scales, torch.zeros_like(scales)], dim=-1).contiguous()
+        self.int4_tiles = tiles
+
+    def _untile(self, rows=1024):
+        """Packed `[out, in / 2]` weight from the tiles: the kernel applied to an identity, then requantized.
+
+        The kernel's bf16 output is (q - 8) * scale to within 2^-9 relative,
+        so dividing by the scale and rounding gives q back exactly.
+        """
+        device = self.int4_tiles.device
+        columns = []
+        for start in range(0, self.in_features, rows):
+            count = min(rows, self.in_features - start)
+            eye = torch.zeros((count, self.in_features), dtype=torch.bfloat16, device=device)
+            eye[torch.arange(count, device=device), torch.arange(start, start + count, device=device)] = 1
+            columns.append(torch._weight_int4pack_mm(eye, self.int4_tiles, self.group_size, self.int4_scales))
+        weight = torch.cat(columns).t().float()
+        scales = self.int4_scales[..., 0].t().float().repeat_interleave(self.group_size, dim=1)
+        nibbles = ((weight / scales).round().clamp(-8, 7) + 8).to(torch.uint8)
+        return nibbles[:, 0::2] | (nibbles[:, 1::2] << 4)
+
+    def _restore_packed(self):
+        if self.int4_tiles is not None:
+            if self.qweight is None:
+                self.qweight = self._untile()
+            self.int4_tiles = self.int4_scales = None
+
+    def _apply(self, fn, *args, **kwargs):
+        # The tiles are only meaningful to the CUDA kernel: move or cast the checkpoint layout instead
+        self._restore_packed()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+        if self.qweight is None:
+            # Built on the CPU, so saving a whole model never needs a second copy of its int4 weights in VRAM
+            destination[prefix + 'qweight'] = self._untile().cpu()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self._restore_packed()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _fused_matmul(self, x):
+        """x @ W.T with the weight still quantized; x is `[rows, in_features]`"""
+        if self.scheme == 'int8':
+            return torch._weight_int8pack_mm(x, self.qweight, self.scales[:, 0].to(x.dtype))
+        if self.scheme == 'int4':
+            if self.int4_tiles is None:
+                self._tile()
+            out = torch._weight_int4pack_mm(x.to(torch.bfloat16), self.int4_tiles, self.group_size, self.int4_scales)
+            self.qweight = None  # the kernel works on this GPU: the tiles are the only copy from now on
+            return out.to(x.dtype)
+        x_scales = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-12) / QMAX['fp8']
+        x_fp8 = (x / x_scales).to(torch.float8_e4m3fn)
+        return torch._scaled_mm(x_fp8, self.qweight.t(), scale_a=x_scales, scale_b=self.scales.float().t(),
+                                out_dtype=torch.bfloat16).to(x.dtype)
+
+    def forward(self, x):
+        if self.fused and x.is_cuda:
+            try:
+                out = self._fused_matmul(x.reshape(-1, self.in_features)).reshape(*x.shape[:-1], self.out_features)
+                return out + self.bias.to(out.dtype) if self.bias is not None else out
+            except RuntimeError as e:
+                print(f"⚠️  Fused {self.scheme} matmul unavailable on this GPU, dequantizing instead: {e}")
+                self.fused = False
+                self._restore_packed()
+        return F.linear(x, self.dequantize(x.dtype), self.bias)
+
+    def extra_repr(self):
+        return (f'in_features={self.in_features}, out_features={self.out_features}, '
+                f'scheme={self.scheme}, group_size={self.group_size}')
+
+
+def quantize_model(model, scheme, group_size=DEFAULT_GROUP_SIZE):
+    """Swap every linear layer inside the decoder blocks for a QuantizedLinear; returns how many were swapped.
+
+    Works on meta-device skeletons (empty quantized layers for the loader to
+    fill) as well as on loaded models (weights are quantized in place).
+    """
+    if scheme not in SCHEMES:
+        raise ValueError(f"Unknown quantization '{scheme}' (supported: {', '.join(SCHEMES)})")
+    linear_types = (torch.nn.Linear,) + ((Conv1D,) if Conv1D is not None else ())
+    swapped = 0
+    for layer in decoder_layers(model):
+        for name, module in list(layer.named_modules()):
+            if not isinstance(module, linear_types):
+                continue
+            parent_name, _, child = name.rpartition('.')
+            parent = layer.get_submodule(parent_name) if parent_name else layer
+            setattr(parent, child, QuantizedLinear.from_module(module, scheme, group_size))
+            swapped += 1
+    model.config.quantization_scheme = scheme
+    return swapped
+
+
+def quantized_layers(model):
+    """{module name: QuantizedLinear} for a model (empty if it is not quantized)"""
+    return {name: module for name, module in model.named_modules() if isinstance(module, QuantizedLinear)}
+
+
+def self_check(device='cpu', dtype=torch.float32, group_size=DEFAULT_GROUP_SIZE):
+    """Round-trip and layer-output error of every scheme on random weights; returns {scheme: stats}"""
+    generator = torch.Generator().manual_seed(0)
+    weight = torch.randn(512, 1024, generator=generator).to(device, dtype) * 0.02
+    x = torch.randn(8, 1024, generator=generator).to(device, dtype)
+    reference = torch.nn.Linear(1024, 512, bias=False).to(device, dtype).requires_grad_(False)
+    reference.weight.copy_(weight)
+    expected = reference(x)
+    results = {}
+    for scheme in SCHEMES:
+        layer = QuantizedLinear.from_module(reference, scheme, group_size)
+        restored = layer.dequantize(dtype)
+        # The CPU path is the reference: quantizing on another device must give the same packed bits
+        cpu_packed, _ = quantize_weight(weight.cpu().float().to(dtype), scheme, group_size)
+        results[scheme] = {
+            'weight_rel_error': float((restored - weight).norm() / weight.norm()),
+            'output_rel_error': float((layer(x) - expected).norm() / expected.norm()),
+            'bytes_ratio': (layer.packed_weight().numel() * layer.packed_weight().element_size()
+                            + layer.scales.numel() * layer.scales.element_size())
+                           / (weight.numel() * weight.element_size()),
+            'matches_cpu': bool(torch.equal(layer.packed_weight().cpu().view(torch.uint8), cpu_packed.view(torch.uint8))),
+            'fused': layer.fused and x.is_cuda,
+        }
+    return results
+
+
+if __name__ == '__main__':
+    # Expected error ceilings for Gaussian weights: 128-wide int4 groups, per-row int8 / fp8 scales
+    limits = {'int8': 0.01, 'int4': 0.15, 'fp8': 0.05}
+    devices = [('cpu', torch.float32)] + ([('cuda', torch.float16)] if torch.cuda.is_available() else [])
+    failed = False
+    for device, dtype in devices:
+        for scheme, stats in self_check(device, dtype).items():
+            ok = stats['output_rel_error'] < limits[scheme] and stats['matches_cpu']
+            failed |= not ok
+            print(f"{'✅' if ok else '❌'} {device:<5} {scheme:<5} weight error {stats['weight_rel_error']:.4f}, "
+                  f"output error {stats['output_rel_error']:.4f}, {stats['bytes_ratio']:.2f}x the bytes"
+                  f"{', fused kernel' if stats['fused'] else ''}"
+                  f"{'' if stats['matches_cpu'] else ', differs from CPU reference'}")
+    raise SystemExit(1 if failed else 0)
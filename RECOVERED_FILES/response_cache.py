@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Exact-Match Response Cache for LM Studio Server v3
+- Replays the output of deterministic requests (greedy, or sampled with a seed) instead of re-running the model
+- Keyed by model revision, prompt token IDs and every sampling parameter that can change the output
+- Size-bounded in-memory LRU with a TTL; evicted entries can spill to disk and be promoted back on a hit
+"""
+
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+
+def cacheable(temperature, seed):
+    """Only requests whose output is a function of the key may be replayed"""
+    return temperature is None or temperature <= 0 or seed is not None
+
+
+def response_key(model_name, revision, token_ids, params):
+    """sha256 over the model, its weights and the normalized request"""
+    payload = json.dumps([model_name, revision, list(token_ids), params], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    """LRU of JSON-able responses, at most `max_bytes` in memory, each valid for `ttl` seconds.
+
+    With a `spill_dir`, entries pushed out of memory are written there as
+    one JSON file each (at most `spill_bytes` in total, oldest files
+    dropped first) and promoted back into memory when they are hit again.
+    Expired entries are dropped lazily, on lookup or eviction.
+
+    The spill directory may be on NFS, so no file is touched under the lock
+    or on the request path for a key that was never spilled: a background
+    thread writes and deletes the files, and an in-memory index of spilled
+    keys (read from the directory once at startup) answers which keys are
+    on disk. Entries waiting to be written are still served from memory.
+    """
+
+    def __init__(self, max_bytes, ttl=3600.0, spill_dir=None, spill_bytes=0, clock=time.time):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill_dir = spill_dir if spill_bytes > 0 else None
+        self.spill_bytes = spill_bytes
+        self.clock = clock
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expired = 0
+        self.bytes = 0
+        self.spilled_bytes = 0
+        self._entries = OrderedDict()  # key -> (stored_at, size, value)
+        self._pending = {}  # key -> (stored_at, size, value) evicted but not written yet
+        self._spilled = OrderedDict()  # key -> (stored_at, file size), oldest first
+        self._lock = threading.Lock()
+        self._writes = queue.Queue()
+        if self.spill_dir is not None:
+            threading.Thread(target=self._writer, name='response-cache-spill', daemon=True).start()
+
+    def get(self, key):
+        """Cached value for key, or None on a miss"""
+        now = self.clock()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                if now - item[0] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return item[2]
+                self._drop(key)
+                self.expired += 1
+            item = self._pending.pop(key, None)
+            if item is not None and now - item[0] > self.ttl:
+                self.expired += 1
+                self.misses += 1
+                return None
+            spilled = self._spilled.pop(key, None) if item is None else None
+            if spilled is not None:
+                self.spilled_bytes -= spilled[1]
+                if now - spilled[0] > self.ttl:
+                    self.expired += 1
+                    self._writes.put(('remove', key))
+                    spilled = None
+            if item is None and spilled is None:
+                self.misses += 1
+                return None
+        if item is None:
+            item = self._read_spilled(key, now)
+        with self._lock:
+            if item is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._insert(key, *item)
+        return item[2]
+
+    def put(self, key, value):
+        encoded = json.dumps(value)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            # A fresh value supersedes any older copy waiting for, or already on, the disk
+            self._pending.pop(key, None)
+            spilled = self._spilled.pop(key, None)
+            if spilled is not None:
+                self.spilled_bytes -= spilled[1]
+                self._writes.put(('remove', key))
+            self._insert(key, self.clock(), len(encoded), value)
+            self.stores += 1
+
+    def _insert(self, key, stored_at, size, value):
+        """Add an entry (lock held); evicted entries still within their TTL are queued for the spill writer"""
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (stored_at, size, value)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            victim, item = next(iter(self._entries.items()))
+            self._drop(victim)
+            self.evictions += 1
+            if self.spill_dir is not None and self.clock() - item[0] <= self.ttl:
+                self._pending[victim] = item
+                self._writes.put(('spill', victim))
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def _path(self, key):
+        return os.path.join(self.spill_dir, f'{key}.json')
+
+    def _writer(self):
+        """Spill-thread loop: index the directory once, then write, trim and delete files as asked"""
+        self._index_spilled()
+        while True:
+            action, key = self._writes.get()
+            try:
+                if action == 'spill':
+                    self._spill(key)
+                elif action == 'remove':
+                    os.remove(self._path(key))
+                elif action == 'clear':
+                    for name in os.listdir(self.spill_dir):
+                        if name.endswith(('.json', '.partial')):
+                            os.remove(os.path.join(self.spill_dir, name))
+            except OSError as e:
+                if action == 'spill':
+                    with self._lock:
+                        self._pending.pop(key, None)
+                if action != 'remove':
+                    print(f"⚠️  Response cache spill failed: {e}")
+
+    def _index_spilled(self):
+        """Load what earlier runs left in the spill directory into the index, oldest first"""
+        try:
+            files = []
+            for name in os.listdir(self.spill_dir):
+                if name.endswith('.json'):
+                    stat = os.stat(os.path.join(self.spill_dir, name))
+                    files.append((stat.st_mtime, stat.st_size, name[:-len('.json')]))
+        except OSError:
+            return
+        with self._lock:
+            for mtime, size, key in sorted(files):
+                if key not in self._spilled:
+                    self._spilled[key] = (mtime, size)
+                    self.spilled_bytes += size
+        self._trim_spill()
+
+    def _spill(self, key):
+        with self._lock:
+            item = self._pending.get(key)
+        if item is None:
+            return  # hit again (and back in memory) before it was written
+        stored_at, _, value = item
+        os.makedirs(self.spill_dir, exist_ok=True)
+        partial = self._path(key) + '.partial'
+        with open(partial, 'w') as f:
+            json.dump({'stored_at': stored_at, 'value': value}, f)
+        size = os.path.getsize(partial)
+        os.replace(partial, self._path(key))
+        with self._lock:
+            if self._pending.get(key) is not item:
+                self._writes.put(('remove', key))  # promoted while it was being written
+                return
+            del self._pending[key]
+            previous = self._spilled.pop(key, None)
+            if previous is not None:
+                self.spilled_bytes -= previous[1]  # the file was just overwritten
+            self._spilled[key] = (stored_at, size)
+            self.spilled_bytes += size
+        self._trim_spill()
+
+    def _trim_spill(self):
+        """Delete the oldest spilled files until the directory fits spill_bytes"""
+        victims = []
+        with self._lock:
+            while self._spilled and self.spilled_bytes > self.spill_bytes:
+                key, (_, size) = self._spilled.popitem(last=False)
+                self.spilled_bytes -= size
+                victims.append(key)
+        for key in victims:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _read_spilled(self, key, now):
+        """(stored_at, size, value) of a spilled entry, removing its file either way"""
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        finally:
+            self._writes.put(('remove', key))
+        if now - record['stored_at'] > self.ttl:
+            with self._lock:
+                self.expired += 1
+            return None
+        return record['stored_at'], len(json.dumps(record['value'])), record['value']
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pending.clear()
+            self._spilled.clear()
+            self.bytes = 0
+            self.spilled_bytes = 0
+        if self.spill_dir is not None:
+            self._writes.put(('clear', None))
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'used_mb': round(self.bytes / 1e6, 2),
+            'budget_mb': round(self.max_bytes / 1e6, 2),
+            'ttl_seconds': self.ttl,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0,
+            'stores': self.stores,
+            'evictions': self.evictions,
+            'expired': self.expired,
+            'spill_dir': self.spill_dir,
+            'spilled_entries': len(self._spilled),
+            'spilled_mb': round(self.spilled_bytes / 1e6, 2),
+        }
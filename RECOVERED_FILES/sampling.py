@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Batched Per-Row Sampling for the v3 Scheduler
+- Temperature, top-k, top-p and min-p from per-row parameter tensors, so every request in a batch keeps its own settings
+- One vectorized pass over the batch: a single sort serves top-k, top-p and min-p
+- Gumbel-max sampling with noise hashed from (seed, position, token), so a row's draw never depends on its batch-mates
+"""
+
+import torch
+
+# splitmix64 constants as signed int64; torch integer arithmetic wraps like the uint64 original
+_GOLDEN = -7046029254386353131   # 0x9e3779b97f4a7c15
+_MIX_1 = -4658895280553007687    # 0xbf58476d1ce4e5b9
+_MIX_2 = -7723592293110705685    # 0x94d049bb133111eb
+
+
+def _shr(z, bits):
+    """Logical right shift of int64 values (>> on torch int64 is arithmetic)"""
+    return (z >> bits) & ((1 << (64 - bits)) - 1)
+
+
+def _mix(z):
+    """splitmix64 finalizer: a bijective scramble of every bit of z"""
+    z = (z ^ _shr(z, 30)) * _MIX_1
+    z = (z ^ _shr(z, 27)) * _MIX_2
+    return z ^ _shr(z, 31)
+
+
+def gumbel_noise(seeds, positions, vocab_size):
+    """`[rows, vocab]` standard Gumbel noise, a pure function of each row's (seed, position) and the token ID"""
+    keys = _mix(seeds * _GOLDEN + positions)
+    tokens = torch.arange(vocab_size, dtype=torch.long, device=seeds.device) * _GOLDEN
+    bits = _mix(keys[:, None] ^ tokens[None, :])
+    # 53 random bits -> uniform in (0, 1), never exactly 0 or 1
+    uniform = (_shr(bits, 11).double() + 0.5) * 2.0 ** -53
+    return -torch.log(-torch.log(uniform))
+
+
+def row_params(rows, device):
+    """Parameter tensors from (temperature, top_p, top_k, min_p, seed, position) per row.
+
+    temperature <= 0 (or None) means greedy; top_p >= 1, top_k <= 0 and
+    min_p <= 0 (or None) switch the respective filter off for that row.
+    """
+    temperature, top_p, top_k, min_p, seeds, positions = zip(*rows)
+    return {
+        'temperature': torch.tensor([t or 0.0 for t in temperature], dtype=torch.float32, device=device),
+        'top_p': torch.tensor([1.0 if p is None else p for p in top_p], dtype=torch.float32, device=device),
+        'top_k': torch.tensor([k or 0 for k in top_k], dtype=torch.long, device=device),
+        'min_p': torch.tensor([m or 0.0 for m in min_p], dtype=torch.float32, device=device),
+        'seeds': torch.tensor(seeds, dtype=torch.long, device=device),
+        'positions': torch.tensor(positions, dtype=torch.long, device=device),
+    }
+
+
+def warp(scores, temperature, top_p, top_k, min_p, **_):
+    """Temperature-scaled `[rows, vocab]` logits with filtered-out tokens at -inf.
+
+    Filters run in the order top-k, top-p, min-p, each on what the previous
+    one kept; every row keeps at least its most likely token. Greedy rows
+    come back unscaled and unfiltered.
+    """
+    greedy = temperature <= 0
+    scores = scores / torch.where(greedy, torch.ones_like(temperature), temperature)[:, None]
+    filtered = ~greedy & ((top_k > 0) | (top_p < 1) | (min_p > 0))
+    if not bool(filtered.any()):
+        return scores
+
+    ordered, order = scores.sort(dim=-1, descending=True)
+    rank = torch.arange(scores.shape[-1], device=scores.device)[None, :]
+    remove = (top_k[:, None] > 0) & (rank >= top_k[:, None])
+    ordered = ordered.masked_fill(remove, float('-inf'))
+    probs = torch.softmax(ordered, dim=-1)
+    # Top-p keeps the smallest prefix whose mass reaches top_p: drop tokens once the mass before them does
+    remove = (top_p[:, None] < 1) & (probs.cumsum(dim=-1) - probs >= top_p[:, None])
+    # Min-p drops tokens far less likely than the best one; a ratio, so renormalizing after top-k does not change it
+    remove |= probs < min_p[:, None] * probs[:, :1]
+    remove[:, 0] = False
+    ordered = ordered.masked_fill(remove & filtered[:, None], float('-inf'))
+    return torch.empty_like(scores).scatter_(-1, order, ordered)
+
+
+def sample(scores, params):
+    """One token ID per row of `[rows, vocab]` scores: argmax for greedy rows, a seeded Gumbel-max draw otherwise"""
+    tokens = scores.argmax(dim=-1)
+    sampled = params['temperature'] > 0
+    if not bool(sampled.any()):
+        return tokens
+    rows = sampled.nonzero().squeeze(-1)
+    warped = warp(scores[rows], **{name: value[rows] for name, value in params.items()})
+    noise = gumbel_noise(params['seeds'][rows], params['positions'][rows], scores.shape[-1])
+    tokens[rows] = (warped.double() + noise).argmax(dim=-1)
+    return tokens
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Single-Flight Request Coalescing for LM Studio Server v3
+- Identical deterministic requests that arrive while one is still running attach to it instead of queueing again
+- Followers wait on (or stream from) the leader's scheduler request, so they get the same tokens
+- Subscribers are reference-counted: the shared request is only cancelled once every client has gone away
+"""
+
+import threading
+
+
+class _Flight:
+    def __init__(self, request):
+        self.request = request
+        self.subscribers = 1
+
+
+class SingleFlight:
+    """In-flight scheduler requests by key (see response_cache.response_key)"""
+
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def join(self, key, request, submit):
+        """(request to follow, error) for a new arrival.
+
+        With a running flight for key, the arrival follows that flight's
+        request. Otherwise submit(request) queues it (under the lock, so a
+        simultaneous duplicate cannot queue a second copy) and, unless submit
+        returned an error, it becomes the flight's leader.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and not flight.request.done and not flight.request.cancelled:
+                flight.subscribers += 1
+                self.coalesced += 1
+                return flight.request, None
+            error = submit(request)
+            if error is None:
+                self._flights[key] = _Flight(request)
+                self.leaders += 1
+            return request, error
+
+    def leave(self, key, request):
+        """Drop one subscriber of request's flight; True when nobody else is waiting on it"""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None or flight.request is not request:
+                return True
+            flight.subscribers -= 1
+            if flight.subscribers > 0:
+                return False
+            del self._flights[key]
+            return True
+
+    def stats(self):
+        return {
+            'in_flight': len(self._flights),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+        }
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Speculative Decoding Draft Model for LM Studio Server v3
+- A small model sharing the target's tokenizer proposes k tokens per step
+- The target checks all k in one forward pass and keeps the longest agreeing run
+- Greedy requests produce exactly the target's own output; sampled ones use rejection sampling
+"""
+
+import time
+
+import torch
+
+from batch_scheduler import cache_to_tensors
+from paged_kv_cache import PagedKVCache
+
+
+class DraftModel:
+    """The draft side of speculative decoding for one BatchScheduler.
+
+    The draft keeps its own PagedKVCache, indexed by the scheduler's
+    sequence IDs. Before a speculative step it is brought level with the
+    target's cache (prefilled on first use, caught up after plain decode
+    steps); after verification both caches are truncated to the accepted
+    length, so the two never disagree about what a sequence has seen.
+    """
+
+    def __init__(self, model, kv_cache=None, num_tokens=4, max_batch_size=4, name=None):
+        self.model = model
+        self.name = name
+        self.num_tokens = num_tokens
+        self.max_batch_size = max_batch_size
+        self.input_device = model.get_input_embeddings().weight.device
+        self.vocab_limit = None  # the target's vocab size, so drafts never propose tokens it cannot emit
+
+        if kv_cache is None:
+            kv_cache = PagedKVCache(num_blocks=max_batch_size * 256)
+            kv_cache.preallocate(model)
+        self.kv_cache = kv_cache
+
+        self.rounds = 0
+        self.verified = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.emitted = 0
+        self.resyncs = 0
+        self.draft_seconds = 0.0
+        self.verify_seconds = 0.0
+
+    def release(self, seq_id):
+        self.kv_cache.free(seq_id)
+
+    def reserve(self, seq, target_length, num_tokens):
+        """Make room for num_tokens drafted positions and sync seq's draft KV to target_length"""
+        seq_id = seq.seq_id
+        if not self.kv_cache.reserve(seq_id, target_length + num_tokens + 1):
+            self.release(seq_id)
+            return False
+        cached = self.kv_cache.lengths.get(seq_id, 0)
+        if cached != target_length:
+            self._catch_up(seq_id, seq.context_ids(), cached)
+        return True
+
+    def _catch_up(self, seq_id, context, cached):
+        """Run the draft over the context tokens its cache has not seen yet"""
+        if cached > len(context):
+            self.kv_cache.truncate(seq_id, 0)
+            cached = 0
+        self.resyncs += 1
+        input_ids = torch.tensor([context[cached:]], device=self.input_device)
+        if cached == 0:
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+            self.kv_cache.write(seq_id, cache_to_tensors(outputs.past_key_values))
+            return
+        count = len(context) - cached
+        past, mask = self.kv_cache.view([seq_id], count, self.input_device)
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=mask,
+            position_ids=torch.arange(cached, len(context), device=self.input_device).unsqueeze(0),
+            past_key_values=past,
+            use_cache=True,
+        )
+        past.commit(outputs.past_key_values)
+
+    def propose(self, batch, num_tokens, warp):
+        """Draft num_tokens tokens per sequence.
+
+        `warp(seq, history, scores)` applies the scheduler's repetition
+        controls and sampling warpers, so the draft proposes from the same
+        distribution family the target will be judged by. Returns the drafted
+        tokens and, for sampled requests, the draft probabilities they were
+        drawn from (None for greedy ones). The draft runs one extra step over
+        the last proposal so its cache covers every token it may keep.
+        """
+        start = time.monotonic()
+        seq_ids = [seq.seq_id for seq in batch]
+        drafts = [[] for _ in batch]
+        probs = [[] for _ in batch]
+        current = [seq.last_token for seq in batch]
+        for step in range(num_tokens + 1):
+            positions = [self.kv_cache.lengths[seq_id] for seq_id in seq_ids]
+            past, mask = self.kv_cache.view(seq_ids, 1, self.input_device)
+            outputs = self.model(
+                input_ids=torch.tensor([[token] for token in current], device=self.input_device),
+                attention_mask=mask,
+                position_ids=torch.tensor([[position] for position in positions], device=self.input_device),
+                past_key_values=past,
+                use_cache=True,
+            )
+            past.commit(outputs.past_key_values)
+            if step == num_tokens:
+                break
+            logits = outputs.logits[:, -1, :].float()
+            for row, seq in enumerate(batch):
+                scores = warp(seq, seq.token_ids + drafts[row], logits[row:row + 1, :self.vocab_limit])
+                if seq.request.greedy:
+                    token, dist = int(scores.argmax(dim=-1)), None
+                else:
+                    dist = torch.softmax(scores, dim=-1)[0]
+                    token = int(torch.multinomial(dist, num_samples=1))
+                drafts[row].append(token)
+                probs[row].append(dist)
+            current = [tokens[-1] for tokens in drafts]
+        self.draft_seconds += time.monotonic() - start
+        return drafts, probs
+
+    def verify(self, draft_token, draft_probs, target_scores, greedy):
+        """Verify one drafted token against the target's warped scores.
+
+        Returns (accepted, replacement): on rejection the replacement comes from
+        the residual distribution max(0, p - q), which keeps sampled output
+        distributed exactly as if the target had sampled on its own.
+        """
+        if greedy:
+            target_token = int(target_scores.argmax(dim=-1))
+            return target_token == draft_token, target_token
+        p = torch.softmax(target_scores, dim=-1)[0]
+        q = torch.zeros_like(p)
+        width = min(len(q), len(draft_probs))
+        q[:width] = draft_probs[:width].to(p.device)
+        if draft_token < len(p) and float(torch.rand(())) * float(q[draft_token]) < float(p[draft_token]):
+            return True, None
+        residual = torch.clamp(p - q, min=0)
+        if float(residual.sum()) <= 0:
+            residual = p
+        return False, int(torch.multinomial(residual / residual.sum(), num_samples=1))
+
+    def record(self, proposed, accepted, emitted):
+        """Count one sequence's verification: tokens drafted, drafts kept and tokens emitted"""
+        self.verified += 1
+        self.proposed += proposed
+        self.accepted += accepted
+        self.emitted += emitted
+
+    def stats(self):
+        return {
+            'draft_model': self.name,
+            'num_tokens': self.num_tokens,
+            'max_batch_size': self.max_batch_size,
+            'rounds': self.rounds,
+            'proposed': self.proposed,
+            'accepted': self.accepted,
+            'acceptance_rate': round(self.accepted / self.proposed, 3) if self.proposed else 0,
+            'tokens_per_verify': round(self.emitted / self.verified, 2) if self.verified else 0,
+            'resyncs': self.resyncs,
+            'draft_seconds': round(self.draft_seconds, 2),
+            'verify_seconds': round(self.verify_seconds, 2),
+            'kv_cache': self.kv_cache.stats(),
+        }
+
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Deterministic Stub Model for LM Studio Server v3
+- A stand-in causal LM that sleeps instead of computing: a fixed cost per forward pass plus a cost per prompt token
+- Emits a scripted token sequence and never EOS, so every request runs to max_new_tokens
+- Goes through the real tokenizer, scheduler and paged KV cache, so benchmarks measure server overhead without a GPU
+"""
+
+import string
+import time
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers
+from transformers import LlamaConfig, PreTrainedTokenizerFast
+from transformers.modeling_outputs import CausalLMOutputWithPast
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+try:
+    from transformers import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+STUB_MODEL_NAME = 'stub'
+EOS_TOKEN = '<|endoftext|>'
+# 61 symbols (a prime), so every stride below walks through all of them before repeating
+ALPHABET = string.ascii_lowercase + string.ascii_uppercase + '012345678'
+
+
+def scripted_token(position):
+    """Token the stub emits at an absolute position.
+
+    Each lap over the alphabet uses a different stride, so no trigram
+    repeats for thousands of tokens and the scheduler's no-repeat-ngram
+    processor never has to override the script.
+    """
+    lap, index = divmod(position, len(ALPHABET))
+    stride = 7 + lap % (len(ALPHABET) - 7)
+    return ord(ALPHABET[index * stride % len(ALPHABET)])
+
+
+def stub_tokenizer():
+    """Byte-level tokenizer where token id == byte value, plus EOS as id 256"""
+    byte_to_char = bytes_to_unicode()
+    vocab = {byte_to_char[b]: b for b in range(256)}
+    vocab[EOS_TOKEN] = 256
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token=EOS_TOKEN, pad_token=EOS_TOKEN)
+
+
+class StubModel(torch.nn.Module):
+    """Causal-LM interface (forward with past_key_values, logits, config) backed by sleep().
+
+    A forward pass costs `token_delay` seconds, like a memory-bound decode
+    step whose time hardly depends on batch size, plus `prefill_delay`
+    seconds per token for passes that process more than one position per
+    row. KV tensors are zero-filled but correctly shaped, so the paged KV
+    cache and prefix cache do their usual bookkeeping.
+    """
+
+    def __init__(self, token_delay=0.02, prefill_delay=0.0002, num_layers=2, head_dim=8):
+        super().__init__()
+        self.config = LlamaConfig(
+            vocab_size=257,
+            hidden_size=head_dim,
+            intermediate_size=head_dim,
+            num_hidden_layers=num_layers,
+            num_attention_heads=1,
+            num_key_value_heads=1,
+            max_position_embeddings=1 << 20,
+            eos_token_id=256,
+        )
+        self.token_delay = token_delay
+        self.prefill_delay = prefill_delay
+        self.embed_tokens = torch.nn.Embedding(self.config.vocab_size, head_dim)
+        # One placeholder module per layer so the KV pool is allocated per "layer" as for a real model
+        self.layers = torch.nn.ModuleList(torch.nn.Linear(1, 1, bias=False) for _ in range(num_layers))
+        self.forward_passes = 0
+
+    def get_input_embeddings(self):
+        return self.embed_tokens
+
+    def forward(self, input_ids, attention_mask=None, position_ids=None, past_key_values=None, use_cache=True, **kwargs):
+        batch, width = input_ids.shape
+        past_length = past_key_values.get_seq_length() if past_key_values is not None else 0
+        if position_ids is None:
+            position_ids = torch.arange(past_length, past_length + width, device=input_ids.device).expand(batch, width)
+        time.sleep(self.token_delay + (self.prefill_delay * batch * width if width > 1 else 0.0))
+        self.forward_passes += 1
+
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        weight = self.embed_tokens.weight
+        for layer_idx in range(self.config.num_hidden_layers):
+            kv = weight.new_zeros((batch, 1, width, self.config.hidden_size))
+            past_key_values.update(kv, kv.clone(), layer_idx)
+
+        logits = weight.new_zeros((batch, width, self.config.vocab_size))
+        logits[..., self.config.eos_token_id] = float('-inf')
+        targets = torch.tensor([[scripted_token(position + 1) for position in row] for row in position_ids.tolist()],
+                               device=input_ids.device)
+        logits.scatter_(2, targets.unsqueeze(-1), 20.0)
+        return CausalLMOutputWithPast(logits=logits, past_key_values=past_key_values)
+
+
+def load_stub(token_delay=0.02, prefill_delay=0.0002, device='cpu'):
+    """(model, tokenizer) for the stub backend"""
+    model = StubModel(token_delay=token_delay, prefill_delay=prefill_delay).to(device).eval()
+    return model, stub_tokenizer()
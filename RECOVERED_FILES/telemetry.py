@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Background Telemetry Sampler for the LM Studio Servers
+- One daemon thread collects CPU, RAM, disk and GPU stats on a fixed interval
+- /status reads the latest snapshot instead of measuring on every poll
+- A ring buffer of past snapshots backs /metrics/history time series
+"""
+
+import threading
+import time
+from collections import deque
+
+import psutil
+
+
+class SystemStats:
+    """CPU / RAM / disk figures without blocking the caller.
+
+    CPU load is measured between consecutive calls (psutil's non-blocking
+    mode) instead of sleeping for a second, and the disk figure - an NFS
+    round trip on the cluster - is refreshed at most every `disk_interval`
+    seconds.
+    """
+
+    def __init__(self, disk_path, disk_interval=60.0):
+        self.disk_path = disk_path
+        self.disk_interval = disk_interval
+        self._disk = None
+        self._disk_at = 0.0
+        psutil.cpu_percent(interval=None)  # prime the counter so the first reading covers a real interval
+
+    def __call__(self):
+        memory = psutil.virtual_memory()
+        info = {
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "memory_total": memory.total / 1e9,
+            "memory_used": memory.used / 1e9,
+            "memory_percent": memory.percent,
+        }
+        now = time.time()
+        if self._disk is None or now - self._disk_at >= self.disk_interval:
+            try:
+                self._disk = psutil.disk_usage(self.disk_path)
+            except OSError:
+                self._disk = None
+            self._disk_at = now
+        if self._disk is not None:
+            info.update({
+                "disk_total": self._disk.total / 1e9,
+                "disk_used": self._disk.used / 1e9,
+                "disk_percent": (self._disk.used / self._disk.total) * 100,
+            })
+        return info
+
+
+def _flatten(value, prefix, out):
+    """Numeric leaves of nested dicts / lists as {'a.b.0.c': number}"""
+    if isinstance(value, bool):
+        return
+    if isinstance(value, (int, float)):
+        out[prefix] = value
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(item, f'{prefix}.{key}' if prefix else str(key), out)
+    elif isinstance(value, (list, tuple)):
+        for index, item in enumerate(value):
+            _flatten(item, f'{prefix}.{index}' if prefix else str(index), out)
+
+
+class TelemetrySampler:
+    """Runs `collectors` ({name: callable returning a JSON-able dict}) every `interval` seconds.
+
+    The newest snapshot is what /status serves; the last `history_seconds`
+    of snapshots stay in a ring buffer. A collector that raises records
+    {'error': ...} for that sample instead of stopping the thread.
+    """
+
+    def __init__(self, collectors, interval=2.0, history_seconds=3600):
+        self.collectors = dict(collectors)
+        self.interval = interval
+        self.samples = deque(maxlen=max(1, int(history_seconds / interval)))
+        self.sample_seconds = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # One synchronous sample first, so readers never see an empty buffer
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name='telemetry', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        start = time.time()
+        snapshot = {'time': start}
+        for name, collect in self.collectors.items():
+            try:
+                snapshot[name] = collect()
+            except Exception as e:
+                snapshot[name] = {'error': str(e)}
+        with self._lock:
+            self.samples.append(snapshot)
+            self.sample_seconds = time.time() - start
+        return snapshot
+
+    def latest(self, name=None):
+        """Most recent snapshot (or one collector's part of it)"""
+        with self._lock:
+            snapshot = self.samples[-1] if self.samples else {}
+        if name is not None:
+            return snapshot.get(name)
+        return dict(snapshot, age=round(time.time() - snapshot['time'], 2)) if snapshot else {}
+
+    def history(self, seconds=600, prefix=None):
+        """Samples from the last `seconds` as {'timestamps': [...], 'series': {'gpu_info.gpus.0.free': [...]}}.
+
+        Every numeric value in the snapshots becomes a series keyed by its
+        dotted path; `prefix` keeps only the series under one path. A value
+        missing from a sample shows up as None, so all series line up with
+        the timestamps.
+        """
+        cutoff = time.time() - seconds
+        with self._lock:
+            samples = [s for s in self.samples if s['time'] >= cutoff]
+        flat = []
+        for snapshot in samples:
+            values = {}
+            _flatten({k: v for k, v in snapshot.items() if k != 'time'}, '', values)
+            flat.append(values)
+        names = sorted({name for values in flat for name in values
+                        if prefix is None or name == prefix or name.startswith(prefix + '.')})
+        return {
+            'interval': self.interval,
+            'samples': len(samples),
+            'timestamps': [round(s['time'], 3) for s in samples],
+            'series': {name: [values.get(name) for values in flat] for name in names},
+        }
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'samples': len(self.samples),
+            'capacity': self.samples.maxlen,
+            'last_sample_seconds': round(self.sample_seconds, 4),
+        }
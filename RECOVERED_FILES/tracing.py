@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Request Lifecycle Tracing for LM Studio Server v3
+- Records enqueue, batch join, prefill, decode-step, stream-flush and completion spans
+- Writes Chrome trace format JSON (chrome://tracing, ui.perfetto.dev) from a bounded in-memory buffer
+- Off until start() is called; a sampling rate picks which requests get their own track
+"""
+
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+# Track 0 of every model is its scheduler thread; requests get tracks 1, 2, ...
+SCHEDULER_TID = 0
+
+
+class Tracer:
+    """Bounded buffer of Chrome trace events, captured between start() and stop().
+
+    Every model is a trace process and every sampled request a thread in
+    it, so concurrent requests show up as parallel tracks under the
+    scheduler track that holds the decode steps they shared. Timestamps are
+    time.monotonic() seconds, the clock the scheduler already uses. When the
+    buffer is full the oldest events are dropped, so a long capture keeps
+    its most recent `max_events`.
+    """
+
+    def __init__(self, max_events=200000, sample_rate=1.0, clock=time.monotonic):
+        self.max_events = max_events
+        self.sample_rate = sample_rate
+        self.clock = clock
+        self.active = False
+        self.started_at = None
+        self.events = deque(maxlen=max_events)
+        self.recorded = 0
+        self.sampled_requests = 0
+        self._pids = {}
+        self._names = {}  # (pid, tid) -> thread name, re-emitted with every capture
+        self._tids = itertools.count(1)
+        self._random = random.Random()
+        self._lock = threading.Lock()
+
+    def start(self, sample_rate=None, max_events=None):
+        """Clear the buffer and begin recording"""
+        with self._lock:
+            if sample_rate is not None:
+                self.sample_rate = sample_rate
+            if max_events is not None:
+                self.max_events = max_events
+            self.events = deque(maxlen=self.max_events)
+            self.recorded = 0
+            self.sampled_requests = 0
+            self.started_at = self.clock()
+            self.active = True
+
+    def stop(self, path):
+        """Stop recording and write the capture to path; returns a summary of what was written"""
+        with self._lock:
+            self.active = False
+            events = list(self.events)
+            names = dict(self._names)
+            pids = dict(self._pids)
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': name}}
+                    for name, pid in pids.items()]
+        metadata += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                     for (pid, tid), name in names.items()]
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + events, 'displayTimeUnit': 'ms'}, f)
+        return {
+            'path': path,
+            'events': len(events),
+            'dropped': max(0, self.recorded - len(events)),
+            'sampled_requests': self.sampled_requests,
+            'seconds': round(self.clock() - self.started_at, 3) if self.started_at is not None else 0,
+        }
+
+    def process(self, name):
+        """Trace pid for a model (or any other component), registering it on first use"""
+        with self._lock:
+            if name not in self._pids:
+                self._pids[name] = len(self._pids) + 1
+                self._names[(self._pids[name], SCHEDULER_TID)] = 'scheduler'
+            return self._pids[name]
+
+    def sample(self, pid, label):
+        """A new track for one request, or None if tracing is off or the request was not sampled"""
+        if not self.active or self._random.random() >= self.sample_rate:
+            return None
+        tid = next(self._tids)
+        with self._lock:
+            self._names[(pid, tid)] = label
+            self.sampled_requests += 1
+        return tid
+
+    def _ts(self, at):
+        return round((at - self.started_at) * 1e6, 1)
+
+    def span(self, name, start, end, pid, tid, args=None):
+        """A complete ('X') event from start to end (monotonic seconds)"""
+        if not self.active:
+            return
+        event = {'name': name, 'ph': 'X', 'ts': self._ts(start), 'dur': round((end - start) * 1e6, 1),
+                 'pid': pid, 'tid': tid}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+        self.recorded += 1
+
+    def instant(self, name, at, pid, tid, args=None):
+        """A thread-scoped instant ('i') event"""
+        if not self.active:
+            return
+        event = {'name': name, 'ph': 'i', 's': 't', 'ts': self._ts(at), 'pid': pid, 'tid': tid}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+        self.recorded += 1
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'sample_rate': self.sample_rate,
+            'events': len(self.events),
+            'max_events': self.max_events,
+            'dropped': max(0, self.recorded - len(self.events)),
+            'sampled_requests': self.sampled_requests,
+        }